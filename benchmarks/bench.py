@@ -0,0 +1,251 @@
+"""
+Latency/throughput benchmarks for the MCP tools, run against the fake IMAP
+and SMTP servers in fake_servers.py (no real mail account involved).
+
+    python benchmarks/bench.py
+    python benchmarks/bench.py --messages 100000 --html-ratio 0.5 --latency 0.02
+    python benchmarks/bench.py --json before.json
+    python benchmarks/bench.py --baseline before.json   # exit code 1 on regressions
+
+Every scenario runs at each --limits / --concurrency combination and reports
+latency percentiles (ms), throughput (calls/s) and IMAP commands per call.
+The servers run on their own thread and event loop, so their work doesn't
+show up as client latency; --latency adds a simulated network round trip to
+every IMAP command.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import platform
+import re
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from fake_servers import USER, PASSWORD, FakeIMAPServer, FakeMailStore, FakeSMTPServer, make_tls_context
+
+SCENARIOS = ("list_folders", "list_emails", "list_emails_body", "read_email", "read_email_cached",
+             "send_email", "send_email_delivered")
+# Scenarios whose cost depends on the page size
+PAGED = {"list_emails", "list_emails_body"}
+# Slowdowns smaller than this are timer noise, whatever the percentage
+NOISE_MS = 0.5
+
+
+def percentile(values: list[float], pct: float) -> float:
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+class ServerThread:
+    """The fake servers on a background event loop."""
+
+    def __init__(self, store: FakeMailStore, latency: float):
+        self.store = store
+        self.latency = latency
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="fake-servers", daemon=True)
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def start(self) -> tuple[Path, int, int]:
+        self.thread.start()
+        tls, cert = make_tls_context()
+        self.imap = self._run(FakeIMAPServer(self.store, tls=tls, latency=self.latency).__aenter__())
+        self.smtp = self._run(FakeSMTPServer(self.store, tls=tls).__aenter__())
+        return cert, self.imap.port, self.smtp.port
+
+    def stop(self) -> None:
+        self._run(self.imap.__aexit__())
+        self._run(self.smtp.__aexit__())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def build_scenarios(server, uids: list[int]) -> dict:
+    """name -> factory(limit) -> async call(i)."""
+    tool = lambda f: getattr(f, "fn", f)
+    list_folders, list_emails = tool(server.list_folders), tool(server.list_emails)
+    read_email, send_email = tool(server.read_email), tool(server.send_email)
+    # Every cold read gets a message nobody has read yet (oldest first; the listings cover the newest)
+    unread = itertools.count()
+
+    async def send(i: int) -> str:
+        return await send_email([f"bench{i}@example.org"], f"Benchmark {i}", "Hello from the benchmark.\n" * 20)
+
+    async def send_and_wait(i: int):
+        result = await send(i)
+        match = re.search(r"id: (\w+)", result)
+        if not match:
+            return result
+        while True:
+            status = server.outbox.status(match.group(1))[0]["status"]
+            if status not in ("queued", "sending"):
+                return result if status == "sent" else f"Error: {status}"
+            await asyncio.sleep(0.002)
+
+    return {
+        "list_folders": lambda limit: lambda i: list_folders(),
+        "list_emails": lambda limit: lambda i: list_emails(limit=limit),
+        "list_emails_body": lambda limit: lambda i: list_emails(limit=limit, include_body=True),
+        "read_email": lambda limit: lambda i: read_email(str(uids[next(unread) % len(uids)])),
+        "read_email_cached": lambda limit: lambda i: read_email(str(uids[-1])),
+        "send_email": lambda limit: send,
+        "send_email_delivered": lambda limit: send_and_wait,
+    }
+
+
+def failed(result) -> bool:
+    if isinstance(result, dict):
+        return "error" in result
+    if isinstance(result, list):
+        return any(isinstance(item, dict) and "error" in item for item in result)
+    return isinstance(result, str) and result.startswith("Error")
+
+
+async def measure(call, iterations: int, concurrency: int, servers: ServerThread) -> dict:
+    latencies, errors = [], 0
+    counter = itertools.count()
+    commands_before = len(servers.imap.commands)
+
+    async def worker():
+        nonlocal errors
+        while (i := next(counter)) < iterations:
+            start = time.perf_counter()
+            try:
+                result = await call(i)
+            except Exception as e:
+                result = f"Error: {e}"
+            latencies.append(time.perf_counter() - start)
+            errors += failed(result)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - start
+    ms = [latency * 1000 for latency in latencies]
+    return {
+        "calls": len(ms),
+        "p50_ms": round(percentile(ms, 50), 2),
+        "p90_ms": round(percentile(ms, 90), 2),
+        "p99_ms": round(percentile(ms, 99), 2),
+        "max_ms": round(max(ms), 2),
+        "calls_per_s": round(len(ms) / wall, 1),
+        "imap_per_call": round((len(servers.imap.commands) - commands_before) / len(ms), 2),
+        "errors": errors,
+    }
+
+
+async def run(args, servers: ServerThread, uids: list[int]) -> list[dict]:
+    from src import server
+
+    scenarios = build_scenarios(server, uids)
+    results = []
+    print(f"{'scenario':<22}{'limit':>6}{'conc':>6}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}"
+          f"{'calls/s':>10}{'imap/call':>11}{'errors':>8}")
+    for name in args.scenarios:
+        for limit in (args.limits if name in PAGED else [None]):
+            factory = scenarios[name](limit)
+            for concurrency in args.concurrency:
+                # Warm up the connection pool (and, for cached reads, the cache)
+                await measure(factory, concurrency, concurrency, servers)
+                row = {"scenario": name, "limit": limit, "concurrency": concurrency,
+                       **await measure(factory, args.iterations, concurrency, servers)}
+                results.append(row)
+                print(f"{name:<22}{limit or '-':>6}{concurrency:>6}{row['p50_ms']:>10}{row['p90_ms']:>10}"
+                      f"{row['p99_ms']:>10}{row['max_ms']:>10}{row['calls_per_s']:>10}"
+                      f"{row['imap_per_call']:>11}{row['errors']:>8}")
+
+    await server.outbox.stop()
+    await server.idle_watcher.stop()
+    await server.imap_pool.close_all()
+    await server.smtp_pool.close_all()
+    server.parse_pool.shutdown()
+    return results
+
+
+def compare(results: list[dict], meta: dict, baseline_path: str, threshold: float) -> bool:
+    """Print p50 changes against a --json file from an earlier run; True if anything got slower than allowed."""
+    key = lambda row: (row["scenario"], row["limit"], row["concurrency"])
+    saved = json.loads(Path(baseline_path).read_text())
+    baseline = {key(row): row for row in saved["results"]}
+    regressed = False
+    print(f"\nAgainst {baseline_path} (p50, regression above +{threshold:.0%}):")
+    changed = {k: (v, meta[k]) for k, v in saved["meta"].items() if k in meta and meta[k] != v}
+    if changed:
+        print(f"  Note: the runs used different settings, {changed}")
+    for row in results:
+        old = baseline.get(key(row))
+        if old is None or not old["p50_ms"]:
+            continue
+        change = row["p50_ms"] / old["p50_ms"] - 1
+        flag = change > threshold and row["p50_ms"] - old["p50_ms"] > NOISE_MS
+        regressed |= flag
+        print(f"  {row['scenario']:<22}{row['limit'] or '-':>6}{row['concurrency']:>6}  "
+              f"{old['p50_ms']:>9} -> {row['p50_ms']:<9} {change:+.0%}{'  REGRESSION' if flag else ''}")
+    return regressed
+
+
+def csv_list(cast):
+    return lambda value: [cast(item) for item in value.split(",") if item]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1000, help="messages seeded into INBOX (1k to 1M)")
+    parser.add_argument("--html-ratio", type=float, default=0.3, help="share of HTML-heavy messages")
+    parser.add_argument("--html-kb", type=int, default=40, help="size of each HTML body")
+    parser.add_argument("--gmail", action="store_true", help="act like Gmail (X-GM-EXT-1, [Gmail]/ folders)")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated seconds per IMAP round trip")
+    parser.add_argument("--limits", type=csv_list(int), default=[10, 50], help="page sizes for list_emails")
+    parser.add_argument("--concurrency", type=csv_list(int), default=[1, 8], help="concurrent callers")
+    parser.add_argument("--iterations", type=int, default=50, help="calls per scenario and setting")
+    parser.add_argument("--scenarios", type=csv_list(str), default=list(SCENARIOS),
+                        help=f"comma separated, from: {', '.join(SCENARIOS)}")
+    parser.add_argument("--idle", action="store_true", help="leave the IMAP IDLE watcher on")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare with the --json output of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed p50 slowdown against --baseline")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    store = FakeMailStore(gmail=args.gmail)
+    started = time.perf_counter()
+    store.seed("INBOX", args.messages, html_ratio=args.html_ratio, html_kb=args.html_kb)
+    print(f"Seeded {args.messages} messages in {time.perf_counter() - started:.1f}s")
+    uids = [message.uid for message in store.mailboxes["INBOX"].messages]
+
+    servers = ServerThread(store, args.latency)
+    cert, imap_port, smtp_port = servers.start()
+    # Before the first import of src: the config is read from the environment then
+    os.environ.update(
+        SSL_CERT_FILE=str(cert), IMAP_HOST="localhost", SMTP_HOST="localhost",
+        IMAP_PORT=str(imap_port), SMTP_PORT=str(smtp_port), EMAIL_USER=USER, EMAIL_PASS=PASSWORD,
+        CACHE_DIR=tempfile.mkdtemp(prefix="email-mcp-bench-"), IDLE_ENABLED=str(args.idle).lower(),
+    )
+    try:
+        results = asyncio.run(run(args, servers, uids))
+    finally:
+        servers.stop()
+
+    meta = {key: getattr(args, key) for key in ("messages", "html_ratio", "html_kb", "gmail", "latency", "iterations")}
+    meta["python"] = platform.python_version()
+    if args.json:
+        Path(args.json).write_text(json.dumps({"meta": meta, "results": results}, indent=2))
+    if args.baseline and compare(results, meta, args.baseline, args.threshold):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1012 @@
+"""
+In-process fake IMAP4rev1 and SMTP servers for benchmarks and local experiments.
+
+Only the parts of the protocols the MCP tools actually use are implemented, but
+those parts follow the RFCs closely enough for aioimaplib/aiosmtplib: UID
+commands, BODYSTRUCTURE, partial BODY.PEEK[section]<offset.len>, CONDSTORE
+(MODSEQ / CHANGEDSINCE), IDLE, MOVE, UIDPLUS and the Gmail X-GM-* extensions.
+
+Mailboxes live in memory and can be seeded with synthetic messages:
+
+    store = FakeMailStore()
+    store.seed("INBOX", 10_000, html_ratio=0.5)
+    async with FakeIMAPServer(store) as imap, FakeSMTPServer(store) as smtp:
+        ...  # point IMAP_HOST/IMAP_PORT/SMTP_HOST/SMTP_PORT at imap.port / smtp.port
+"""
+import asyncio
+import base64
+import datetime as dt
+import email
+import os
+import random
+import re
+import ssl
+import subprocess
+import tempfile
+from dataclasses import dataclass, field
+from email.policy import default
+from email.utils import format_datetime, make_msgid, parsedate_to_datetime
+from pathlib import Path
+
+USER = "bench@example.com"
+PASSWORD = "bench-password"
+
+SPECIAL_USE = {
+    "[Gmail]/Sent Mail": "\\Sent",
+    "[Gmail]/Drafts": "\\Drafts",
+    "[Gmail]/Trash": "\\Trash",
+    "[Gmail]/Spam": "\\Junk",
+    "[Gmail]/All Mail": "\\All",
+}
+
+WORDS = (
+    "invoice meeting schedule report quarterly update review project deadline "
+    "budget lunch travel release customer support ticket design roadmap launch "
+    "newsletter offer discount weekly digest security alert password account"
+).split()
+
+
+# --------------------------------------------------------------------------- #
+# Certificates
+# --------------------------------------------------------------------------- #
+
+def make_tls_context() -> tuple[ssl.SSLContext, Path]:
+    """
+    Create a self-signed localhost certificate and a server context for it.
+
+    Returns the context and the certificate path; point SSL_CERT_FILE at the
+    path so ssl.create_default_context() in the clients trusts it.
+    """
+    tmp = Path(tempfile.mkdtemp(prefix="fake-mail-tls-"))
+    cert, key = tmp / "cert.pem", tmp / "key.pem"
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "2",
+         "-keyout", str(key), "-out", str(cert), "-subj", "/CN=localhost",
+         "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1"],
+        check=True, capture_output=True,
+    )
+    ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ctx.load_cert_chain(cert, key)
+    return ctx, cert
+
+
+# --------------------------------------------------------------------------- #
+# Mail store
+# --------------------------------------------------------------------------- #
+
+@dataclass
+class FakeMessage:
+    uid: int
+    raw: bytes
+    flags: set[str] = field(default_factory=set)
+    internaldate: dt.datetime = field(default_factory=lambda: dt.datetime.now(dt.timezone.utc))
+    modseq: int = 1
+    gm_msgid: int = 0
+    gm_thrid: int = 0
+    labels: set[str] = field(default_factory=set)
+    _parsed: email.message.Message | None = None
+
+    @property
+    def parsed(self):
+        if self._parsed is None:
+            self._parsed = email.message_from_bytes(self.raw, policy=default)
+        return self._parsed
+
+
+@dataclass
+class FakeMailbox:
+    name: str
+    attributes: str = ""
+    uidvalidity: int = 1
+    uidnext: int = 1
+    highestmodseq: int = 1
+    messages: list[FakeMessage] = field(default_factory=list)
+
+
+class FakeMailStore:
+    """Shared state for the fake servers (one account)."""
+
+    def __init__(self, gmail: bool = True):
+        self.gmail = gmail
+        self.mailboxes: dict[str, FakeMailbox] = {}
+        self.sent: list[tuple[str, list[str], bytes]] = []   # SMTP envelopes
+        self._watchers: set[asyncio.Queue] = set()
+        self._next_gm_id = 1
+        for name in ["INBOX", "Drafts", "Sent", "Trash", "Junk"] if not gmail else \
+                ["INBOX", *SPECIAL_USE]:
+            self.create(name)
+
+    def create(self, name: str) -> FakeMailbox:
+        attrs = SPECIAL_USE.get(name, "")
+        if not self.gmail and name in ("Sent", "Drafts", "Trash", "Junk"):
+            attrs = "\\" + name
+        box = FakeMailbox(name, attributes=attrs, uidvalidity=random.randint(1, 2**31 - 1))
+        self.mailboxes[name] = box
+        return box
+
+    def add(self, mailbox: str, raw: bytes, flags: set[str] | None = None,
+            internaldate: dt.datetime | None = None, thread_of: FakeMessage | None = None) -> FakeMessage:
+        box = self.mailboxes[mailbox]
+        box.highestmodseq += 1
+        gm_id = self._next_gm_id
+        self._next_gm_id += 1
+        msg = FakeMessage(
+            uid=box.uidnext, raw=raw, flags=set(flags or ()), modseq=box.highestmodseq,
+            internaldate=internaldate or dt.datetime.now(dt.timezone.utc),
+            gm_msgid=gm_id, gm_thrid=thread_of.gm_thrid if thread_of else gm_id,
+        )
+        box.uidnext += 1
+        box.messages.append(msg)
+        self.notify(mailbox, f"{len(box.messages)} EXISTS")
+        return msg
+
+    def notify(self, mailbox: str, line: str) -> None:
+        for queue in list(self._watchers):
+            queue.put_nowait((mailbox, line))
+
+    def bump(self, box: FakeMailbox, msg: FakeMessage) -> None:
+        box.highestmodseq += 1
+        msg.modseq = box.highestmodseq
+
+    def seed(self, mailbox: str, count: int, html_ratio: float = 0.3, attachment_ratio: float = 0.05,
+             html_kb: int = 40, thread_ratio: float = 0.2, seed: int = 1) -> None:
+        """
+        Fill a mailbox with `count` synthetic messages, oldest first.
+
+        Messages are rendered from templates rather than built as
+        EmailMessages, so a million plain ones seed in under a minute (budget
+        about 2 KB of memory each, plus html_kb per HTML message).
+        """
+        rng = random.Random(seed)
+        start = dt.datetime(2024, 1, 1, tzinfo=dt.timezone.utc)
+        step = dt.timedelta(seconds=max(1, (60 * 60 * 24 * 365) // max(count, 1)))
+        previous: list[tuple[FakeMessage, dict]] = []
+        for i in range(count):
+            when = start + step * i
+            parent = rng.choice(previous) if previous and rng.random() < thread_ratio else None
+            html = rng.random() < html_ratio
+            attachment = rng.random() < attachment_ratio
+            reply_to = parent[1] if parent else None
+            raw, headers = synthetic_message(rng, i, when, html=html, attachment=attachment, html_kb=html_kb,
+                                             reply_to=reply_to)
+            flags = {"\\Seen"} if rng.random() < 0.7 else set()
+            if rng.random() < 0.05:
+                flags.add("\\Flagged")
+            stored = self.add(mailbox, raw, flags=flags, internaldate=when,
+                              thread_of=parent[0] if parent else None)
+            # Replies go to one of the last 50 messages
+            previous.append((stored, headers))
+            if len(previous) > 50:
+                previous.pop(0)
+
+
+def _thread_headers(reply_to: dict | None, subject: str) -> tuple[str, dict]:
+    """Subject plus In-Reply-To/References for a reply to `reply_to` (Subject/Message-ID/References)."""
+    if reply_to is None:
+        return subject, {}
+    subject = "Re: " + re.sub(r"^(Re: )+| #\d+$", "", reply_to["Subject"])
+    refs = " ".join(filter(None, [reply_to.get("References", ""), reply_to["Message-ID"]]))
+    return subject, {"In-Reply-To": reply_to["Message-ID"], "References": refs}
+
+
+HTML_ROW = "<tr><td style='padding:4px;font-family:Arial'>{}</td><td><a href='https://example.org/{}'>{}</a></td></tr>"
+
+
+def synthetic_message(rng: random.Random, i: int, when: dt.datetime, html: bool = False,
+                      attachment: bool = False, html_kb: int = 40, reply_to: dict | None = None) -> tuple[bytes, dict]:
+    """
+    A synthetic message rendered straight to bytes (text/plain, plus an HTML
+    alternative and/or an attachment), and its Subject/Message-ID/References
+    for replies to it.
+    """
+    sender = f"user{rng.randint(1, 200)}@example.org"
+    words = rng.choices(WORDS, k=5 + 8 * 12)
+    subject, thread = _thread_headers(reply_to, " ".join(words[:5]).capitalize())
+    headers = {"Subject": f"{subject} #{i}", "Message-ID": make_msgid(domain="example.org"), **thread}
+    lines = [f"From: {sender}", f"To: {USER}", f"Subject: {headers['Subject']}", f"Date: {format_datetime(when)}",
+             f"Message-ID: {headers['Message-ID']}", *(f"{k}: {headers[k]}" for k in thread), "MIME-Version: 1.0"]
+    text = ['Content-Type: text/plain; charset="utf-8"', "Content-Transfer-Encoding: 7bit", "",
+            *(" ".join(words[n:n + 12]) for n in range(5, len(words), 12))]
+
+    body = text
+    if html:
+        count = max(1, html_kb * 1024 // len(HTML_ROW.format("report", 500000, "report")))
+        cells = rng.choices(WORDS, k=2 * count)
+        rows = [HTML_ROW.format(cells[2 * n], rng.randint(1, 10**6), cells[2 * n + 1]) for n in range(count)]
+        boundary = f"=_alt_{i}"
+        body = [f'Content-Type: multipart/alternative; boundary="{boundary}"', "",
+                f"--{boundary}", *text, f"--{boundary}",
+                'Content-Type: text/html; charset="utf-8"', "Content-Transfer-Encoding: 7bit", "",
+                f"<html><body><h1>{subject}</h1><table>", *rows, "</table></body></html>", f"--{boundary}--"]
+    if attachment:
+        data = base64.encodebytes(os.urandom(rng.randint(20_000, 200_000))).decode().splitlines()
+        boundary = f"=_mixed_{i}"
+        body = [f'Content-Type: multipart/mixed; boundary="{boundary}"', "",
+                f"--{boundary}", *body, f"--{boundary}",
+                "Content-Type: application/octet-stream", "Content-Transfer-Encoding: base64",
+                f'Content-Disposition: attachment; filename="report-{i}.bin"', "", *data, f"--{boundary}--"]
+    return "\r\n".join([*lines, *body, ""]).encode(), headers
+
+
+# --------------------------------------------------------------------------- #
+# IMAP syntax helpers
+# --------------------------------------------------------------------------- #
+
+TOKEN_RE = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|(\[[^\]]*\](?:<[^>]*>)?)|([^\s()"\[]+(?:\[[^\]]*\](?:<[^>]*>)?)?))')
+
+
+def tokenize(data: bytes) -> list:
+    """Parse IMAP arguments into nested lists of str."""
+    stack: list[list] = [[]]
+    pos = 0
+    while pos < len(data):
+        m = TOKEN_RE.match(data, pos)
+        if not m or m.end() == pos:
+            break
+        pos = m.end()
+        if m.group(1):
+            stack.append([])
+        elif m.group(2):
+            inner = stack.pop()
+            stack[-1].append(inner)
+        elif m.group(3) is not None:
+            stack[-1].append(re.sub(rb'\\(.)', rb'\1', m.group(3)).decode())
+        elif m.group(4):
+            stack[-1][-1] = stack[-1][-1] + m.group(4).decode() if stack[-1] else m.group(4).decode()
+        elif m.group(5):
+            stack[-1].append(m.group(5).decode())
+    return stack[0]
+
+
+def quote(s: str | None) -> str:
+    if s is None:
+        return "NIL"
+    return '"' + s.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def parse_set(spec: str, maximum: int) -> set[int]:
+    result: set[int] = set()
+    for part in spec.split(","):
+        if ":" in part:
+            a, b = part.split(":")
+            a = maximum if a == "*" else int(a)
+            b = maximum if b == "*" else int(b)
+            lo, hi = min(a, b), max(a, b)
+            if hi - lo > 5_000_000:
+                raise ValueError("range too large")
+            result.update(range(lo, hi + 1))
+        else:
+            result.add(maximum if part == "*" else int(part))
+    return result
+
+
+def imap_date(s: str) -> dt.date:
+    return dt.datetime.strptime(s, "%d-%b-%Y").date()
+
+
+def header_date(msg: FakeMessage) -> dt.date:
+    try:
+        return parsedate_to_datetime(str(msg.parsed["Date"])).date()
+    except Exception:
+        return msg.internaldate.date()
+
+
+def body_structure(part) -> str:
+    """Render an email.message part as an IMAP BODYSTRUCTURE."""
+    if part.is_multipart():
+        children = "".join(body_structure(p) for p in part.iter_parts())
+        boundary = part.get_param("boundary")
+        return f'({children} {quote(part.get_content_subtype().upper())} ("BOUNDARY" {quote(boundary)}) NIL NIL)'
+    maintype, subtype = part.get_content_maintype().upper(), part.get_content_subtype().upper()
+    params = [f'{quote(k.upper())} {quote(v)}' for k, v in part.get_params()[1:]] if part.get_params() else []
+    params_s = f"({' '.join(params)})" if params else "NIL"
+    encoding = (part.get("Content-Transfer-Encoding") or "7BIT").upper()
+    payload = part.get_payload(decode=False)
+    if isinstance(payload, list):
+        payload = ""
+    payload_bytes = payload.encode("utf-8", "surrogateescape") if isinstance(payload, str) else payload
+    size = len(payload_bytes)
+    disposition = part.get_content_disposition()
+    dispo_s = "NIL"
+    if disposition:
+        filename = part.get_filename()
+        dispo_s = f'({quote(disposition.upper())} {"(" + quote("FILENAME") + " " + quote(filename) + ")" if filename else "NIL"})'
+    base = f'{quote(maintype)} {quote(subtype)} {params_s} NIL NIL {quote(encoding)} {size}'
+    if maintype == "TEXT":
+        base += " " + str(payload_bytes.count(b"\n") + 1)
+    return f"({base} NIL {dispo_s} NIL NIL)"
+
+
+def message_section(msg: FakeMessage, section: str) -> bytes:
+    """Return the bytes of BODY[section] for a message."""
+    raw = msg.raw
+    if section == "":
+        return raw
+    head, sep, body = raw.partition(b"\r\n\r\n")
+    if not sep:
+        head, sep, body = raw.partition(b"\n\n")
+    if section == "HEADER":
+        return head + sep
+    if section == "TEXT":
+        return body
+    m = re.match(r"HEADER\.FIELDS(\.NOT)? \((.*)\)", section, re.I)
+    if m:
+        wanted = {f.lower() for f in m.group(2).split()}
+        lines = re.split(rb"\r?\n(?![ \t])", head)
+        keep = [l for l in lines if (l.split(b":", 1)[0].decode().lower() in wanted) != bool(m.group(1))]
+        return b"\r\n".join(keep) + b"\r\n\r\n"
+    # Numeric part specifier, optionally ending in .MIME / .HEADER / .TEXT
+    tail = None
+    numbers = section.split(".")
+    if numbers[-1].upper() in ("MIME", "HEADER", "TEXT"):
+        tail = numbers.pop().upper()
+    part = msg.parsed
+    for n in numbers:
+        idx = int(n) - 1
+        if part.is_multipart():
+            part = list(part.iter_parts())[idx]
+        elif idx != 0:
+            return b""
+    if tail in ("MIME", "HEADER"):
+        return b"".join(f"{k}: {v}\r\n".encode() for k, v in part.items()) + b"\r\n"
+    payload = part.get_payload(decode=False)
+    if isinstance(payload, list):
+        return part.as_bytes().partition(b"\n\n")[2]
+    return payload.encode("utf-8", "surrogateescape") if isinstance(payload, str) else payload
+
+
+# --------------------------------------------------------------------------- #
+# IMAP server
+# --------------------------------------------------------------------------- #
+
+class FakeIMAPServer:
+    def __init__(self, store: FakeMailStore, host: str = "127.0.0.1", port: int = 0,
+                 tls: ssl.SSLContext | None = None, latency: float = 0.0, user: str = USER):
+        self.store = store
+        self.host, self.port = host, port
+        self.tls = tls
+        self.user = user             # login accepted (with PASSWORD), to stand in for another account
+        self.latency = latency       # simulated per-command round trip
+        self.commands: list[str] = []  # command names seen, for round-trip accounting
+        self.bytes_sent = 0
+        self.connections = 0
+        self._server = None
+
+    async def __aenter__(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, ssl=self.tls)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *exc):
+        self._server.close()
+        await self._server.wait_closed()
+
+    def capabilities(self) -> str:
+        caps = "IMAP4rev1 LITERAL+ IDLE MOVE UIDPLUS CONDSTORE QRESYNC ENABLE SPECIAL-USE LIST-STATUS"
+        if self.store.gmail:
+            caps += " X-GM-EXT-1"
+        return caps
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        session = _Session(self, reader, writer)
+        try:
+            await session.run()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self.store._watchers.discard(session.push_queue)
+            writer.close()
+
+
+class _Session:
+    def __init__(self, server: FakeIMAPServer, reader, writer):
+        self.server = server
+        self.store = server.store
+        self.reader, self.writer = reader, writer
+        self.selected: FakeMailbox | None = None
+        self.readonly = False
+        self.push_queue: asyncio.Queue = asyncio.Queue()
+        self.authenticated = False
+
+    def send(self, data: bytes | str) -> None:
+        if isinstance(data, str):
+            data = data.encode()
+        self.server.bytes_sent += len(data)
+        self.writer.write(data)
+
+    def line(self, text: str) -> None:
+        self.send(text + "\r\n")
+
+    async def read_command(self) -> bytes | None:
+        line = await self.reader.readline()
+        if not line:
+            return None
+        data = line.rstrip(b"\r\n")
+        # Collect literals: "... {123}" / "{123+}"
+        while True:
+            m = re.search(rb"\{(\d+)(\+?)\}$", data)
+            if not m:
+                return data
+            if not m.group(2):
+                self.line("+ Ready for literal data")
+                await self.writer.drain()
+            literal = await self.reader.readexactly(int(m.group(1)))
+            rest = (await self.reader.readline()).rstrip(b"\r\n")
+            data = data[:m.start()] + b"\x00LITERAL" + base64.b64encode(literal) + b"\x00" + rest
+
+    async def run(self):
+        self.line("* OK [CAPABILITY " + self.server.capabilities() + "] Fake IMAP ready")
+        await self.writer.drain()
+        while True:
+            data = await self.read_command()
+            if data is None:
+                return
+            if self.server.latency:
+                await asyncio.sleep(self.server.latency)
+            tag, _, rest = data.partition(b" ")
+            cmd, _, args = rest.partition(b" ")
+            name = cmd.decode().upper()
+            if name == "UID":
+                sub, _, args = args.partition(b" ")
+                name = "UID " + sub.decode().upper()
+            self.server.commands.append(name)
+            handler = getattr(self, "cmd_" + name.replace(" ", "_"), None)
+            if handler is None:
+                self.line(f"{tag.decode()} BAD Unknown command {name}")
+            else:
+                try:
+                    result = await handler(tag.decode(), args)
+                    if result == "LOGOUT":
+                        await self.writer.drain()
+                        return
+                except Exception as e:  # keep the connection alive like a real server would
+                    self.line(f"{tag.decode()} BAD {type(e).__name__}: {e}")
+            await self.writer.drain()
+
+    # -- any state ----------------------------------------------------------
+
+    async def cmd_CAPABILITY(self, tag, args):
+        self.line("* CAPABILITY " + self.server.capabilities())
+        self.line(f"{tag} OK CAPABILITY completed")
+
+    async def cmd_NOOP(self, tag, args):
+        self.line(f"{tag} OK NOOP completed")
+
+    async def cmd_LOGOUT(self, tag, args):
+        self.line("* BYE Logging out")
+        self.line(f"{tag} OK LOGOUT completed")
+        return "LOGOUT"
+
+    async def cmd_LOGIN(self, tag, args):
+        user, password = tokenize(args)[:2]
+        if user == self.server.user and password == PASSWORD:
+            self.authenticated = True
+            self.line(f"{tag} OK [CAPABILITY {self.server.capabilities()}] Logged in")
+        else:
+            self.line(f"{tag} NO [AUTHENTICATIONFAILED] Invalid credentials")
+
+    async def cmd_ENABLE(self, tag, args):
+        self.line("* ENABLED " + args.decode())
+        self.line(f"{tag} OK ENABLE completed")
+
+    async def cmd_ID(self, tag, args):
+        self.line('* ID ("name" "fake-imap")')
+        self.line(f"{tag} OK ID completed")
+
+    # -- authenticated -------------------------------------------------------
+
+    def _mailbox(self, name: str) -> FakeMailbox | None:
+        if name.upper() == "INBOX":
+            name = "INBOX"
+        return self.store.mailboxes.get(name)
+
+    async def cmd_LIST(self, tag, args):
+        ref, pattern = tokenize(args)[:2]
+        regex = re.compile("^" + re.escape(pattern).replace(r"\*", ".*").replace("%", "[^/]*") + "$")
+        for box in self.store.mailboxes.values():
+            if regex.match(box.name):
+                attrs = "\\HasNoChildren" + (" " + box.attributes if box.attributes else "")
+                self.line(f'* LIST ({attrs}) "/" {quote(box.name)}')
+        self.line(f"{tag} OK LIST completed")
+
+    async def cmd_STATUS(self, tag, args):
+        name, items = tokenize(args)[:2]
+        box = self._mailbox(name)
+        if box is None:
+            self.line(f"{tag} NO Mailbox does not exist")
+            return
+        values = {
+            "MESSAGES": len(box.messages), "UIDNEXT": box.uidnext, "UIDVALIDITY": box.uidvalidity,
+            "UNSEEN": sum(1 for m in box.messages if "\\Seen" not in m.flags),
+            "HIGHESTMODSEQ": box.highestmodseq, "RECENT": 0,
+        }
+        out = " ".join(f"{item.upper()} {values[item.upper()]}" for item in items)
+        self.line(f"* STATUS {quote(box.name)} ({out})")
+        self.line(f"{tag} OK STATUS completed")
+
+    async def _select(self, tag, args, readonly):
+        tokens = tokenize(args)
+        box = self._mailbox(tokens[0])
+        if box is None:
+            self.selected = None
+            self.line(f"{tag} NO Mailbox does not exist")
+            return
+        self.selected, self.readonly = box, readonly
+        self.line("* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)")
+        self.line(f"* {len(box.messages)} EXISTS")
+        self.line("* 0 RECENT")
+        self.line(f"* OK [UIDVALIDITY {box.uidvalidity}] UIDs valid")
+        self.line(f"* OK [UIDNEXT {box.uidnext}] Predicted next UID")
+        if "CONDSTORE" in self.server.capabilities():
+            self.line(f"* OK [HIGHESTMODSEQ {box.highestmodseq}] Highest")
+        mode = "READ-ONLY" if readonly else "READ-WRITE"
+        self.line(f"{tag} OK [{mode}] {'EXAMINE' if readonly else 'SELECT'} completed")
+
+    async def cmd_SELECT(self, tag, args):
+        await self._select(tag, args, False)
+
+    async def cmd_EXAMINE(self, tag, args):
+        await self._select(tag, args, True)
+
+    async def cmd_CLOSE(self, tag, args):
+        self.selected = None
+        self.line(f"{tag} OK CLOSE completed")
+
+    async def cmd_CREATE(self, tag, args):
+        name = tokenize(args)[0]
+        self.store.create(name)
+        self.line(f"{tag} OK CREATE completed")
+
+    async def cmd_APPEND(self, tag, args):
+        m = re.match(rb'(.*?)\x00LITERAL([A-Za-z0-9+/=]*)\x00', args, re.S)
+        literal = base64.b64decode(m.group(2))
+        tokens = tokenize(m.group(1))
+        box = self._mailbox(tokens[0])
+        if box is None:
+            self.line(f"{tag} NO [TRYCREATE] Mailbox does not exist")
+            return
+        flags = set(tokens[1]) if len(tokens) > 1 and isinstance(tokens[1], list) else set()
+        msg = self.store.add(box.name, literal, flags=flags)
+        self.line(f"{tag} OK [APPENDUID {box.uidvalidity} {msg.uid}] APPEND completed")
+
+    async def cmd_IDLE(self, tag, args):
+        self.store._watchers.add(self.push_queue)
+        self.line("+ idling")
+        await self.writer.drain()
+        done = asyncio.ensure_future(self.reader.readline())
+        try:
+            while True:
+                get = asyncio.ensure_future(self.push_queue.get())
+                finished, _ = await asyncio.wait({done, get}, return_when=asyncio.FIRST_COMPLETED)
+                if get in finished:
+                    mailbox, line = get.result()
+                    if self.selected is not None and mailbox == self.selected.name:
+                        self.line(f"* {line}")
+                        await self.writer.drain()
+                else:
+                    get.cancel()
+                    break
+        finally:
+            self.store._watchers.discard(self.push_queue)
+        self.line(f"{tag} OK IDLE terminated")
+
+    # -- selected ------------------------------------------------------------
+
+    def _targets(self, spec: str, by_uid: bool) -> list[tuple[int, FakeMessage]]:
+        box = self.selected
+        msgs = box.messages
+        if by_uid:
+            max_uid = msgs[-1].uid if msgs else 0
+            if spec.endswith(":*") and msgs:
+                # "n:*" always includes the highest UID even when n > max
+                lo = int(spec.split(":")[0]) if spec.split(":")[0] != "*" else max_uid
+                return [(i + 1, m) for i, m in enumerate(msgs) if m.uid >= lo] or [(len(msgs), msgs[-1])]
+            wanted = parse_set(spec, max_uid)
+            return [(i + 1, m) for i, m in enumerate(msgs) if m.uid in wanted]
+        wanted = parse_set(spec, len(msgs))
+        return [(i, msgs[i - 1]) for i in sorted(wanted) if 1 <= i <= len(msgs)]
+
+    async def cmd_SEARCH(self, tag, args, by_uid=False):
+        tokens = tokenize(args)
+        if tokens and str(tokens[0]).upper() == "CHARSET":
+            tokens = tokens[2:]
+        box = self.selected
+        hits = []
+        for seq, msg in enumerate(box.messages, 1):
+            if _matches(list(tokens), msg, seq, box):
+                hits.append(msg.uid if by_uid else seq)
+        self.line("* SEARCH" + "".join(f" {h}" for h in hits))
+        self.line(f"{tag} OK SEARCH completed")
+
+    async def cmd_UID_SEARCH(self, tag, args):
+        await self.cmd_SEARCH(tag, args, by_uid=True)
+
+    async def cmd_FETCH(self, tag, args, by_uid=False):
+        tokens = tokenize(args)
+        spec, items = tokens[0], tokens[1]
+        items = items if isinstance(items, list) else [items]
+        changedsince = None
+        vanished = False
+        if len(tokens) > 2 and isinstance(tokens[2], list):
+            mods = [str(t).upper() for t in tokens[2]]
+            if "CHANGEDSINCE" in mods:
+                changedsince = int(mods[mods.index("CHANGEDSINCE") + 1])
+            vanished = "VANISHED" in mods
+        macros = {"ALL": ["FLAGS", "INTERNALDATE", "RFC822.SIZE"], "FAST": ["FLAGS", "INTERNALDATE", "RFC822.SIZE"],
+                  "FULL": ["FLAGS", "INTERNALDATE", "RFC822.SIZE", "BODY"]}
+        expanded = []
+        for item in items:
+            expanded.extend(macros.get(str(item).upper(), [item]))
+        if by_uid and "UID" not in [str(i).upper() for i in expanded]:
+            expanded.insert(0, "UID")
+        if changedsince is not None and "MODSEQ" not in [str(i).upper() for i in expanded]:
+            expanded.append("MODSEQ")
+        if vanished and by_uid and changedsince is not None:
+            # We do not keep tombstones; report UIDs in the requested range that no longer exist.
+            existing = {m.uid for m in self.selected.messages}
+            max_uid = self.selected.uidnext - 1
+            asked = parse_set(spec.replace("*", str(max_uid)), max_uid) if max_uid else set()
+            gone = sorted(asked - existing)
+            if gone:
+                self.line("* VANISHED (EARLIER) " + compress(gone))
+        for seq, msg in self._targets(spec, by_uid):
+            if changedsince is not None and msg.modseq <= changedsince:
+                continue
+            self._send_fetch(seq, msg, expanded)
+            # Drain periodically so huge fetches don't buffer everything in memory
+            if self.writer.transport.get_write_buffer_size() > 1 << 20:
+                await self.writer.drain()
+        self.line(f"{tag} OK FETCH completed")
+
+    async def cmd_UID_FETCH(self, tag, args):
+        await self.cmd_FETCH(tag, args, by_uid=True)
+
+    def _send_fetch(self, seq: int, msg: FakeMessage, items: list) -> None:
+        parts: list[bytes] = []
+        set_seen = False
+        for item in items:
+            name = str(item).upper()
+            if name == "UID":
+                parts.append(f"UID {msg.uid}".encode())
+            elif name == "FLAGS":
+                parts.append(f"FLAGS ({' '.join(sorted(msg.flags))})".encode())
+            elif name == "RFC822.SIZE":
+                parts.append(f"RFC822.SIZE {len(msg.raw)}".encode())
+            elif name == "INTERNALDATE":
+                parts.append(f'INTERNALDATE "{msg.internaldate.strftime("%d-%b-%Y %H:%M:%S %z")}"'.encode())
+            elif name == "MODSEQ":
+                parts.append(f"MODSEQ ({msg.modseq})".encode())
+            elif name == "X-GM-MSGID":
+                parts.append(f"X-GM-MSGID {msg.gm_msgid}".encode())
+            elif name == "X-GM-THRID":
+                parts.append(f"X-GM-THRID {msg.gm_thrid}".encode())
+            elif name == "X-GM-LABELS":
+                parts.append(f"X-GM-LABELS ({' '.join(quote(l) for l in sorted(msg.labels))})".encode())
+            elif name in ("BODYSTRUCTURE", "BODY"):
+                parts.append(f"{name} {body_structure(msg.parsed)}".encode())
+            elif name in ("RFC822", "RFC822.HEADER", "RFC822.TEXT"):
+                section = {"RFC822": "", "RFC822.HEADER": "HEADER", "RFC822.TEXT": "TEXT"}[name]
+                data = message_section(msg, section)
+                parts.append(f"{name} {{{len(data)}}}\r\n".encode() + data)
+                set_seen = set_seen or name != "RFC822.HEADER"
+            elif name.startswith("BODY[") or name.startswith("BODY.PEEK["):
+                m = re.match(r"BODY(\.PEEK)?\[(.*)\](?:<(\d+)\.(\d+)>)?$", str(item), re.I)
+                section = m.group(2)
+                data = message_section(msg, section)
+                label = f"BODY[{section}]"
+                if m.group(3) is not None:
+                    offset, length = int(m.group(3)), int(m.group(4))
+                    data = data[offset:offset + length]
+                    label += f"<{offset}>"
+                parts.append(f"{label} {{{len(data)}}}\r\n".encode() + data)
+                set_seen = set_seen or not m.group(1)
+        if set_seen and not self.readonly and "\\Seen" not in msg.flags:
+            msg.flags.add("\\Seen")
+            self.store.bump(self.selected, msg)
+            parts.append(f"FLAGS ({' '.join(sorted(msg.flags))})".encode())
+        self.send(f"* {seq} FETCH (".encode() + b" ".join(parts) + b")\r\n")
+
+    async def cmd_STORE(self, tag, args, by_uid=False):
+        tokens = tokenize(args)
+        spec, action = tokens[0], str(tokens[1]).upper()
+        if isinstance(tokens[1], list):   # (UNCHANGEDSINCE n)
+            action = str(tokens[2]).upper()
+            values = tokens[3]
+        else:
+            values = tokens[2]
+        values = set(values if isinstance(values, list) else [values])
+        silent = action.endswith(".SILENT")
+        action = action.removesuffix(".SILENT")
+        for seq, msg in self._targets(spec, by_uid):
+            target = msg.labels if action.startswith("X-GM-LABELS") or action[1:].startswith("X-GM-LABELS") else msg.flags
+            if action.startswith("+"):
+                target |= values
+            elif action.startswith("-"):
+                target -= values
+            else:
+                target.clear()
+                target |= values
+            self.store.bump(self.selected, msg)
+            if not silent:
+                uid = f"UID {msg.uid} " if by_uid else ""
+                self.line(f"* {seq} FETCH ({uid}FLAGS ({' '.join(sorted(msg.flags))}) MODSEQ ({msg.modseq}))")
+            self.store.notify(self.selected.name, f"{seq} FETCH (FLAGS ({' '.join(sorted(msg.flags))}))")
+        self.line(f"{tag} OK STORE completed")
+
+    async def cmd_UID_STORE(self, tag, args):
+        await self.cmd_STORE(tag, args, by_uid=True)
+
+    def _expunge(self, only_uids: set[int] | None = None) -> None:
+        box = self.selected
+        keep = []
+        seq = 0
+        for msg in box.messages:
+            seq += 1
+            if "\\Deleted" in msg.flags and (only_uids is None or msg.uid in only_uids):
+                self.line(f"* {seq} EXPUNGE")
+                self.store.notify(box.name, f"{seq} EXPUNGE")
+                seq -= 1
+            else:
+                keep.append(msg)
+        box.messages = keep
+        box.highestmodseq += 1
+
+    async def cmd_EXPUNGE(self, tag, args):
+        self._expunge()
+        self.line(f"{tag} OK EXPUNGE completed")
+
+    async def cmd_UID_EXPUNGE(self, tag, args):
+        spec = tokenize(args)[0]
+        self._expunge({m.uid for _, m in self._targets(spec, True)})
+        self.line(f"{tag} OK UID EXPUNGE completed")
+
+    async def cmd_COPY(self, tag, args, by_uid=False, move=False):
+        spec, dest = tokenize(args)[:2]
+        target = self._mailbox(dest)
+        if target is None:
+            self.line(f"{tag} NO [TRYCREATE] Mailbox does not exist")
+            return
+        src_uids, dst_uids = [], []
+        for seq, msg in self._targets(spec, by_uid):
+            copy = self.store.add(target.name, msg.raw, flags=set(msg.flags), internaldate=msg.internaldate)
+            copy.gm_thrid = msg.gm_thrid
+            src_uids.append(msg.uid)
+            dst_uids.append(copy.uid)
+        code = f"[COPYUID {target.uidvalidity} {compress(src_uids)} {compress(dst_uids)}] " if src_uids else ""
+        if move:
+            for msg in self.selected.messages:
+                if msg.uid in src_uids:
+                    msg.flags.add("\\Deleted")
+            self.line(f"* OK {code}Moved")
+            self._expunge(set(src_uids))
+            self.line(f"{tag} OK MOVE completed")
+        else:
+            self.line(f"{tag} OK {code}COPY completed")
+
+    async def cmd_UID_COPY(self, tag, args):
+        await self.cmd_COPY(tag, args, by_uid=True)
+
+    async def cmd_MOVE(self, tag, args):
+        await self.cmd_COPY(tag, args, move=True)
+
+    async def cmd_UID_MOVE(self, tag, args):
+        await self.cmd_COPY(tag, args, by_uid=True, move=True)
+
+
+def compress(uids: list[int]) -> str:
+    uids = sorted(uids)
+    out, start, prev = [], None, None
+    for u in uids:
+        if start is None:
+            start = prev = u
+        elif u == prev + 1:
+            prev = u
+        else:
+            out.append(f"{start}:{prev}" if start != prev else str(start))
+            start = prev = u
+    if start is not None:
+        out.append(f"{start}:{prev}" if start != prev else str(start))
+    return ",".join(out)
+
+
+def _matches(tokens: list, msg: FakeMessage, seq: int, box: FakeMailbox) -> bool:
+    """Evaluate (consume) a SEARCH key list against one message."""
+    result = True
+    while tokens:
+        # Always evaluate, so every key consumes its arguments
+        result = _match_one(tokens, msg, seq, box) and result
+    return result
+
+
+def _match_one(tokens: list, msg: FakeMessage, seq: int, box: FakeMailbox) -> bool:
+    key = tokens.pop(0)
+    if isinstance(key, list):
+        return _matches(list(key), msg, seq, box)
+    k = key.upper()
+    header = lambda name: str(msg.parsed.get(name, "")).lower()
+    if k == "ALL":
+        return True
+    if k == "NOT":
+        return not _match_one(tokens, msg, seq, box)
+    if k == "OR":
+        a = _match_one(tokens, msg, seq, box)
+        b = _match_one(tokens, msg, seq, box)
+        return a or b
+    if k in ("FROM", "TO", "CC", "BCC", "SUBJECT"):
+        return tokens.pop(0).lower() in header(k)
+    if k == "HEADER":
+        name, value = tokens.pop(0), tokens.pop(0)
+        return value.lower() in header(name)
+    if k in ("BODY", "TEXT", "X-GM-RAW"):
+        needle = tokens.pop(0).lower()
+        return needle in msg.raw.decode("utf-8", "ignore").lower()
+    flag_keys = {"SEEN": "\\Seen", "FLAGGED": "\\Flagged", "ANSWERED": "\\Answered",
+                 "DELETED": "\\Deleted", "DRAFT": "\\Draft"}
+    if k in flag_keys:
+        return flag_keys[k] in msg.flags
+    if k.startswith("UN") and k[2:] in flag_keys:
+        return flag_keys[k[2:]] not in msg.flags
+    if k == "KEYWORD":
+        return tokens.pop(0) in msg.flags
+    if k == "LARGER":
+        return len(msg.raw) > int(tokens.pop(0))
+    if k == "SMALLER":
+        return len(msg.raw) < int(tokens.pop(0))
+    if k == "SINCE":
+        return msg.internaldate.date() >= imap_date(tokens.pop(0))
+    if k == "BEFORE":
+        return msg.internaldate.date() < imap_date(tokens.pop(0))
+    if k == "ON":
+        return msg.internaldate.date() == imap_date(tokens.pop(0))
+    if k == "SENTSINCE":
+        return header_date(msg) >= imap_date(tokens.pop(0))
+    if k == "SENTBEFORE":
+        return header_date(msg) < imap_date(tokens.pop(0))
+    if k == "MODSEQ":
+        return msg.modseq >= int(tokens.pop(0))
+    if k == "UID":
+        spec = tokens.pop(0)
+        return msg.uid in parse_set(spec, box.messages[-1].uid if box.messages else 0)
+    if k == "X-GM-THRID":
+        return msg.gm_thrid == int(tokens.pop(0))
+    if re.match(r"^[\d*:,]+$", k):
+        return seq in parse_set(k, len(box.messages))
+    raise ValueError(f"unsupported search key {key}")
+
+
+# --------------------------------------------------------------------------- #
+# SMTP server
+# --------------------------------------------------------------------------- #
+
+class FakeSMTPServer:
+    """
+    ESMTP with AUTH PLAIN/LOGIN and PIPELINING; delivered mail goes to store.sent (and INBOX for USER).
+
+    With `implicit_tls=False` the TLS context is offered via STARTTLS instead,
+    which is what the tools expect on any port other than 465. Like many
+    providers it can cap the messages per connection (`max_per_connection`),
+    answering 421 and hanging up once the cap is reached.
+    """
+
+    def __init__(self, store: FakeMailStore, host: str = "127.0.0.1", port: int = 0,
+                 tls: ssl.SSLContext | None = None, latency: float = 0.0, implicit_tls: bool = False,
+                 max_per_connection: int | None = None):
+        self.store = store
+        self.max_per_connection = max_per_connection
+        self.host, self.port = host, port
+        self.tls = tls
+        self.implicit_tls = implicit_tls
+        self.latency = latency
+        self.commands: list[str] = []
+        self.connections = 0
+        self._server = None
+
+    async def __aenter__(self):
+        ssl_ctx = self.tls if self.implicit_tls else None
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, ssl=ssl_ctx)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *exc):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        offer_starttls = self.tls is not None and not self.implicit_tls
+
+        def reply(text: str):
+            writer.write((text + "\r\n").encode())
+
+        reply("220 fake-smtp ESMTP ready")
+        await writer.drain()
+        mail_from, rcpts, authed = None, [], False
+        delivered = 0
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                text = line.decode().rstrip("\r\n")
+                verb = text.split(" ", 1)[0].upper()
+                self.commands.append(verb)
+                if self.latency and not reader._buffer:   # one delay per client round trip
+                    await asyncio.sleep(self.latency)
+                if verb in ("EHLO", "HELO"):
+                    starttls = b"250-STARTTLS\r\n" if offer_starttls else b""
+                    writer.write(b"250-fake-smtp\r\n250-PIPELINING\r\n250-8BITMIME\r\n250-SIZE 35882577\r\n"
+                                 + starttls + b"250 AUTH PLAIN LOGIN\r\n")
+                elif verb == "STARTTLS" and offer_starttls:
+                    reply("220 2.0.0 Ready to start TLS")
+                    await writer.drain()
+                    await writer.start_tls(self.tls)
+                    offer_starttls = False
+                elif verb == "AUTH":
+                    parts = text.split()
+                    if parts[1].upper() == "PLAIN":
+                        blob = parts[2] if len(parts) > 2 else None
+                        if blob is None:
+                            reply("334 ")
+                            await writer.drain()
+                            blob = (await reader.readline()).decode().strip()
+                        _, user, password = base64.b64decode(blob).decode().split("\x00")
+                    else:
+                        reply("334 VXNlcm5hbWU6")
+                        await writer.drain()
+                        user = base64.b64decode((await reader.readline()).strip()).decode()
+                        reply("334 UGFzc3dvcmQ6")
+                        await writer.drain()
+                        password = base64.b64decode((await reader.readline()).strip()).decode()
+                    authed = user == USER and password == PASSWORD
+                    reply("235 2.7.0 Authentication successful" if authed else "535 5.7.8 Bad credentials")
+                elif verb == "MAIL":
+                    if self.max_per_connection is not None and delivered >= self.max_per_connection:
+                        reply("421 4.7.0 Too many messages for this session, closing connection")
+                        await writer.drain()
+                        return
+                    if not authed:
+                        reply("530 5.7.0 Authentication required")
+                    else:
+                        mail_from, rcpts = re.search(r"<(.*?)>", text).group(1), []
+                        reply("250 2.1.0 OK")
+                elif verb == "RCPT":
+                    rcpts.append(re.search(r"<(.*?)>", text).group(1))
+                    reply("250 2.1.5 OK")
+                elif verb == "DATA":
+                    reply("354 Go ahead")
+                    await writer.drain()
+                    chunks = []
+                    while True:
+                        data_line = await reader.readline()
+                        if data_line in (b".\r\n", b".\n"):
+                            break
+                        if data_line.startswith(b".."):
+                            data_line = data_line[1:]
+                        chunks.append(data_line)
+                    raw = b"".join(chunks)
+                    self.store.sent.append((mail_from, rcpts, raw))
+                    if self.store.gmail:
+                        # Gmail files submitted mail into Sent Mail on its own
+                        self.store.add("[Gmail]/Sent Mail", raw, flags={"\\Seen"})
+                    if USER in rcpts:
+                        self.store.add("INBOX", raw)
+                    reply(f"250 2.0.0 OK queued as {len(self.store.sent)}")
+                    delivered += 1
+                    mail_from, rcpts = None, []
+                elif verb == "RSET":
+                    mail_from, rcpts = None, []
+                    reply("250 2.0.0 OK")
+                elif verb == "NOOP":
+                    reply("250 2.0.0 OK")
+                elif verb == "QUIT":
+                    reply("221 2.0.0 Bye")
+                    await writer.drain()
+                    return
+                else:
+                    reply("502 5.5.2 Command not implemented")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,178 @@
+"""
+Cold start benchmark: how long a new server process takes to answer, the
+way MCP hosts start one per session over stdio.
+
+    python benchmarks/startup.py                  # checked against startup_budget.json
+    python benchmarks/startup.py --runs 10 --json startup.json
+    python benchmarks/startup.py --importtime     # where the import time goes
+
+Each run uses a fresh interpreter; the medians are reported:
+
+  fastmcp_ms         importing fastmcp, the floor any FastMCP server pays
+  import_ms          importing src.server (fastmcp included)
+  own_ms             import_ms - fastmcp_ms: our modules and tool registration
+  first_response_ms  from spawning `python src/server.py` to its answer to
+                     tools/list (initialize first), over stdio
+
+Importing the server must also leave the configuration unread and the
+DEFERRED modules unimported; they load on first use. Exit code 1 when a
+budget is exceeded or either check fails.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+BUDGET_FILE = Path(__file__).resolve().parent / "startup_budget.json"
+
+# Only needed once a tool talks to a server or converts HTML
+DEFERRED = ("aioimaplib", "aiosmtplib", "bs4", "soupsieve", "selectolax", "lxml", "opentelemetry.sdk")
+
+PROBE = f"""
+import json, sys, time
+start = time.perf_counter()
+from fastmcp import FastMCP
+middle = time.perf_counter()
+import src.server
+end = time.perf_counter()
+from src.config import config
+print(json.dumps({{
+    "fastmcp_ms": (middle - start) * 1000,
+    "import_ms": (end - start) * 1000,
+    "config_loaded": getattr(config, "loaded", True),  # True before the config was lazy
+    "deferred_loaded": [m for m in {DEFERRED!r} if m in sys.modules],
+}}))
+"""
+
+
+def environment() -> dict:
+    # Keep the runs away from the real cache directory
+    return dict(os.environ, CACHE_DIR=tempfile.mkdtemp(prefix="email-mcp-startup-"), PYTHONUNBUFFERED="1")
+
+
+def probe_import(env: dict) -> dict:
+    out = subprocess.run([sys.executable, "-c", PROBE], cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def first_response(env: dict, timeout: float = 60) -> float:
+    """Milliseconds from spawning the server until tools/list is answered."""
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "src/server.py"], cwd=ROOT, env=env, text=True,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def send(message: dict) -> None:
+        process.stdin.write(json.dumps(message) + "\n")
+        process.stdin.flush()
+
+    def answer(request_id: int) -> dict:
+        while time.perf_counter() - start < timeout:
+            line = process.stdout.readline()
+            if not line:
+                raise RuntimeError("server exited before answering")
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            if message.get("id") == request_id:
+                return message
+        raise TimeoutError(f"no answer within {timeout}s")
+
+    try:
+        send({"jsonrpc": "2.0", "id": 1, "method": "initialize",
+              "params": {"protocolVersion": "2025-06-18", "capabilities": {},
+                         "clientInfo": {"name": "startup-bench", "version": "1"}}})
+        answer(1)
+        send({"jsonrpc": "2.0", "method": "notifications/initialized"})
+        send({"jsonrpc": "2.0", "id": 2, "method": "tools/list"})
+        tools = answer(2)["result"]["tools"]
+        elapsed = (time.perf_counter() - start) * 1000
+        if not tools:
+            raise RuntimeError("tools/list came back empty")
+        return elapsed
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def importtime(code: str, env: dict) -> dict[str, int]:
+    """Self time (us) per module, from python -X importtime."""
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=ROOT, env=env,
+                         capture_output=True, text=True, check=True)
+    times = {}
+    for line in out.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            self_us, _, name = line[len("import time:"):].split("|")
+            if self_us.strip().isdigit():
+                times[name.strip()] = int(self_us)
+    return times
+
+
+def print_importtime(env: dict, top: int) -> None:
+    """The modules importing the server adds on top of fastmcp, grouped by package."""
+    floor = importtime("from fastmcp import FastMCP", env)
+    server = importtime("import src.server", env)
+    packages: dict[str, int] = {}
+    for name, self_us in server.items():
+        if name not in floor:
+            package = name.split(".")[0]
+            packages[package] = packages.get(package, 0) + self_us
+    print(f"\nImported on top of fastmcp ({sum(packages.values()) / 1000:.1f} ms self time):")
+    for package, self_us in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+        print(f"  {self_us / 1000:>8.1f} ms  {package}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes per measurement")
+    parser.add_argument("--budget", default=str(BUDGET_FILE), help="JSON file of {metric: max ms}")
+    parser.add_argument("--no-stdio", action="store_true", help="skip the first_response measurement")
+    parser.add_argument("--importtime", action="store_true", help="also list the slowest imports")
+    parser.add_argument("--top", type=int, default=15, help="packages listed by --importtime")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    env = environment()
+    probes = [probe_import(env) for _ in range(args.runs)]
+    results = {key: round(statistics.median(p[key] for p in probes), 1) for key in ("fastmcp_ms", "import_ms")}
+    results["own_ms"] = round(statistics.median(p["import_ms"] - p["fastmcp_ms"] for p in probes), 1)
+    if not args.no_stdio:
+        results["first_response_ms"] = round(statistics.median(first_response(env) for _ in range(args.runs)), 1)
+
+    budget = json.loads(Path(args.budget).read_text()) if args.budget and Path(args.budget).exists() else {}
+    failed = False
+    print(f"{'metric':<20}{'median':>10}{'budget':>10}")
+    for key, value in results.items():
+        limit = budget.get(key)
+        over = limit is not None and value > limit
+        failed |= over
+        print(f"{key:<20}{value:>10}{limit if limit is not None else '-':>10}{'  OVER BUDGET' if over else ''}")
+
+    config_loaded = any(p["config_loaded"] for p in probes)
+    deferred = sorted({m for p in probes for m in p["deferred_loaded"]})
+    if config_loaded:
+        print("Importing the server read the configuration (it should wait for the first tool call)")
+    if deferred:
+        print(f"Imported at startup but meant to load on first use: {', '.join(deferred)}")
+    failed |= config_loaded or bool(deferred)
+
+    if args.importtime:
+        print_importtime(env, args.top)
+    if args.json:
+        Path(args.json).write_text(json.dumps({"python": sys.version.split()[0], "runs": args.runs,
+                                               "results": results, "config_loaded": config_loaded,
+                                               "deferred_loaded": deferred}, indent=2))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
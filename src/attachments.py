@@ -0,0 +1,165 @@
+import binascii
+import hashlib
+import logging
+import mimetypes
+import re
+import secrets
+from pathlib import Path
+
+try:
+    from src.config import config
+    from src.message_cache import cache_root
+    from src.utils import parse_bodystructure, parse_fetch_response, text_sections
+except ImportError:
+    from config import config
+    from message_cache import cache_root
+    from utils import parse_bodystructure, parse_fetch_response, text_sections
+
+logger = logging.getLogger(__name__)
+
+# Smallest partial FETCH worth a round trip
+MIN_CHUNK_BYTES = 16 * 1024
+UNSAFE_FILENAME_RE = re.compile(r'[\x00-\x1f/\\:*?"<>|]')
+
+
+class Base64Decoder:
+    """base64 decoded as it streams in: whole 4-character groups now, the rest with the next chunk."""
+
+    def __init__(self):
+        self._rest = b""
+
+    def feed(self, data: bytes) -> bytes:
+        data = self._rest + re.sub(rb"[^A-Za-z0-9+/=]", b"", data)
+        cut = len(data) - len(data) % 4
+        self._rest = data[cut:]
+        return binascii.a2b_base64(data[:cut]) if cut else b""
+
+    def flush(self) -> bytes:
+        rest, self._rest = self._rest, b""
+        # A truncated final group; decode what it still holds
+        return binascii.a2b_base64(rest + b"=" * (-len(rest) % 4)) if len(rest) > 1 else b""
+
+
+class QuotedPrintableDecoder:
+    """quoted-printable decoded a complete line at a time (so no =XX escape is ever split)."""
+
+    def __init__(self):
+        self._rest = b""
+
+    def feed(self, data: bytes) -> bytes:
+        data = self._rest + data
+        cut = data.rfind(b"\n") + 1
+        self._rest = data[cut:]
+        return binascii.a2b_qp(data[:cut]) if cut else b""
+
+    def flush(self) -> bytes:
+        rest, self._rest = self._rest, b""
+        return binascii.a2b_qp(rest)
+
+
+class IdentityDecoder:
+    def feed(self, data: bytes) -> bytes:
+        return data
+
+    def flush(self) -> bytes:
+        return b""
+
+
+def decoder_for(encoding: str):
+    if encoding == "base64":
+        return Base64Decoder()
+    if encoding == "quoted-printable":
+        return QuotedPrintableDecoder()
+    return IdentityDecoder()
+
+
+def decoded_size(part: dict) -> int:
+    """Approximate size of a part once its transfer encoding is undone."""
+    if part["encoding"] == "base64":
+        return part["size"] * 57 // 78
+    return part["size"]
+
+
+def attachment_parts(parts: list[dict]) -> list[dict]:
+    """Parts of a flattened BODYSTRUCTURE that are not the body text extract_email_body shows."""
+    body = {p["section"] for p in text_sections(parts)}
+    return [p for p in parts if p["section"] not in body and (
+        p["disposition"] == "attachment" or p["filename"] or p["type"] not in ("text/plain", "text/html"))]
+
+
+async def fetch_parts(client, uid: int) -> list[dict] | None:
+    """Leaf parts of a message in the selected folder (see parse_bodystructure), or None if there is no such UID."""
+    status, data = await client.uid('fetch', str(uid), '(UID BODYSTRUCTURE)')
+    if status != 'OK':
+        raise ConnectionError(f"BODYSTRUCTURE fetch failed: {status}")
+    for record in parse_fetch_response(data):
+        if record.get("UID") == str(uid):
+            return parse_bodystructure(record.get("BODYSTRUCTURE"))
+    return None
+
+
+def safe_filename(part: dict, uid: int) -> str:
+    name = UNSAFE_FILENAME_RE.sub("_", Path(part["filename"] or "").name).strip(" .")
+    if name:
+        return name
+    extension = mimetypes.guess_extension(part["type"]) or ".bin"
+    return f"{uid}-{part['section'].replace('.', '-')}{extension}"
+
+
+def spool_path(folder: str, uidvalidity: int | None, uid: int, part: dict) -> Path:
+    """
+    Where a part is saved: ATTACHMENT_DIR (default <CACHE_DIR>/attachments)
+    in a directory per (account, folder, uidvalidity, uid, part), so saving
+    it again is answered from disk.
+    """
+    root = Path(config.ATTACHMENT_DIR) if config.ATTACHMENT_DIR else cache_root() / 'attachments'
+    key = f"{config.EMAIL_USER}\0{folder}\0{uidvalidity}\0{uid}\0{part['section']}"
+    return root / hashlib.sha1(key.encode()).hexdigest()[:16] / safe_filename(part, uid)
+
+
+def _chunk_data(record: dict, section: str) -> bytes:
+    for key, value in record.items():
+        if isinstance(key, str) and key.startswith(f"BODY[{section}]"):
+            if isinstance(value, str):
+                # Small chunks may come back as a quoted string rather than a literal
+                return b"" if value.upper() == "NIL" else value.encode('latin-1', errors='replace')
+            return bytes(value)
+    return b""
+
+
+async def save_part(client, uid: int, part: dict, path: Path) -> int:
+    """
+    Stream one part of a message in the selected folder to `path`, decoded.
+
+    The part is fetched as BODY.PEEK[section]<offset.length> ranges of
+    ATTACHMENT_CHUNK_BYTES and decoded chunk by chunk, so memory use stays
+    at about one chunk whatever the attachment's size. The file only
+    appears under its name once complete. Returns the bytes written.
+    """
+    section = part["section"]
+    chunk = max(MIN_CHUNK_BYTES, config.ATTACHMENT_CHUNK_BYTES)
+    decoder = decoder_for(part["encoding"])
+    path.parent.mkdir(parents=True, exist_ok=True)
+    spool = path.with_name(f"{path.name}.{secrets.token_hex(4)}.part")
+    offset, written = 0, 0
+    try:
+        with open(spool, 'wb') as out:
+            while True:
+                status, data = await client.uid('fetch', str(uid), f"(UID BODY.PEEK[{section}]<{offset}.{chunk}>)")
+                if status != 'OK':
+                    raise ConnectionError(f"Fetch of part {section} failed: {status}")
+                records = [r for r in parse_fetch_response(data) if r.get("UID") == str(uid)]
+                if not records:
+                    raise ConnectionError(f"Message {uid} disappeared while saving part {section}")
+                piece = _chunk_data(records[0], section)
+                written += out.write(decoder.feed(piece))
+                offset += len(piece)
+                if len(piece) < chunk or (part["size"] and offset >= part["size"]):
+                    break
+            written += out.write(decoder.flush())
+        spool.replace(path)
+    except BaseException:
+        spool.unlink(missing_ok=True)
+        raise
+    logger.info(f"Saved part {section} of message {uid} ({written} bytes, {offset} fetched) to {path}")
+    return written
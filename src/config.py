@@ -1,6 +1,10 @@
 import json
 import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
 
+from pydantic import BaseModel
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pathlib import Path
 from typing import Optional
@@ -9,11 +13,32 @@ from typing import Optional
 BASE_DIR = Path(__file__).resolve().parent.parent
 ENV_FILE = BASE_DIR / '.env'
 CREDENTIALS_FILE = BASE_DIR / 'credentials.json'
+ACCOUNTS_FILE = BASE_DIR / 'accounts.json'
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+DEFAULT_ACCOUNT = "default"
+
+# Settings that belong to a mailbox rather than to the server
+ACCOUNT_FIELDS = frozenset({"SMTP_HOST", "SMTP_PORT", "IMAP_HOST", "IMAP_PORT", "EMAIL_USER", "EMAIL_PASS"})
+
+
+class Account(BaseModel):
+    """One extra mailbox from accounts.json."""
+    SMTP_HOST: Optional[str] = None
+    SMTP_PORT: int = 465
+    IMAP_HOST: Optional[str] = None
+    IMAP_PORT: int = 993
+    EMAIL_USER: Optional[str] = None
+    EMAIL_PASS: Optional[str] = None
+
+
+# (name, account) the current task works on; None = the default account
+_active_account: ContextVar[Optional[tuple[str, Account]]] = ContextVar("active_account", default=None)
+
+
 class EmailConfig(BaseSettings):
     """
     Configuration settings for the Email MCP Server.
@@ -37,6 +62,120 @@ class EmailConfig(BaseSettings):
     # Deployment (Optional, for generating correct links)
     APP_URL: Optional[str] = None
 
+    # IMAP connection pool
+    IMAP_POOL_SIZE: int = 4
+    IMAP_POOL_IDLE_TIMEOUT: float = 300.0  # seconds before an unused session is logged out
+    IMAP_POOL_HEALTHCHECK_INTERVAL: float = 60.0  # NOOP sessions idle longer than this before reuse
+
+    # Seconds the folder list (LIST) is cached for
+    FOLDER_CACHE_TTL: float = 600.0
+
+    # SMTP connection pool
+    SMTP_POOL_SIZE: int = 2
+    SMTP_POOL_IDLE_TIMEOUT: float = 120.0  # providers drop idle SMTP sessions after a few minutes
+
+    # Outbound queue used by send_email
+    OUTBOX_WORKERS: int = 2
+    OUTBOX_MAX_ATTEMPTS: int = 8
+    OUTBOX_RETRY_BASE_SECONDS: float = 30.0  # doubled after every failed attempt
+    OUTBOX_RETRY_MAX_SECONDS: float = 3600.0
+    OUTBOX_RATE_PER_MINUTE: int = 0  # provider sending quota, 0 = unlimited
+    OUTBOX_RETENTION_DAYS: float = 30.0  # finished entries (and their idempotency keys) kept this long
+    SAVE_TO_SENT: str = "auto"  # auto (skip on Gmail, which files sent mail itself), always, never
+
+    # Seconds a folder's header index is trusted without a SELECT (0 = always check;
+    # folders watched with IDLE are always current)
+    HEADER_INDEX_MAX_AGE: float = 0.0
+
+    # Max messages per batched FETCH command
+    IMAP_FETCH_BATCH_SIZE: int = 200
+
+    # Longer bodies are cut off with a marker (0 = no limit)
+    BODY_MAX_BYTES: int = 512 * 1024
+
+    # Local cache (defaults to <project>/.cache)
+    CACHE_DIR: Optional[str] = None
+    MESSAGE_CACHE_ENABLED: bool = True
+    MESSAGE_CACHE_MAX_MB: int = 256
+
+    # IMAP IDLE change watcher
+    IDLE_ENABLED: bool = True
+    IDLE_FOLDERS: str = "INBOX"  # comma separated, e.g. "INBOX,Sent"
+    IDLE_RENEW_SECONDS: int = 1500  # re-issue IDLE before the server's 30 minute cutoff
+    IDLE_PREFETCH_BODIES: bool = False  # also download new messages into the message cache
+
+    # Where MIME parsing and HTML-to-text run: thread, process or inline (on the event loop)
+    PARSE_EXECUTOR: str = "thread"
+    PARSE_WORKERS: int = 0  # 0 = min(4, CPU count)
+    HTML_PARSER: str = "auto"  # auto (selectolax > lxml > html.parser, whichever is installed) or one of those
+
+    # Memoized HTML-to-text results (keyed by a hash of the HTML)
+    TEXT_CACHE_SIZE: int = 256  # entries kept in memory, 0 = off
+    TEXT_CACHE_DISK: bool = False  # also keep them in <CACHE_DIR>/texts.sqlite3 across restarts
+    TEXT_CACHE_DISK_MAX_MB: int = 64
+
+    # save_attachment: where parts are saved (defaults to <CACHE_DIR>/attachments)
+    # and how much is fetched per round trip (bounds memory use per download)
+    ATTACHMENT_DIR: Optional[str] = None
+    ATTACHMENT_CHUNK_BYTES: int = 1024 * 1024
+
+    # Local full-text search over mail the server has seen (SQLite FTS5)
+    SEARCH_INDEX_ENABLED: bool = True
+
+    # Extra accounts ({"name": {"IMAP_HOST": ..., ...}}), defaults to <project>/accounts.json
+    ACCOUNTS_FILE: Optional[str] = None
+    # Max folders queried at the same time by multi-folder/multi-account listings
+    FANOUT_CONCURRENCY: int = 4
+
+    # Instrumentation: Prometheus metrics on GET /metrics of a separate listener (not the setup server)
+    METRICS_ENABLED: bool = True
+    METRICS_HOST: str = "127.0.0.1"  # 0.0.0.0 to let a scraper on another host in
+    METRICS_PORT: int = 9464
+    SLOW_TOOL_LOG_MS: int = 0  # log where the time went for tool calls slower than this, 0 = off
+    OTEL_ENABLED: bool = False  # also emit OpenTelemetry spans (OTLP export needs opentelemetry-sdk + exporter)
+
+    def __getattribute__(self, name):
+        # Inside use_account() the mailbox settings come from that account, so
+        # the pools, caches and indexes (all keyed by these) follow along
+        if name in ACCOUNT_FIELDS:
+            active = _active_account.get()
+            if active is not None:
+                return getattr(active[1], name)
+        return super().__getattribute__(name)
+
+    def load_accounts(self) -> dict[str, Account]:
+        """Extra accounts from ACCOUNTS_FILE (empty if there is none)."""
+        path = Path(self.ACCOUNTS_FILE) if self.ACCOUNTS_FILE else ACCOUNTS_FILE
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        return {name: Account(**settings) for name, settings in data.items() if name != DEFAULT_ACCOUNT}
+
+    def account_names(self) -> list[str]:
+        return [DEFAULT_ACCOUNT, *self.load_accounts()]
+
+    @property
+    def account_name(self) -> str:
+        active = _active_account.get()
+        return active[0] if active else DEFAULT_ACCOUNT
+
+    @contextmanager
+    def use_account(self, name: Optional[str]):
+        """Run the block against another configured account (None/"default" = the main one)."""
+        active = None
+        if name and name != DEFAULT_ACCOUNT:
+            account = self.load_accounts().get(name)
+            if account is None:
+                raise ValueError(f"Unknown account '{name}'")
+            active = (name, account)
+        token = _active_account.set(active)
+        try:
+            yield
+        finally:
+            _active_account.reset(token)
+
     @property
     def is_configured(self) -> bool:
         """Check if essential config is present"""
@@ -84,16 +223,53 @@ class EmailConfig(BaseSettings):
         self.EMAIL_USER = email_user
         self.EMAIL_PASS = email_pass
 
-# Instantiate config
-config = EmailConfig()
-
-# Attempt to load from file if not fully configured via Env
-if not config.is_configured:
-    try:
-        config.load_from_file()
-    except Exception as e:
-        # If it's a critical error like JSONDecodeError, it might have been raised.
-        # We allow it to bubble up to prevent partial/corrupt configuration.
-        logger.error(f"Configuration loading failed: {e}")
-        raise
+def _load_config() -> EmailConfig:
+    settings = EmailConfig()
+
+    # Attempt to load from file if not fully configured via Env
+    if not settings.is_configured:
+        try:
+            settings.load_from_file()
+        except Exception as e:
+            # If it's a critical error like JSONDecodeError, it might have been raised.
+            # We allow it to bubble up to prevent partial/corrupt configuration.
+            logger.error(f"Configuration loading failed: {e}")
+            raise
+    return settings
+
+
+class LazyConfig:
+    """
+    Stands in for the EmailConfig until a setting is first read, so importing
+    the server doesn't parse .env or read credentials.json (MCP hosts start
+    a server per session and wait for it). Everything else is passed through.
+    """
+
+    def __init__(self):
+        object.__setattr__(self, "_config", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+
+    @property
+    def loaded(self) -> bool:
+        return self._config is not None
+
+    def _resolve(self) -> EmailConfig:
+        settings = self._config
+        if settings is None:
+            # The parse pool's threads read settings too
+            with self._lock:
+                settings = self._config
+                if settings is None:
+                    settings = _load_config()
+                    object.__setattr__(self, "_config", settings)
+        return settings
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._resolve(), name, value)
+
+
+config = LazyConfig()
 
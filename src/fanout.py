@@ -0,0 +1,47 @@
+import asyncio
+import heapq
+import logging
+from itertools import islice
+from typing import Awaitable, Callable, Iterable
+
+try:
+    from src.config import config
+    from src.utils import date_timestamp
+except ImportError:
+    from config import config
+    from utils import date_timestamp
+
+logger = logging.getLogger(__name__)
+
+
+async def fan_out(jobs: list[tuple[str | None, Callable[[], Awaitable]]], concurrency: int | None = None) -> list:
+    """
+    Run (account, job) pairs concurrently, at most `concurrency` at a time,
+    each job inside its account (see config.use_account).
+
+    Returns the results in job order; a job that raised returns its exception,
+    so one unreachable folder or account doesn't sink the whole query.
+    """
+    slots = asyncio.Semaphore(max(1, concurrency or config.FANOUT_CONCURRENCY))
+
+    async def run(account: str | None, job: Callable[[], Awaitable]):
+        async with slots:
+            # Each task has its own context, so the account doesn't leak into the others
+            with config.use_account(account):
+                return await job()
+
+    return await asyncio.gather(*(run(account, job) for account, job in jobs), return_exceptions=True)
+
+
+def newest_first(item: dict) -> float:
+    return date_timestamp(item.get("date")) or 0.0
+
+
+def merge_newest(sources: Iterable[list[dict]], limit: int) -> list[dict]:
+    """
+    k-way heap merge of per-folder lists (each newest first) by date.
+
+    Inputs are kept in their own order, so what is taken from each source is
+    always a prefix of it; that is what makes per-source paging cursors work.
+    """
+    return list(islice(heapq.merge(*sources, key=newest_first, reverse=True), limit))
@@ -0,0 +1,124 @@
+import logging
+import time
+
+try:
+    from src.config import config
+    from src.utils import FOLDER_ALIASES, FOLDER_ALIAS_KEYS, parse_folder_line, parse_select_response, quote_mailbox
+except ImportError:
+    from config import config
+    from utils import FOLDER_ALIASES, FOLDER_ALIAS_KEYS, parse_folder_line, parse_select_response, quote_mailbox
+
+logger = logging.getLogger(__name__)
+
+# RFC 6154 attributes for the well-known folders
+SPECIAL_USE = {
+    "sent": "\\Sent",
+    "drafts": "\\Drafts",
+    "trash": "\\Trash",
+    "junk": "\\Junk",
+    "all": "\\All",
+    "archive": "\\Archive",
+}
+
+
+class FolderCatalog:
+    """
+    Cached result of LIST "" "*" per account.
+
+    Well-known folders are resolved by their special-use attribute (\\Sent,
+    \\Drafts, ...) first and by the usual provider names second, so "Sent"
+    finds "[Gmail]/Sent Mail" without a LIST on every call. The catalog is
+    refreshed after FOLDER_CACHE_TTL seconds, when list_folders asks for it,
+    when a name isn't in it or no longer selects, and after the IDLE watcher
+    sees the mailbox change.
+    """
+
+    def __init__(self):
+        self._folders: dict[tuple, tuple[float, list[dict]]] = {}
+
+    @staticmethod
+    def _key() -> tuple:
+        return (config.IMAP_HOST, config.EMAIL_USER)
+
+    def _cached(self) -> list[dict] | None:
+        entry = self._folders.get(self._key())
+        if entry is None or time.monotonic() - entry[0] > config.FOLDER_CACHE_TTL:
+            return None
+        return entry[1]
+
+    def invalidate(self) -> None:
+        self._folders.pop(self._key(), None)
+
+    async def get(self, client, refresh: bool = False) -> list[dict]:
+        folders = None if refresh else self._cached()
+        if folders is not None:
+            return folders
+        status, lines = await client.list('""', '*')
+        if status != 'OK':
+            raise ConnectionError(f"LIST failed: {status}")
+        folders = [parsed for parsed in map(parse_folder_line, lines) if parsed]
+        self._folders[self._key()] = (time.monotonic(), folders)
+        return folders
+
+    @staticmethod
+    def _match(folders: list[dict], folder: str) -> str | None:
+        names = {f["name"] for f in folders}
+        if folder in names:
+            return folder
+        if folder.upper() == "INBOX":
+            return "INBOX"
+        alias = FOLDER_ALIAS_KEYS.get(folder.lower())
+        if alias is None:
+            return None
+        attribute = SPECIAL_USE[alias].lower()
+        for f in folders:
+            if attribute in f["flags"].lower().split():
+                return f["name"]
+        for candidate in FOLDER_ALIASES[alias]:
+            if candidate in names:
+                return candidate
+        if alias == "archive":
+            # Gmail has no archive folder: archiving is removing the Inbox label, i.e. a move to All Mail
+            return FolderCatalog._match(folders, "all mail")
+        return None
+
+    def lookup(self, folder: str) -> str | None:
+        """Resolve from the cache only (no I/O); None if unknown or the cache is cold."""
+        folders = self._cached()
+        return self._match(folders, folder) if folders is not None else None
+
+    async def resolve(self, client, folder: str, refresh: bool = False) -> str | None:
+        """Real name of `folder` (exact name or Sent/Drafts/Trash/Junk/Archive alias), or None."""
+        folders = None if refresh else self._cached()
+        if folders is not None:
+            found = self._match(folders, folder)
+            if found is not None:
+                return found
+        # Cold cache, or a miss that may be a folder created since the last LIST
+        return self._match(await self.get(client, refresh=True), folder)
+
+
+folder_catalog = FolderCatalog()
+
+
+async def select_folder(client, folder: str) -> tuple[str | None, dict]:
+    """
+    SELECT a folder, resolving the well-known names (Sent, Drafts, ...) to
+    the provider's folder through the catalog.
+
+    Returns the real folder name and the parsed SELECT info, or (None, {})
+    if nothing matched.
+    """
+    target = folder_catalog.lookup(folder) or folder
+    res = await client.select(quote_mailbox(target))
+    if res.result == 'OK':
+        return target, parse_select_response(res.lines)
+
+    # The catalog is cold, stale, or the name is an alias: one fresh LIST
+    real_folder = await folder_catalog.resolve(client, folder, refresh=True)
+    if real_folder is None or real_folder == target:
+        return None, {}
+    res = await client.select(quote_mailbox(real_folder))
+    if res.result != 'OK':
+        return None, {}
+    return real_folder, parse_select_response(res.lines)
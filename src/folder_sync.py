@@ -0,0 +1,494 @@
+import asyncio
+import email
+import logging
+import re
+import sqlite3
+import time
+from dataclasses import dataclass
+from email.policy import default
+
+try:
+    from src.config import config
+    from src.mail_filter import MailFilter, parse_day
+    from src.message_cache import cache_root
+    from src.search_index import search_index
+    from src.utils import parse_fetch_response, fetch_literal, date_timestamp
+except ImportError:
+    from config import config
+    from mail_filter import MailFilter, parse_day
+    from message_cache import cache_root
+    from search_index import search_index
+    from utils import parse_fetch_response, fetch_literal, date_timestamp
+
+logger = logging.getLogger(__name__)
+
+HEADER_FIELDS = "FROM TO CC SUBJECT DATE MESSAGE-ID IN-REPLY-TO REFERENCES"
+MESSAGE_ID_RE = re.compile(r"<[^<>\s]+>")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sync_state (
+    account       TEXT NOT NULL,
+    folder        TEXT NOT NULL,
+    uidvalidity   INTEGER NOT NULL,
+    uidnext       INTEGER,
+    highestmodseq INTEGER,
+    exists_count  INTEGER NOT NULL,
+    low_uid       INTEGER,
+    synced_at     REAL NOT NULL,
+    PRIMARY KEY (account, folder)
+);
+CREATE TABLE IF NOT EXISTS headers (
+    account     TEXT NOT NULL,
+    folder      TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    uid         INTEGER NOT NULL,
+    sender      TEXT,
+    recipients  TEXT,
+    subject     TEXT,
+    date        TEXT,
+    date_ts     REAL,
+    flags       TEXT,
+    modseq      INTEGER,
+    size        INTEGER,
+    message_id  TEXT,
+    in_reply_to TEXT,
+    refs        TEXT,
+    PRIMARY KEY (account, folder, uidvalidity, uid)
+);
+CREATE INDEX IF NOT EXISTS headers_message_id ON headers (account, message_id);
+CREATE INDEX IF NOT EXISTS headers_in_reply_to ON headers (account, in_reply_to);
+-- One row per Message-ID in a message's References, so threading is an index lookup
+CREATE TABLE IF NOT EXISTS header_refs (
+    account     TEXT NOT NULL,
+    folder      TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    uid         INTEGER NOT NULL,
+    ref         TEXT NOT NULL,
+    PRIMARY KEY (account, ref, folder, uidvalidity, uid)
+);
+CREATE INDEX IF NOT EXISTS header_refs_message ON header_refs (account, folder, uidvalidity, uid);
+"""
+
+# Columns list_emails/_query hand out, in order
+ROW_FIELDS = ("uid", "sender", "recipients", "subject", "date", "date_ts", "flags", "size",
+              "message_id", "in_reply_to", "refs")
+
+
+@dataclass
+class SyncState:
+    uidvalidity: int
+    uidnext: int | None
+    highestmodseq: int | None
+    exists_count: int
+    # The index holds every message of the folder whose UID is >= low_uid
+    low_uid: int | None
+    synced_at: float | None = None
+
+
+class FolderSync:
+    """
+    Keeps a local header index per folder current with as little IMAP traffic
+    as possible.
+
+    For every folder we remember UIDVALIDITY, UIDNEXT, HIGHESTMODSEQ and the
+    EXISTS count from the last sync. On the next SELECT:
+
+    * nothing changed          -> no further commands
+    * UIDNEXT moved            -> headers for the new UIDs only (UID FETCH n:*)
+    * HIGHESTMODSEQ moved      -> flags of indexed messages changed since then (CHANGEDSINCE)
+    * EXISTS doesn't add up    -> one UID SEARCH over the indexed range to drop expunged UIDs
+    * UIDVALIDITY changed      -> the folder's index is discarded
+
+    The index only ever grows backwards as far as a caller asked for
+    (see ensure_depth), so a 100k message INBOX costs what you actually list.
+
+    Besides sender/subject/date it keeps the recipients, parsed date, flags,
+    size, Message-ID and thread references (In-Reply-To/References) of each
+    message, so listings, filters and threading can be answered locally.
+    """
+
+    def __init__(self):
+        self._db: sqlite3.Connection | None = None
+        # One sync per folder at a time (the IDLE watcher and tools may race)
+        self._locks: dict[tuple, asyncio.Lock] = {}
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            root = cache_root()
+            root.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(root / 'headers.sqlite3')
+            self._db.execute("PRAGMA journal_mode=WAL")
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(headers)")}
+            if columns and "message_id" not in columns:
+                # Index from an older version without the extra headers: it's only a cache, rebuild it
+                logger.info("Rebuilding the header index with the extended columns")
+                self._db.executescript("DROP TABLE headers; DROP TABLE IF EXISTS header_refs; DELETE FROM sync_state;")
+            has_refs = self._db.execute("SELECT 1 FROM sqlite_master WHERE name = 'header_refs'").fetchone()
+            self._db.executescript(SCHEMA)
+            if not has_refs:
+                # Index from before the references table: fill it from the refs column
+                with self._db:
+                    self._db.executemany(
+                        "INSERT OR IGNORE INTO header_refs (account, folder, uidvalidity, uid, ref) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        [(*key, ref) for *key, refs in self._db.execute(
+                            "SELECT account, folder, uidvalidity, uid, refs FROM headers WHERE refs IS NOT NULL")
+                         for ref in MESSAGE_ID_RE.findall(refs)],
+                    )
+        return self._db
+
+    @staticmethod
+    def _account() -> str:
+        return config.EMAIL_USER or ""
+
+    def get_state(self, folder: str) -> SyncState | None:
+        return self._load_state(folder)
+
+    def _load_state(self, folder: str) -> SyncState | None:
+        row = self.db.execute(
+            "SELECT uidvalidity, uidnext, highestmodseq, exists_count, low_uid, synced_at FROM sync_state "
+            "WHERE account = ? AND folder = ?", (self._account(), folder)
+        ).fetchone()
+        return SyncState(*row) if row else None
+
+    def _save_state(self, folder: str, state: SyncState) -> None:
+        state.synced_at = time.time()
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO sync_state "
+                "(account, folder, uidvalidity, uidnext, highestmodseq, exists_count, low_uid, synced_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (self._account(), folder, state.uidvalidity, state.uidnext, state.highestmodseq,
+                 state.exists_count, state.low_uid, state.synced_at),
+            )
+
+    def is_fresh(self, state: SyncState) -> bool:
+        """Whether the index may be trusted without asking the server (HEADER_INDEX_MAX_AGE)."""
+        return (config.HEADER_INDEX_MAX_AGE > 0 and state.synced_at is not None
+                and time.time() - state.synced_at < config.HEADER_INDEX_MAX_AGE)
+
+    def is_complete(self, folder: str, state: SyncState) -> bool:
+        """Whether every message of the folder is indexed, so filters can be answered locally."""
+        return self._indexed_count(folder, state.uidvalidity) >= state.exists_count
+
+    def _store_headers(self, folder: str, uidvalidity: int, records: list[dict]) -> list[int]:
+        rows = []
+        for record in records:
+            if "UID" not in record:
+                continue
+            msg = email.message_from_bytes(fetch_literal(record, "BODY[HEADER"), policy=default)
+            search_index.add(folder, uidvalidity, int(record["UID"]), msg)
+            modseq = record.get("MODSEQ")
+            size = str(record.get("RFC822.SIZE", ""))
+            fields = header_fields(msg)
+            rows.append((
+                self._account(), folder, uidvalidity, int(record["UID"]),
+                fields["sender"], fields["recipients"], fields["subject"], fields["date"], fields["date_ts"],
+                " ".join(record.get("FLAGS", [])), int(modseq[0]) if isinstance(modseq, list) and modseq else None,
+                int(size) if size.isdigit() else None,
+                fields["message_id"], fields["in_reply_to"], fields["refs"],
+            ))
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO headers "
+                "(account, folder, uidvalidity, uid, sender, recipients, subject, date, date_ts, flags, modseq, "
+                "size, message_id, in_reply_to, refs) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows,
+            )
+            self._delete_refs([row[:4] for row in rows])
+            self.db.executemany(
+                "INSERT OR IGNORE INTO header_refs (account, folder, uidvalidity, uid, ref) VALUES (?, ?, ?, ?, ?)",
+                [(*row[:4], ref) for row in rows for ref in MESSAGE_ID_RE.findall(row[14] or "")],
+            )
+        return [row[3] for row in rows]
+
+    def _delete_refs(self, keys: list[tuple]) -> None:
+        self.db.executemany(
+            "DELETE FROM header_refs WHERE account = ? AND folder = ? AND uidvalidity = ? AND uid = ?", keys,
+        )
+
+    def _indexed_count(self, folder: str, uidvalidity: int) -> int:
+        return self.db.execute(
+            "SELECT COUNT(*) FROM headers WHERE account = ? AND folder = ? AND uidvalidity = ?",
+            (self._account(), folder, uidvalidity),
+        ).fetchone()[0]
+
+    @staticmethod
+    def _header_items(client) -> str:
+        modseq = " MODSEQ" if client.has_capability('CONDSTORE') else ""
+        return f"(UID FLAGS RFC822.SIZE{modseq} BODY.PEEK[HEADER.FIELDS ({HEADER_FIELDS})])"
+
+    async def sync(self, client, folder: str, info: dict) -> SyncState | None:
+        """Bring the index of the currently selected folder up to date. `info` is the parsed SELECT response."""
+        lock = self._locks.setdefault((self._account(), folder), asyncio.Lock())
+        async with lock:
+            return await self._sync(client, folder, info)
+
+    async def _sync(self, client, folder: str, info: dict) -> SyncState | None:
+        uidvalidity = info.get("uidvalidity")
+        if uidvalidity is None:
+            return None
+        exists = info.get("exists", 0)
+        uidnext = info.get("uidnext")
+        highestmodseq = info.get("highestmodseq")
+        account = self._account()
+
+        state = self._load_state(folder)
+        if state is None or state.uidvalidity != uidvalidity:
+            if state is not None:
+                logger.info(f"UIDVALIDITY of {folder} changed, discarding its header index")
+            with self.db:
+                self.db.execute("DELETE FROM headers WHERE account = ? AND folder = ?", (account, folder))
+                self.db.execute("DELETE FROM header_refs WHERE account = ? AND folder = ?", (account, folder))
+            search_index.remove(folder, uidvalidity)
+            # Empty index: trivially complete for every UID from UIDNEXT on
+            state = SyncState(uidvalidity, uidnext, highestmodseq, exists, uidnext)
+            self._save_state(folder, state)
+            return state
+
+        unchanged = (uidnext is not None and uidnext == state.uidnext and exists == state.exists_count
+                     and (highestmodseq is None or highestmodseq == state.highestmodseq))
+        if unchanged:
+            self._touch(folder, state)
+            return state
+
+        # 1. New messages
+        new_uids = []
+        if uidnext is None or state.uidnext is None or uidnext != state.uidnext:
+            start = state.uidnext or 1
+            status, data = await client.uid('fetch', f"{start}:*", self._header_items(client))
+            if status == 'OK':
+                fresh = [r for r in parse_fetch_response(data) if "UID" in r and int(r["UID"]) >= start]
+                new_uids = self._store_headers(folder, uidvalidity, fresh)
+            if state.low_uid is None and new_uids:
+                state.low_uid = min(new_uids)
+
+        # 2. Flag changes on messages we already know about
+        low_uid = state.low_uid
+        if low_uid is not None and state.uidnext and low_uid < state.uidnext:
+            known_range = f"{low_uid}:{state.uidnext - 1}"
+            if highestmodseq is not None and state.highestmodseq is not None:
+                if highestmodseq != state.highestmodseq:
+                    status, data = await client.uid(
+                        'fetch', known_range, f"(UID FLAGS) (CHANGEDSINCE {state.highestmodseq})")
+                    if status == 'OK':
+                        self._update_flags(folder, uidvalidity, parse_fetch_response(data))
+            elif not client.has_capability('CONDSTORE'):
+                # No MODSEQ to go by; flags are cheap enough to refresh for the indexed range
+                status, data = await client.uid('fetch', known_range, "(UID FLAGS)")
+                if status == 'OK':
+                    self._update_flags(folder, uidvalidity, parse_fetch_response(data))
+
+        # 3. Expunges: EXISTS must equal the old count plus what just arrived
+        if exists != state.exists_count + len(new_uids) and low_uid is not None:
+            status, data = await client.uid_search(f"UID {low_uid}:*")
+            if status == 'OK':
+                alive = {int(u) for u in data[0].split()}
+                self._drop_missing(folder, uidvalidity, low_uid, alive)
+
+        state.uidnext = uidnext
+        state.highestmodseq = highestmodseq
+        state.exists_count = exists
+        self._save_state(folder, state)
+        return state
+
+    def _touch(self, folder: str, state: SyncState) -> None:
+        """Record that the index was just confirmed current."""
+        state.synced_at = time.time()
+        with self.db:
+            self.db.execute("UPDATE sync_state SET synced_at = ? WHERE account = ? AND folder = ?",
+                            (state.synced_at, self._account(), folder))
+
+    def _update_flags(self, folder: str, uidvalidity: int, records: list[dict]) -> None:
+        rows = []
+        for record in records:
+            if "UID" not in record:
+                continue
+            modseq = record.get("MODSEQ")
+            rows.append((" ".join(record.get("FLAGS", [])),
+                         int(modseq[0]) if isinstance(modseq, list) and modseq else None,
+                         self._account(), folder, uidvalidity, int(record["UID"])))
+        with self.db:
+            self.db.executemany(
+                "UPDATE headers SET flags = ?, modseq = COALESCE(?, modseq) "
+                "WHERE account = ? AND folder = ? AND uidvalidity = ? AND uid = ?", rows,
+            )
+
+    def update_flags(self, folder: str, uidvalidity: int | None, records: list[dict]) -> None:
+        """Apply FETCH (UID FLAGS MODSEQ) records, e.g. from a STORE, to the index."""
+        if uidvalidity is not None:
+            self._update_flags(folder, uidvalidity, [r for r in records if "FLAGS" in r])
+
+    def remove(self, folder: str, uidvalidity: int | None, uids: list[int]) -> None:
+        """Drop messages that were moved out of or expunged from the folder."""
+        if uidvalidity is None or not uids:
+            return
+        keys = [(self._account(), folder, uidvalidity, uid) for uid in uids]
+        with self.db:
+            self.db.executemany(
+                "DELETE FROM headers WHERE account = ? AND folder = ? AND uidvalidity = ? AND uid = ?", keys,
+            )
+            self._delete_refs(keys)
+        search_index.remove(folder, uidvalidity, list(uids))
+
+    def _drop_missing(self, folder: str, uidvalidity: int, low_uid: int, alive: set[int]) -> None:
+        indexed = [row[0] for row in self.db.execute(
+            "SELECT uid FROM headers WHERE account = ? AND folder = ? AND uidvalidity = ? AND uid >= ?",
+            (self._account(), folder, uidvalidity, low_uid),
+        )]
+        gone = [uid for uid in indexed if uid not in alive]
+        if gone:
+            logger.info(f"Dropping {len(gone)} expunged messages from the {folder} index")
+            self.remove(folder, uidvalidity, gone)
+
+    async def ensure_depth(self, client, folder: str, info: dict, count: int) -> None:
+        """
+        Make sure the index holds the newest `count` messages of the folder.
+
+        Since the index is exactly "every message with UID >= low_uid", the
+        missing older ones are sequence numbers 1..(EXISTS - indexed), so we can
+        fetch just the slice we need by sequence range without a SEARCH.
+        """
+        uidvalidity = info.get("uidvalidity")
+        state = self._load_state(folder)
+        if uidvalidity is None or state is None or state.uidvalidity != uidvalidity:
+            return
+        exists = state.exists_count
+        indexed = self._indexed_count(folder, uidvalidity)
+        wanted = min(count, exists)
+        if indexed >= wanted:
+            return
+
+        high = exists - indexed
+        low = max(1, exists - wanted + 1)
+        status, data = await client.fetch(f"{low}:{high}", self._header_items(client))
+        if status != 'OK':
+            logger.warning(f"Header backfill of {folder} failed: {status}")
+            return
+        uids = self._store_headers(folder, uidvalidity, parse_fetch_response(data))
+        if uids:
+            state.low_uid = min([uid for uid in (state.low_uid, *uids) if uid is not None])
+            self._save_state(folder, state)
+
+    def latest(self, folder: str, uidvalidity: int | None, limit: int,
+               filters: MailFilter | None = None) -> list[dict]:
+        """Newest `limit` indexed messages of a folder, newest first (optionally filtered)."""
+        where, params = _filters(filters)
+        return self._query(folder, uidvalidity, where, params, "DESC", limit)
+
+    def before(self, folder: str, uidvalidity: int | None, max_uid: int, limit: int,
+               filters: MailFilter | None = None) -> list[dict]:
+        """Indexed messages with UID < max_uid, newest first."""
+        where, params = _filters(filters)
+        return self._query(folder, uidvalidity, "AND uid < ? " + where, (max_uid, *params), "DESC", limit)
+
+    def count_from(self, folder: str, uidvalidity: int | None, min_uid: int) -> int:
+        """Number of indexed messages with UID >= min_uid."""
+        return self.db.execute(
+            "SELECT COUNT(*) FROM headers WHERE account = ? AND folder = ? AND uidvalidity = ? AND uid >= ?",
+            (self._account(), folder, uidvalidity, min_uid),
+        ).fetchone()[0]
+
+    def since(self, folder: str, uidvalidity: int | None, min_uid: int, limit: int) -> list[dict]:
+        """Indexed messages with UID >= min_uid, oldest first."""
+        return self._query(folder, uidvalidity, "AND uid >= ?", (min_uid,), "ASC", limit)
+
+    def get(self, folder: str, uidvalidity: int | None, uid: int) -> dict | None:
+        rows = self._query(folder, uidvalidity, "AND uid = ?", (uid,), "DESC", 1)
+        return rows[0] if rows else None
+
+    def find_related(self, message_ids: list[str], limit: int = 500) -> list[dict]:
+        """
+        Indexed messages of any folder that are, reply to or reference one of
+        `message_ids` (one round of thread discovery, see threader).
+        """
+        if not message_ids:
+            return []
+        marks = ",".join("?" * len(message_ids))
+        columns = ", ".join(f"h.{column}" for column in ("folder", "uidvalidity", *ROW_FIELDS))
+        # Three index lookups (Message-ID, In-Reply-To, References), not a scan of every header
+        rows = self.db.execute(
+            f"SELECT {columns} FROM headers h WHERE h.account = ? AND h.message_id IN ({marks}) "
+            f"UNION SELECT {columns} FROM headers h WHERE h.account = ? AND h.in_reply_to IN ({marks}) "
+            f"UNION SELECT {columns} FROM header_refs r JOIN headers h USING (account, folder, uidvalidity, uid) "
+            f"WHERE r.account = ? AND r.ref IN ({marks}) LIMIT ?",
+            (*[self._account(), *message_ids] * 3, limit),
+        ).fetchall()
+        entries = []
+        for row in rows:
+            entry = dict(zip(("folder", "uidvalidity", *ROW_FIELDS), row))
+            entry["flags"] = entry["flags"].split() if entry["flags"] else []
+            entries.append(entry)
+        return entries
+
+    def _query(self, folder: str, uidvalidity: int | None, where: str, params: tuple, order: str, limit: int) -> list[dict]:
+        if uidvalidity is None:
+            return []
+        rows = self.db.execute(
+            f"SELECT {', '.join(ROW_FIELDS)} FROM headers "
+            f"WHERE account = ? AND folder = ? AND uidvalidity = ? {where} ORDER BY uid {order} LIMIT ?",
+            (self._account(), folder, uidvalidity, *params, limit),
+        ).fetchall()
+        entries = []
+        for row in rows:
+            entry = dict(zip(ROW_FIELDS, row))
+            entry["flags"] = entry["flags"].split() if entry["flags"] else []
+            entries.append(entry)
+        return entries
+
+
+def _header(msg, name: str) -> str | None:
+    value = msg.get(name)
+    return " ".join(str(value).split()) if value else None
+
+
+def header_fields(msg) -> dict:
+    """The indexed header columns of a parsed message."""
+    date = str(msg.get("date", "Unknown"))
+    return {
+        "sender": str(msg.get("from", "Unknown")),
+        "recipients": ", ".join(str(msg.get(h)) for h in ("to", "cc") if msg.get(h)),
+        "subject": str(msg.get("subject", "No Subject")),
+        "date": date,
+        "date_ts": date_timestamp(date),
+        "message_id": _header(msg, "message-id"),
+        "in_reply_to": _header(msg, "in-reply-to"),
+        "refs": _header(msg, "references"),
+    }
+
+
+def _filters(filters: MailFilter | None) -> tuple[str, tuple]:
+    """SQL for the MailFilter criteria the index can answer (see MailFilter.local)."""
+    where, params = "", ()
+    if not filters:
+        return where, params
+    # Substring match, like IMAP SEARCH FROM/TO (LIKE is case-insensitive for ASCII)
+    for column, value in (("sender", filters.sender), ("recipients", filters.to)):
+        if value:
+            where += f"AND {column} LIKE ? ESCAPE '\\' "
+            params += (_like(value),)
+    if filters.since:
+        where += "AND date_ts >= ? "
+        params += (parse_day(filters.since).timestamp(),)
+    if filters.before:
+        where += "AND date_ts < ? "
+        params += (parse_day(filters.before).timestamp(),)
+    # Flags are stored space separated; no ESCAPE here, so the backslash is literal
+    for flag, wanted in (("\\Seen", None if filters.unread is None else not filters.unread),
+                         ("\\Flagged", filters.flagged)):
+        if wanted is not None:
+            where += f"AND (' ' || flags || ' ') {'' if wanted else 'NOT '}LIKE '% {flag} %' "
+    if filters.min_size:
+        where += "AND size > ? "
+        params += (int(filters.min_size),)
+    return where, params
+
+
+def _like(value: str) -> str:
+    """LIKE pattern matching `value` anywhere, with its own % and _ taken literally."""
+    escaped = value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+folder_sync = FolderSync()
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+
+try:
+    from src.config import config, DEFAULT_ACCOUNT
+    from src.imap_pool import imap_pool
+    from src.folder_sync import folder_sync
+    from src.message_cache import message_cache
+    from src.search_index import search_index
+    from src.folder_catalog import folder_catalog, select_folder
+    from src.parse_pool import parse_pool
+    from src.metrics import detach
+    from src.utils import (
+        quote_mailbox, parse_select_response, parse_fetch_response, fetch_literal, to_sequence_set,
+    )
+except ImportError:
+    from config import config, DEFAULT_ACCOUNT
+    from imap_pool import imap_pool
+    from folder_sync import folder_sync
+    from message_cache import message_cache
+    from search_index import search_index
+    from folder_catalog import folder_catalog, select_folder
+    from parse_pool import parse_pool
+    from metrics import detach
+    from utils import (
+        quote_mailbox, parse_select_response, parse_fetch_response, fetch_literal, to_sequence_set,
+    )
+
+logger = logging.getLogger(__name__)
+
+
+class IdleWatcher:
+    """
+    Runs one IMAP IDLE loop per folder in IDLE_FOLDERS on its own connection.
+
+    Whenever the server pushes EXISTS/EXPUNGE/FETCH for a folder, the folder
+    is re-synced into the header index (see folder_sync) and, if
+    IDLE_PREFETCH_BODIES is on, new messages are downloaded into the message
+    cache. While a folder is being watched its index is current, so
+    whats_new can answer without any network I/O.
+    """
+
+    def __init__(self):
+        self._tasks: dict[str, asyncio.Task] = {}
+        # configured name -> real folder name on the server
+        self.resolved: dict[str, str] = {}
+        # real folder names whose IDLE loop is currently up
+        self.live: set[str] = set()
+
+    def ensure_started(self) -> None:
+        """Start watching the configured folders (idempotent; needs a running loop)."""
+        if not config.IDLE_ENABLED or not config.is_configured:
+            return
+        for folder in [f.strip() for f in config.IDLE_FOLDERS.split(",") if f.strip()]:
+            task = self._tasks.get(folder)
+            if task is None or task.done():
+                self._tasks[folder] = asyncio.create_task(self._watch(folder), name=f"idle:{folder}")
+
+    async def stop(self) -> None:
+        tasks, self._tasks = list(self._tasks.values()), {}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.live.clear()
+
+    def is_live(self, folder: str) -> bool:
+        # Only the default account is watched
+        return folder in self.live and config.account_name == DEFAULT_ACCOUNT
+
+    async def _watch(self, folder: str) -> None:
+        from aioimaplib import STOP_WAIT_SERVER_PUSH
+
+        detach()
+        backoff = 1
+        while True:
+            client = None
+            real_folder = None
+            try:
+                client = await imap_pool.open_dedicated()
+                if not client.has_capability('IDLE'):
+                    logger.warning("IMAP server has no IDLE support, change watcher disabled")
+                    return
+                real_folder, info = await select_folder(client, folder)
+                if real_folder is None:
+                    logger.warning(f"IDLE watcher: folder {folder} not found")
+                    return
+                self.resolved[folder] = real_folder
+                await self._refresh(client, real_folder, info)
+                self.live.add(real_folder)
+                backoff = 1
+
+                while True:
+                    idle = await client.idle_start(timeout=config.IDLE_RENEW_SECONDS)
+                    push = await client.wait_server_push(timeout=config.IDLE_RENEW_SECONDS + 30)
+                    client.idle_done()
+                    await asyncio.wait_for(idle, timeout=30)
+
+                    if push != STOP_WAIT_SERVER_PUSH and _has_changes(push):
+                        # Whatever changed may have come with folder changes too; LIST again on next use
+                        folder_catalog.invalidate()
+                        res = await client.select(quote_mailbox(real_folder))
+                        if res.result != 'OK':
+                            raise ConnectionError(f"Re-select of {real_folder} failed: {res}")
+                        await self._refresh(client, real_folder, parse_select_response(res.lines))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"IDLE watcher for {folder} failed ({e}); reconnecting in {backoff}s")
+            finally:
+                if real_folder:
+                    self.live.discard(real_folder)
+                if client is not None:
+                    await imap_pool.close(client)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 300)
+
+    async def _refresh(self, client, folder: str, info: dict) -> None:
+        previous = folder_sync.get_state(folder)
+        state = await folder_sync.sync(client, folder, info)
+        if not config.IDLE_PREFETCH_BODIES or state is None or previous is None:
+            return
+        if previous.uidvalidity != state.uidvalidity or not previous.uidnext:
+            return
+        new_uids = [row["uid"] for row in folder_sync.since(folder, state.uidvalidity, previous.uidnext, 500)]
+        if not new_uids:
+            return
+        # BODY.PEEK[] rather than RFC822 so warming the cache doesn't mark mail as read
+        status, data = await client.uid('fetch', to_sequence_set(new_uids), '(BODY.PEEK[])')
+        if status != 'OK':
+            return
+        message_cache.check_uidvalidity(folder, state.uidvalidity)
+        raws = {int(record["UID"]): fetch_literal(record, "BODY[]") for record in parse_fetch_response(data) if "UID" in record}
+        parsed = await parse_pool.extract_bodies([(raw, None) for raw in raws.values()], config.BODY_MAX_BYTES or None)
+        for (uid, raw), (msg, body) in zip(raws.items(), parsed):
+            message_cache.put(folder, state.uidvalidity, uid, raw, msg)
+            search_index.add(folder, state.uidvalidity, uid, msg, body)
+        logger.info(f"Prefetched {len(new_uids)} new messages in {folder}")
+
+
+def _has_changes(push) -> bool:
+    lines = push if isinstance(push, list) else [push]
+    for line in lines:
+        if isinstance(line, (bytes, bytearray)) and any(k in line for k in (b'EXISTS', b'EXPUNGE', b'FETCH', b'VANISHED')):
+            return True
+    return False
+
+
+idle_watcher = IdleWatcher()
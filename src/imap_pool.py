@@ -0,0 +1,170 @@
+import asyncio
+import ssl
+import time
+import logging
+from contextlib import asynccontextmanager
+
+try:
+    from src.config import config
+    from src.metrics import instrument_imap, metrics, span
+except ImportError:
+    from config import config
+    from metrics import instrument_imap, metrics, span
+
+logger = logging.getLogger(__name__)
+
+
+class PooledSession:
+    """An authenticated IMAP client plus the bookkeeping the pool needs."""
+
+    def __init__(self, client, key: tuple):
+        self.client = client
+        self.key = key
+        self.last_used = time.monotonic()
+
+    @property
+    def idle_for(self) -> float:
+        return time.monotonic() - self.last_used
+
+
+class IMAPPool:
+    """
+    Keeps a small set of logged-in IMAP sessions around so tools can skip the
+    TLS handshake + LOGIN on every call.
+
+    Sessions are handed out LIFO (the most recently used one is the most likely
+    to still be alive), checked with NOOP when they have been idle for a while,
+    and transparently replaced if the server dropped them or the configured
+    credentials changed.
+    """
+
+    def __init__(self, size: int | None = None):
+        self._size = size
+        # Idle sessions per (host, port, user, password), so several accounts can share the pool
+        self._idle: dict[tuple, list[PooledSession]] = {}
+        self._semaphore: asyncio.Semaphore | None = None
+
+    # Sized on first use rather than at import, which would load the config (see LazyConfig)
+    @property
+    def size(self) -> int:
+        if self._size is None:
+            self._size = config.IMAP_POOL_SIZE
+        return self._size
+
+    @property
+    def _slots(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.size)
+        return self._semaphore
+
+    @staticmethod
+    def _config_key() -> tuple:
+        return (config.IMAP_HOST, config.IMAP_PORT, config.EMAIL_USER, config.EMAIL_PASS)
+
+    async def _connect(self, key: tuple) -> PooledSession:
+        # Imported on first connect, keeping it out of the server's startup
+        import aioimaplib
+
+        logger.info(f"Opening pooled IMAP connection to {config.IMAP_HOST}:{config.IMAP_PORT}")
+        ssl_context = ssl.create_default_context()
+        client = aioimaplib.IMAP4_SSL(host=config.IMAP_HOST, port=config.IMAP_PORT, ssl_context=ssl_context)
+        # TCP + TLS handshake + greeting
+        with span("imap_connect"):
+            await client.wait_hello_from_server()
+
+        with span("imap_login"):
+            login_response = await client.login(config.EMAIL_USER, config.EMAIL_PASS)
+        if login_response.result != 'OK':
+            await self._close_client(client)
+            raise ConnectionError(f"Login failed: {login_response}")
+        instrument_imap(client)
+
+        # Have the server report HIGHESTMODSEQ/MODSEQ so folder syncs can be incremental
+        if client.has_capability('CONDSTORE') and client.has_capability('ENABLE'):
+            try:
+                await client.enable('CONDSTORE')
+            except Exception as e:
+                logger.info(f"ENABLE CONDSTORE failed, continuing without it: {e}")
+        return PooledSession(client, key)
+
+    @staticmethod
+    async def _close_client(client) -> None:
+        try:
+            await asyncio.wait_for(client.logout(), timeout=5)
+        except Exception as e:
+            logger.debug(f"Ignoring error while closing IMAP session: {e}")
+
+    async def _is_healthy(self, session: PooledSession) -> bool:
+        if session.client.get_state() not in ('AUTH', 'SELECTED'):
+            return False
+        if session.idle_for < config.IMAP_POOL_HEALTHCHECK_INTERVAL:
+            return True
+        try:
+            response = await session.client.noop()
+            return response.result == 'OK'
+        except Exception as e:
+            logger.info(f"Pooled IMAP session failed health check: {e}")
+            return False
+
+    async def _checkout(self) -> PooledSession:
+        key = self._config_key()
+        idle = self._idle.setdefault(key, [])
+        while idle:
+            session = idle.pop()
+            if session.idle_for > config.IMAP_POOL_IDLE_TIMEOUT:
+                await self._close_client(session.client)
+                continue
+            if await self._is_healthy(session):
+                return session
+            await self._close_client(session.client)
+        return await self._connect(key)
+
+    async def _park(self, session: PooledSession) -> None:
+        self._idle.setdefault(session.key, []).append(session)
+        # Keep at most `size` idle sessions across all accounts; the least recently used goes
+        idle = [s for sessions in self._idle.values() for s in sessions]
+        if len(idle) > self.size:
+            oldest = min(idle, key=lambda s: s.last_used)
+            self._idle[oldest.key].remove(oldest)
+            await self._close_client(oldest.client)
+
+    @asynccontextmanager
+    async def acquire(self):
+        """
+        Borrow an authenticated IMAP client.
+
+        The session goes back to the pool when the block exits normally. If the
+        block raises, the connection state is unknown so the session is dropped
+        and a fresh one will be opened next time.
+        """
+        async with self._slots:
+            session = await self._checkout()
+            try:
+                yield session.client
+            except BaseException:
+                await self._close_client(session.client)
+                raise
+            session.last_used = time.monotonic()
+            await self._park(session)
+
+    async def open_dedicated(self):
+        """
+        Open an authenticated client that lives outside the shared slots, for
+        long-running work such as IDLE. The caller owns it and must log it out.
+        """
+        session = await self._connect(self._config_key())
+        return session.client
+
+    async def close(self, client) -> None:
+        await self._close_client(client)
+
+    async def close_all(self) -> None:
+        """Log out every idle session (e.g. after the credentials changed)."""
+        idle, self._idle = self._idle, {}
+        for session in [s for sessions in idle.values() for s in sessions]:
+            await self._close_client(session.client)
+
+
+imap_pool = IMAPPool()
+metrics.gauge("email_mcp_imap_idle_sessions", "Logged-in IMAP sessions waiting in the pool",
+              lambda: sum(len(sessions) for sessions in imap_pool._idle.values()))
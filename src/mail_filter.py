@@ -0,0 +1,86 @@
+from dataclasses import astuple, dataclass
+from datetime import datetime, timezone
+
+MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+
+def parse_day(value: str) -> datetime:
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    except ValueError:
+        raise ValueError(f"Invalid date '{value}', expected YYYY-MM-DD") from None
+
+
+def imap_date(value: str) -> str:
+    """YYYY-MM-DD as an IMAP search date (1-Feb-2025), independent of the locale."""
+    day = parse_day(value)
+    return f"{day.day}-{MONTHS[day.month - 1]}-{day.year}"
+
+
+def quote(value: str) -> str:
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+@dataclass(frozen=True)
+class MailFilter:
+    """
+    The filters of a list_emails call, compiled into a single IMAP SEARCH
+    (see criteria) so only matching UIDs are ever fetched, or answered from
+    the header index when the folder is fully indexed (folder_sync).
+
+    Dates go by the Date header (SENTSINCE/SENTBEFORE), like the dates
+    list_emails shows and sorts by and like search_emails.
+    """
+    sender: str | None = None
+    to: str | None = None
+    since: str | None = None         # YYYY-MM-DD, inclusive
+    before: str | None = None        # YYYY-MM-DD, exclusive
+    unread: bool | None = None       # True: UNSEEN, False: SEEN
+    flagged: bool | None = None      # True: FLAGGED, False: UNFLAGGED
+    min_size: int | None = None      # LARGER, in bytes
+    gmail_query: str | None = None   # X-GM-RAW (Gmail search syntax), Gmail only
+
+    def __post_init__(self):
+        for value in (self.since, self.before):
+            if value:
+                parse_day(value)
+
+    def __bool__(self) -> bool:
+        return any(value is not None and value != "" for value in astuple(self))
+
+    @property
+    def local(self) -> bool:
+        """Whether the header index can answer it (it knows nothing of Gmail's search syntax)."""
+        return not self.gmail_query
+
+    @property
+    def by_flags(self) -> bool:
+        """Whether it filters on \\Seen/\\Flagged, which the index only keeps current with CONDSTORE."""
+        return self.unread is not None or self.flagged is not None
+
+    def key(self) -> list:
+        """JSON-able form for paging cursors, which only continue under the same filters."""
+        return list(astuple(self))
+
+    def criteria(self, before_uid: int | None = None) -> str:
+        """The IMAP SEARCH criteria (all ANDed), limited to UIDs below `before_uid`."""
+        parts = []
+        if before_uid:
+            parts.append(f"UID 1:{before_uid - 1}")
+        if self.sender:
+            parts.append(f"FROM {quote(self.sender)}")
+        if self.to:
+            parts.append(f"TO {quote(self.to)}")
+        if self.since:
+            parts.append(f"SENTSINCE {imap_date(self.since)}")
+        if self.before:
+            parts.append(f"SENTBEFORE {imap_date(self.before)}")
+        if self.unread is not None:
+            parts.append("UNSEEN" if self.unread else "SEEN")
+        if self.flagged is not None:
+            parts.append("FLAGGED" if self.flagged else "UNFLAGGED")
+        if self.min_size:
+            parts.append(f"LARGER {int(self.min_size)}")
+        if self.gmail_query:
+            parts.append(f"X-GM-RAW {quote(self.gmail_query)}")
+        return " ".join(parts) or "ALL"
@@ -0,0 +1,200 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+try:
+    from src.config import config, BASE_DIR
+    from src.metrics import count_cache
+    from src.utils import chunked
+except ImportError:
+    from config import config, BASE_DIR
+    from metrics import count_cache
+    from utils import chunked
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS folders (
+    account     TEXT NOT NULL,
+    folder      TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    PRIMARY KEY (account, folder)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    account     TEXT NOT NULL,
+    folder      TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    uid         INTEGER NOT NULL,
+    size        INTEGER NOT NULL,
+    sender      TEXT,
+    subject     TEXT,
+    date        TEXT,
+    blob        TEXT NOT NULL,
+    last_access REAL NOT NULL,
+    PRIMARY KEY (account, folder, uidvalidity, uid)
+);
+CREATE INDEX IF NOT EXISTS messages_lru ON messages (last_access);
+"""
+
+
+def cache_root() -> Path:
+    return Path(config.CACHE_DIR) if config.CACHE_DIR else BASE_DIR / '.cache'
+
+
+class MessageCache:
+    """
+    Disk-backed store of raw RFC822 messages keyed by (folder, UIDVALIDITY, UID).
+
+    Metadata lives in SQLite, message bytes in one blob file each. The total
+    size is capped at MESSAGE_CACHE_MAX_MB by evicting the least recently
+    read messages. Entries for a folder are dropped as soon as the server
+    reports a different UIDVALIDITY for it.
+    """
+
+    def __init__(self, root: Path | None = None):
+        self._root = root
+        self._db: sqlite3.Connection | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return config.MESSAGE_CACHE_ENABLED
+
+    @property
+    def root(self) -> Path:
+        return self._root or cache_root()
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        # Opened lazily so importing the server never touches the disk
+        if self._db is None:
+            (self.root / 'blobs').mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(self.root / 'messages.sqlite3')
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    @staticmethod
+    def _account() -> str:
+        return config.EMAIL_USER or ""
+
+    def _blob_path(self, folder: str, uidvalidity: int, uid: int) -> Path:
+        digest = hashlib.sha1(f"{self._account()}\0{folder}\0{uidvalidity}\0{uid}".encode()).hexdigest()
+        return self.root / 'blobs' / digest[:2] / f"{digest}.eml"
+
+    def check_uidvalidity(self, folder: str, uidvalidity: int | None) -> None:
+        """Record the folder's current UIDVALIDITY, dropping entries cached under an older one."""
+        if not self.enabled or uidvalidity is None:
+            return
+        account = self._account()
+        row = self.db.execute(
+            "SELECT uidvalidity FROM folders WHERE account = ? AND folder = ?", (account, folder)
+        ).fetchone()
+        if row and row[0] == uidvalidity:
+            return
+        if row:
+            logger.info(f"UIDVALIDITY of {folder} changed ({row[0]} -> {uidvalidity}), dropping cached messages")
+            self._delete_where("account = ? AND folder = ? AND uidvalidity != ?", (account, folder, uidvalidity))
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO folders (account, folder, uidvalidity) VALUES (?, ?, ?)",
+                (account, folder, uidvalidity),
+            )
+
+    def get_many(self, folder: str, uidvalidity: int | None, uids: list[int]) -> dict[int, bytes]:
+        """Return {uid: raw message} for every requested UID that is cached."""
+        if not self.enabled or uidvalidity is None or not uids:
+            return {}
+        found = {}
+        account = self._account()
+        placeholders = ",".join("?" * len(uids))
+        rows = self.db.execute(
+            f"SELECT uid, blob FROM messages WHERE account = ? AND folder = ? AND uidvalidity = ? "
+            f"AND uid IN ({placeholders})",
+            (account, folder, uidvalidity, *uids),
+        ).fetchall()
+        missing = []
+        for uid, blob in rows:
+            try:
+                found[uid] = (self.root / blob).read_bytes()
+            except FileNotFoundError:
+                missing.append(uid)
+        with self.db:
+            if found:
+                self.db.executemany(
+                    "UPDATE messages SET last_access = ? WHERE account = ? AND folder = ? AND uidvalidity = ? AND uid = ?",
+                    [(time.time(), account, folder, uidvalidity, uid) for uid in found],
+                )
+            if missing:
+                self.db.executemany(
+                    "DELETE FROM messages WHERE account = ? AND folder = ? AND uidvalidity = ? AND uid = ?",
+                    [(account, folder, uidvalidity, uid) for uid in missing],
+                )
+        count_cache("message", hits=len(found), misses=len(uids) - len(found))
+        return found
+
+    def get(self, folder: str, uidvalidity: int | None, uid: int) -> bytes | None:
+        return self.get_many(folder, uidvalidity, [uid]).get(uid)
+
+    def put(self, folder: str, uidvalidity: int | None, uid: int, raw: bytes, msg=None) -> None:
+        """Store a raw message (and its parsed headers, if given), then enforce the size cap."""
+        if not self.enabled or uidvalidity is None or not raw:
+            return
+        path = self._blob_path(folder, uidvalidity, uid)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix('.tmp')
+        tmp.write_bytes(raw)
+        os.replace(tmp, path)
+
+        sender = subject = date = None
+        if msg is not None:
+            sender, subject, date = str(msg.get("from", "")), str(msg.get("subject", "")), str(msg.get("date", ""))
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO messages "
+                "(account, folder, uidvalidity, uid, size, sender, subject, date, blob, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (self._account(), folder, uidvalidity, uid, len(raw), sender, subject, date,
+                 str(path.relative_to(self.root)), time.time()),
+            )
+        self._evict()
+
+    def remove(self, folder: str, uidvalidity: int | None, uids: list[int]) -> None:
+        """Forget messages that were moved out of or expunged from the folder."""
+        if not self.enabled or uidvalidity is None:
+            return
+        for batch in chunked(list(uids), 500):
+            self._delete_where(
+                f"account = ? AND folder = ? AND uidvalidity = ? AND uid IN ({','.join('?' * len(batch))})",
+                (self._account(), folder, uidvalidity, *batch),
+            )
+
+    def _delete_where(self, where: str, params: tuple) -> None:
+        rows = self.db.execute(f"SELECT blob FROM messages WHERE {where}", params).fetchall()
+        for (blob,) in rows:
+            (self.root / blob).unlink(missing_ok=True)
+        with self.db:
+            self.db.execute(f"DELETE FROM messages WHERE {where}", params)
+
+    def _evict(self) -> None:
+        limit = config.MESSAGE_CACHE_MAX_MB * 1024 * 1024
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM messages").fetchone()[0]
+        if total <= limit:
+            return
+        # Drop least recently used entries until we are back under the cap
+        victims = []
+        for rowid, size, blob in self.db.execute("SELECT rowid, size, blob FROM messages ORDER BY last_access"):
+            if total <= limit:
+                break
+            victims.append((rowid, blob))
+            total -= size
+        for _, blob in victims:
+            (self.root / blob).unlink(missing_ok=True)
+        with self.db:
+            self.db.executemany("DELETE FROM messages WHERE rowid = ?", [(rowid,) for rowid, _ in victims])
+        logger.debug(f"Evicted {len(victims)} cached messages")
+
+
+message_cache = MessageCache()
@@ -0,0 +1,362 @@
+import bisect
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+try:
+    from src.config import config
+except ImportError:
+    from config import config
+
+try:
+    # opentelemetry-api comes with fastmcp; spans are only created with OTEL_ENABLED
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# aioimaplib methods timed as IMAP round trips (uid() is labelled with its command, e.g. "UID FETCH")
+IMAP_COMMANDS = ("uid", "uid_search", "search", "select", "examine", "list", "lsub", "status", "append",
+                 "noop", "fetch", "store", "copy", "move", "expunge", "enable", "id", "namespace")
+# (not sendmail: send_message goes through it)
+SMTP_COMMANDS = ("send_message", "rset", "noop")
+
+# Tool whose call is running; IMAP commands issued outside a tool (IDLE watcher, outbox) count as "background"
+current_tool: ContextVar[str] = ContextVar("current_tool", default="background")
+# phase -> seconds spent in it by the running tool call (for SLOW_TOOL_LOG_MS)
+_call_phases: ContextVar[dict | None] = ContextVar("call_phases", default=None)
+_call_lock = threading.Lock()
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: tuple = ()) -> str:
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labels, key)} {_number(value)}" for key, value in values]
+
+
+class Histogram:
+    """Prometheus-style histogram: per label set, a count per bucket plus the sum and count."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        # key -> [count per bucket..., count above the last bucket, sum]
+        self._values: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            row[bisect.bisect_left(self.buckets, value)] += 1
+            row[-1] += value
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = sorted((key, list(row)) for key, row in self._values.items())
+        lines = []
+        for key, row in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), row[:-1]):
+                cumulative += count
+                le = bound if bound == "+Inf" else _number(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.labels, key, (('le', le),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {_number(row[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """A value read when /metrics is scraped (pool sizes and the like)."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, read):
+        self.name, self.help, self.read = name, help, read
+
+    def samples(self) -> list[str]:
+        try:
+            return [f"{self.name} {_number(self.read())}"]
+        except Exception as e:
+            logger.debug(f"Gauge {self.name} failed: {e}")
+            return []
+
+
+class Metrics:
+    """
+    The metrics of this process, rendered in the Prometheus text format by
+    GET /metrics. Kept in-house (no prometheus_client dependency); every
+    metric is safe to update from the parse pool's threads. Process pool
+    workers (PARSE_EXECUTOR=process) keep their own, unreported.
+    """
+
+    def __init__(self):
+        self._metrics: list = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, read) -> Gauge:
+        return self._register(Gauge(name, help, read))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+TOOL_SECONDS = metrics.histogram("email_mcp_tool_duration_seconds",
+                                 "Tool call latency; status is ok or error (error results count too)",
+                                 ("tool", "status"))
+PHASE_SECONDS = metrics.histogram("email_mcp_phase_duration_seconds",
+                                  "Time spent per phase of a tool call (connect, login, parse, html_to_text)",
+                                  ("phase", "tool"))
+IMAP_SECONDS = metrics.histogram("email_mcp_imap_command_duration_seconds",
+                                 "IMAP command latency; the count is the number of round trips",
+                                 ("command", "tool"))
+IMAP_BYTES = metrics.counter("email_mcp_imap_received_bytes_total",
+                             "Bytes of IMAP responses received", ("command", "tool"))
+SMTP_SECONDS = metrics.histogram("email_mcp_smtp_command_duration_seconds",
+                                 "SMTP command latency; the count is the number of round trips", ("command",))
+CACHE_LOOKUPS = metrics.counter("email_mcp_cache_lookups_total",
+                                "Cache lookups by cache (message, html_to_text, header_index) and result",
+                                ("cache", "result"))
+
+
+def count_cache(cache: str, hits: int = 0, misses: int = 0, result: str = "hit") -> None:
+    if not config.METRICS_ENABLED:
+        return
+    if hits:
+        CACHE_LOOKUPS.inc(hits, cache=cache, result=result)
+    if misses:
+        CACHE_LOOKUPS.inc(misses, cache=cache, result="miss")
+
+
+_tracer = None
+
+
+def _setup_export() -> None:
+    """Send spans over OTLP, unless the application already configured an OpenTelemetry SDK."""
+    if not isinstance(trace.get_tracer_provider(), trace.ProxyTracerProvider):
+        return
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    except ImportError:
+        logger.warning("OTEL_ENABLED is set but opentelemetry-sdk and opentelemetry-exporter-otlp-proto-http "
+                       "are not installed; spans go nowhere")
+        return
+    # The exporter reads OTEL_EXPORTER_OTLP_ENDPOINT and friends itself
+    provider = TracerProvider(resource=Resource.create({"service.name": "email-mcp"}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    logger.info("Exporting OpenTelemetry spans over OTLP")
+
+
+def _get_tracer():
+    global _tracer
+    if _tracer is None:
+        if trace is None or not config.OTEL_ENABLED:
+            _tracer = False
+        else:
+            _setup_export()
+            _tracer = trace.get_tracer("email-mcp")
+    return _tracer or None
+
+
+def _otel_span(name: str, attributes: dict):
+    tracer = _get_tracer()
+    if tracer is None:
+        return nullcontext()
+    return tracer.start_as_current_span(name, attributes=attributes)
+
+
+def detach() -> None:
+    """
+    For long-lived tasks (outbox, IDLE watcher): they may be started from
+    inside a tool call and inherit its context, but their work isn't its.
+    """
+    current_tool.set("background")
+    _call_phases.set(None)
+
+
+def _add_to_call(phase: str, seconds: float) -> None:
+    phases = _call_phases.get()
+    if phases is not None:
+        with _call_lock:
+            phases[phase] = phases.get(phase, 0.0) + seconds
+
+
+def record_phase(phase: str, seconds: float) -> None:
+    PHASE_SECONDS.observe(seconds, phase=phase, tool=current_tool.get())
+    _add_to_call(phase, seconds)
+
+
+@contextmanager
+def span(phase: str, **attributes):
+    """Time a phase of the running tool call (histogram, slow call log and, with OTEL_ENABLED, a span)."""
+    if not config.METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        with _otel_span(phase, attributes):
+            yield
+    finally:
+        record_phase(phase, time.perf_counter() - start)
+
+
+def failed(result) -> bool:
+    """Whether a tool result reports an error (tools return their errors rather than raise)."""
+    if isinstance(result, dict):
+        return "error" in result
+    if isinstance(result, list):
+        return any(isinstance(item, dict) and "error" in item for item in result)
+    return isinstance(result, str) and result.startswith(("Error", "❌"))
+
+
+def timed_tool(fn):
+    """
+    Decorator for tool handlers (below @mcp.tool()): records the call's
+    latency and status, and labels the IMAP commands and phases it runs
+    with the tool's name.
+    """
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        if not config.METRICS_ENABLED:
+            return await fn(*args, **kwargs)
+        tool_token = current_tool.set(name)
+        phases: dict[str, float] = {}
+        phases_token = _call_phases.set(phases)
+        status = "error"
+        start = time.perf_counter()
+        try:
+            with _otel_span(f"tool {name}", {"email_mcp.tool": name}):
+                result = await fn(*args, **kwargs)
+            status = "error" if failed(result) else "ok"
+            return result
+        finally:
+            elapsed = time.perf_counter() - start
+            current_tool.reset(tool_token)
+            _call_phases.reset(phases_token)
+            TOOL_SECONDS.observe(elapsed, tool=name, status=status)
+            if config.SLOW_TOOL_LOG_MS and elapsed * 1000 >= config.SLOW_TOOL_LOG_MS:
+                breakdown = ", ".join(f"{phase} {seconds * 1000:.0f} ms"
+                                      for phase, seconds in sorted(phases.items(), key=lambda p: -p[1]))
+                logger.info(f"Slow tool call {name} ({status}): {elapsed * 1000:.0f} ms [{breakdown}]")
+
+    return wrapper
+
+
+def _response_bytes(response) -> int:
+    return sum(len(line) for line in getattr(response, "lines", None) or () if isinstance(line, (bytes, bytearray, str)))
+
+
+def _timed_imap(method, name: str):
+    @functools.wraps(method)
+    async def timed(*args, **kwargs):
+        command = f"UID {str(args[0]).upper()}" if name == "uid" and args else name.replace("_", " ").upper()
+        tool = current_tool.get()
+        start = time.perf_counter()
+        response = None
+        try:
+            with _otel_span(f"IMAP {command}", {"imap.command": command}):
+                response = await method(*args, **kwargs)
+            return response
+        finally:
+            elapsed = time.perf_counter() - start
+            IMAP_SECONDS.observe(elapsed, command=command, tool=tool)
+            IMAP_BYTES.inc(_response_bytes(response), command=command, tool=tool)
+            _add_to_call(f"IMAP {command}", elapsed)
+
+    return timed
+
+
+def _timed_smtp(method, name: str):
+    command = name.upper()
+
+    @functools.wraps(method)
+    async def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            with _otel_span(f"SMTP {command}", {"smtp.command": command}):
+                return await method(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            SMTP_SECONDS.observe(elapsed, command=command)
+            _add_to_call(f"SMTP {command}", elapsed)
+
+    return timed
+
+
+def instrument_imap(client):
+    """Time every command of a logged-in aioimaplib client (wraps its methods on the instance)."""
+    if config.METRICS_ENABLED:
+        for name in IMAP_COMMANDS:
+            method = getattr(client, name, None)
+            if method is not None:
+                setattr(client, name, _timed_imap(method, name))
+    return client
+
+
+def instrument_smtp(client):
+    if config.METRICS_ENABLED:
+        for name in SMTP_COMMANDS:
+            method = getattr(client, name, None)
+            if method is not None:
+                setattr(client, name, _timed_smtp(method, name))
+    return client
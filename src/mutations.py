@@ -0,0 +1,170 @@
+import logging
+import re
+
+try:
+    from src.utils import parse_fetch_response, quote_mailbox, to_sequence_set
+except ImportError:
+    from utils import parse_fetch_response, quote_mailbox, to_sequence_set
+
+logger = logging.getLogger(__name__)
+
+# Keep every command line well under the ~8 KB servers commonly accept
+MAX_SET_CHARS = 4000
+COPYUID_RE = re.compile(r'\[COPYUID (\d+) ([\d:,]+) ([\d:,]+)\]', re.IGNORECASE)
+
+
+def uid_sets(uids) -> list[str]:
+    """
+    UIDs as compact sequence sets ("1:40,42,50:90"), one per command.
+
+    Runs of consecutive UIDs collapse into ranges, so even thousands of
+    messages usually fit in one set; a set is only split when it would make
+    the command line longer than MAX_SET_CHARS.
+    """
+    sets, current = [], ""
+    for part in to_sequence_set(uids).split(","):
+        if not part:
+            continue
+        if current and len(current) + len(part) + 1 > MAX_SET_CHARS:
+            sets.append(current)
+            current = part
+        else:
+            current = f"{current},{part}" if current else part
+    if current:
+        sets.append(current)
+    return sets
+
+
+def expand_sequence_set(spec: str) -> list[int]:
+    """The inverse of to_sequence_set, in the order given ("3:5,1" -> [3, 4, 5, 1])."""
+    numbers = []
+    for part in spec.split(","):
+        low, _, high = part.partition(":")
+        low, high = int(low), int(high or low)
+        step = 1 if high >= low else -1
+        numbers.extend(range(low, high + step, step))
+    return numbers
+
+
+def parse_copyuid(lines: list) -> tuple[int | None, dict[int, int]]:
+    """UIDVALIDITY of the destination and {source uid: new uid} from COPYUID (RFC 4315) responses."""
+    uidvalidity, mapping = None, {}
+    for line in lines:
+        text = bytes(line).decode(errors='ignore') if isinstance(line, (bytes, bytearray)) else str(line)
+        for match in COPYUID_RE.finditer(text):
+            uidvalidity = int(match.group(1))
+            mapping.update(zip(expand_sequence_set(match.group(2)), expand_sequence_set(match.group(3))))
+    return uidvalidity, mapping
+
+
+def quote_label(label: str) -> str:
+    """Gmail labels for X-GM-LABELS: system labels (\\Important, \\Starred) as atoms, the rest quoted."""
+    if label.startswith("\\"):
+        return label
+    return '"' + label.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def flag_changes(read: bool | None = None, flagged: bool | None = None) -> list[tuple[str, str]]:
+    """The STOREs for mark_emails: at most one per direction, e.g. [("+FLAGS", "(\\Seen \\Flagged)")]."""
+    add, remove = [], []
+    for wanted, flag in ((read, "\\Seen"), (flagged, "\\Flagged")):
+        if wanted is not None:
+            (add if wanted else remove).append(flag)
+    changes = []
+    if add:
+        changes.append(("+FLAGS", f"({' '.join(add)})"))
+    if remove:
+        changes.append(("-FLAGS", f"({' '.join(remove)})"))
+    return changes
+
+
+def label_changes(add: list[str] | None = None, remove: list[str] | None = None) -> list[tuple[str, str]]:
+    changes = []
+    if add:
+        changes.append(("+X-GM-LABELS", f"({' '.join(map(quote_label, add))})"))
+    if remove:
+        changes.append(("-X-GM-LABELS", f"({' '.join(map(quote_label, remove))})"))
+    return changes
+
+
+async def existing(client, uids: list[int]) -> list[int]:
+    """Which of `uids` are in the selected folder: one UID SEARCH per sequence set."""
+    found = set()
+    for uid_set in uid_sets(uids):
+        status, data = await client.uid_search(f"UID {uid_set}")
+        if status != 'OK':
+            raise ConnectionError(f"UID SEARCH failed: {status}")
+        if data and data[0]:
+            found.update(int(u) for u in data[0].split())
+    return sorted(found & set(uids))
+
+
+async def store(client, uids: list[int], action: str, items: str) -> list[dict]:
+    """
+    UID STORE `action` `items` on the selected folder, one command per set.
+
+    Not .SILENT: the untagged FETCH replies carry every message's new FLAGS
+    (and MODSEQ), which is what the header index needs to stay current.
+    """
+    records = []
+    for uid_set in uid_sets(uids):
+        status, data = await client.uid('store', uid_set, action, items)
+        if status != 'OK':
+            raise ConnectionError(f"UID STORE {action} failed: {status} {data[-1:] if data else ''}")
+        records.extend(parse_fetch_response(data))
+    return records
+
+
+async def expunge(client, uids: list[int]) -> bool:
+    """
+    Permanently remove `uids` from the selected folder.
+
+    With UIDPLUS, UID EXPUNGE removes exactly these messages. Without it a
+    plain EXPUNGE would also take any other message flagged \\Deleted, so it
+    is only sent when ours are the only ones; otherwise their \\Deleted flag
+    is taken off again and False is returned.
+    """
+    await store(client, uids, "+FLAGS.SILENT", "(\\Deleted)")
+    if client.has_capability('UIDPLUS'):
+        for uid_set in uid_sets(uids):
+            status, data = await client.uid('expunge', uid_set)
+            if status != 'OK':
+                raise ConnectionError(f"UID EXPUNGE failed: {status}")
+        return True
+    status, data = await client.uid_search("DELETED")
+    if status != 'OK':
+        raise ConnectionError(f"UID SEARCH failed: {status}")
+    flagged = {int(u) for u in data[0].split()} if data and data[0] else set()
+    if not flagged <= set(uids):
+        logger.warning(f"Not expunging: {len(flagged - set(uids))} other messages are flagged \\Deleted "
+                       f"and the server has no UIDPLUS")
+        await store(client, uids, "-FLAGS.SILENT", "(\\Deleted)")
+        return False
+    status, data = await client.expunge()
+    if status != 'OK':
+        raise ConnectionError(f"EXPUNGE failed: {status}")
+    return True
+
+
+async def move(client, uids: list[int], destination: str) -> tuple[str, int | None, dict[int, int], bool]:
+    """
+    Move `uids` from the selected folder to `destination`.
+
+    UID MOVE (RFC 6851) where the server has it, otherwise UID COPY and an
+    expunge of the originals. Returns (method, destination UIDVALIDITY, {old
+    uid: new uid}, whether the originals are gone); the UIDVALIDITY and the
+    mapping come from COPYUID and are empty when the server doesn't send it.
+    """
+    mailbox = quote_mailbox(destination)
+    method = "move" if client.has_capability('MOVE') else "copy"
+    uidvalidity, mapping = None, {}
+    for uid_set in uid_sets(uids):
+        status, data = await client.uid(method, uid_set, mailbox)
+        if status != 'OK':
+            raise ConnectionError(f"UID {method.upper()} to {destination} failed: {status} {data[-1:] if data else ''}")
+        validity, pairs = parse_copyuid(data)
+        uidvalidity = validity or uidvalidity
+        mapping.update(pairs)
+    if method == "move":
+        return method, uidvalidity, mapping, True
+    return "copy+expunge", uidvalidity, mapping, await expunge(client, uids)
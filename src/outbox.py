@@ -0,0 +1,406 @@
+import asyncio
+import email
+import json
+import logging
+import random
+import sqlite3
+import time
+import uuid
+from email.policy import default
+
+
+try:
+    from src.config import config
+    from src.message_cache import cache_root
+    from src.imap_pool import imap_pool
+    from src.smtp_pool import smtp_pool
+    from src.folder_catalog import folder_catalog
+    from src.metrics import detach
+    from src.utils import quote_mailbox
+except ImportError:
+    from config import config
+    from message_cache import cache_root
+    from imap_pool import imap_pool
+    from smtp_pool import smtp_pool
+    from folder_catalog import folder_catalog
+    from metrics import detach
+    from utils import quote_mailbox
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id              TEXT PRIMARY KEY,
+    account         TEXT NOT NULL,
+    idempotency_key TEXT,
+    raw             BLOB NOT NULL,
+    recipients      TEXT NOT NULL,
+    subject         TEXT,
+    save_to_sent    INTEGER NOT NULL,
+    status          TEXT NOT NULL,
+    attempts        INTEGER NOT NULL DEFAULT 0,
+    next_attempt    REAL NOT NULL,
+    last_error      TEXT,
+    response        TEXT,
+    created_at      REAL NOT NULL,
+    sent_at         REAL,
+    sent_copy       TEXT,
+    UNIQUE (account, idempotency_key)
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt);
+"""
+
+STATUS_FIELDS = ("id", "status", "recipients", "subject", "attempts", "last_error", "response",
+                 "created_at", "next_attempt", "sent_at", "sent_copy")
+
+# Providers that file submitted mail into Sent on their own
+AUTO_SENT_SMTP_HOSTS = ("smtp.gmail.com", "smtp.googlemail.com")
+
+# Max copies appended per IMAP session
+SENT_COPY_BATCH = 50
+# Finished entries older than OUTBOX_RETENTION_DAYS are deleted at most this often
+PRUNE_INTERVAL = 3600.0
+# Pending Sent copies are looked for at least this often, even without a wakeup
+SENT_COPY_POLL_SECONDS = 60.0
+
+
+def server_files_sent_mail(imap_client=None) -> bool:
+    """
+    Whether a copy in Sent would be a duplicate. SAVE_TO_SENT=auto detects
+    Gmail by its SMTP host or, given a client, the X-GM-EXT-1 IMAP capability.
+    """
+    mode = config.SAVE_TO_SENT.lower()
+    if mode in ("always", "never"):
+        return mode == "never"
+    if (config.SMTP_HOST or "").lower() in AUTO_SENT_SMTP_HOSTS:
+        return True
+    return imap_client is not None and imap_client.has_capability('X-GM-EXT-1')
+
+
+def _is_transient(error: Exception) -> bool:
+    """Worth retrying: connection trouble, timeouts and 4xx replies. 5xx and bad addresses are final."""
+    import aiosmtplib
+
+    if isinstance(error, aiosmtplib.SMTPRecipientsRefused):
+        return all(400 <= r.code < 500 for r in error.recipients)
+    if isinstance(error, aiosmtplib.SMTPResponseException):
+        return 400 <= error.code < 500
+    return isinstance(error, (aiosmtplib.SMTPServerDisconnected, aiosmtplib.SMTPConnectError,
+                              aiosmtplib.SMTPTimeoutError, ConnectionError, asyncio.TimeoutError, OSError))
+
+
+async def _wait(event: asyncio.Event, timeout: float | None) -> None:
+    """
+    event.wait() for at most `timeout` seconds. Not wait_for: on Python
+    3.10/3.11 it swallows a cancellation that lands as the event fires,
+    which made stop() hang until the next timeout.
+    """
+    waiter = asyncio.ensure_future(event.wait())
+    try:
+        await asyncio.wait({waiter}, timeout=timeout)
+    finally:
+        waiter.cancel()
+
+
+class Outbox:
+    """
+    Durable outbound queue (SQLite, WAL) drained by background workers.
+
+    send_email only writes the message here and returns its queue id. Workers
+    send due messages through the SMTP pool, retry transient failures with
+    exponential backoff (plus jitter) up to OUTBOX_MAX_ATTEMPTS, and keep the
+    overall rate under OUTBOX_RATE_PER_MINUTE. An idempotency key makes a
+    repeated enqueue return the original entry instead of sending twice.
+
+    The copy to Sent is not part of delivery: delivered entries are marked
+    sent_copy='pending' and a separate task appends them in batches over a
+    pooled IMAP session, or skips them when the provider files sent mail
+    itself (see server_files_sent_mail).
+
+    The raw message is dropped once an entry is delivered and its Sent copy
+    settled; the status row stays for email_status and the idempotency key
+    until OUTBOX_RETENTION_DAYS have passed.
+
+    Delivery is at-least-once: a message that was being sent when the
+    process died is sent again on the next start. Entries belong to the
+    account they were queued under; when configure_email replaces that
+    account, its undelivered ones are cancelled (see cancel_account) rather
+    than sent with someone else's credentials.
+    """
+
+    def __init__(self):
+        self._db: sqlite3.Connection | None = None
+        self._workers: list[asyncio.Task] = []
+        self._wakeup: asyncio.Event | None = None
+        self._copy_wakeup: asyncio.Event | None = None
+        self._rate_lock: asyncio.Lock | None = None
+        self._next_slot = 0.0
+        self._pruned_at = 0.0
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            root = cache_root()
+            root.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(root / 'outbox.sqlite3')
+            self._db.row_factory = sqlite3.Row
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(SCHEMA)
+            columns = {row["name"] for row in self._db.execute("PRAGMA table_info(outbox)")}
+            if "sent_copy" not in columns:
+                self._db.execute("ALTER TABLE outbox ADD COLUMN sent_copy TEXT")
+        return self._db
+
+    @staticmethod
+    def _account() -> str:
+        return config.EMAIL_USER or ""
+
+    def enqueue(self, msg, idempotency_key: str | None = None, save_to_sent: bool = True) -> tuple[str, bool]:
+        """Queue a message. Returns (queue id, created); created is False for a known idempotency key."""
+        account = self._account()
+        if idempotency_key:
+            row = self.db.execute(
+                "SELECT id FROM outbox WHERE account = ? AND idempotency_key = ?", (account, idempotency_key)
+            ).fetchone()
+            if row:
+                return row["id"], False
+
+        self._prune()
+        queue_id = uuid.uuid4().hex
+        recipients = [addr for field in ("To", "Cc", "Bcc") for addr in msg.get_all(field, [])]
+        now = time.time()
+        with self.db:
+            self.db.execute(
+                "INSERT INTO outbox (id, account, idempotency_key, raw, recipients, subject, save_to_sent, "
+                "status, next_attempt, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, 'queued', ?, ?)",
+                (queue_id, account, idempotency_key, msg.as_bytes(), json.dumps([str(r) for r in recipients]),
+                 str(msg.get("Subject", "")), save_to_sent, now, now),
+            )
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return queue_id, True
+
+    def record_sent(self, msg, response: str, save_to_sent: bool = True) -> str:
+        """Log a message that was already delivered elsewhere (send_bulk) so its Sent copy is deferred too."""
+        queue_id, _ = self.enqueue(msg, save_to_sent=save_to_sent)
+        self._mark_sent(queue_id, response, save_to_sent)
+        return queue_id
+
+    def _mark_sent(self, queue_id: str, response: str, save_to_sent: bool) -> None:
+        # Without a Sent copy to make, nothing needs the message any more (raw is NOT NULL, so emptied)
+        with self.db:
+            self.db.execute(
+                "UPDATE outbox SET status = 'sent', response = ?, last_error = NULL, sent_at = ?, sent_copy = ?, "
+                "raw = CASE WHEN ? THEN raw ELSE X'' END WHERE id = ?",
+                (response, time.time(), "pending" if save_to_sent else "skipped", save_to_sent, queue_id),
+            )
+        if save_to_sent and self._copy_wakeup is not None:
+            self._copy_wakeup.set()
+
+    def status(self, queue_id: str | None = None, limit: int = 20) -> list[dict]:
+        """Queue entries of the current account, newest first (or just `queue_id`)."""
+        where, params = "account = ?", [self._account()]
+        if queue_id:
+            where += " AND id = ?"
+            params.append(queue_id)
+        rows = self.db.execute(
+            f"SELECT {', '.join(STATUS_FIELDS)} FROM outbox WHERE {where} ORDER BY created_at DESC LIMIT ?",
+            (*params, limit),
+        ).fetchall()
+        entries = []
+        for row in rows:
+            entry = dict(row)
+            entry["recipients"] = json.loads(entry["recipients"])
+            for field in ("created_at", "next_attempt", "sent_at"):
+                if entry[field] is not None:
+                    entry[field] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(entry[field]))
+            if entry["status"] != "queued":
+                entry.pop("next_attempt")
+            entries.append(entry)
+        return entries
+
+    def ensure_started(self) -> None:
+        """Start the workers (idempotent; needs a running loop)."""
+        self._workers = [task for task in self._workers if not task.done()]
+        if self._workers:
+            return
+        self._wakeup = asyncio.Event()
+        self._copy_wakeup = asyncio.Event()
+        self._copy_wakeup.set()  # copies left 'pending' by a previous process
+        self._rate_lock = asyncio.Lock()
+        # Anything left "sending" by a previous process never got its result recorded
+        with self.db:
+            self.db.execute("UPDATE outbox SET status = 'queued' WHERE status = 'sending'")
+            # Bodies kept by older versions after delivery
+            self.db.execute("UPDATE outbox SET raw = X'' WHERE status = 'sent' "
+                            "AND COALESCE(sent_copy, '') != 'pending' AND raw != X''")
+        self._prune()
+        stranded = self.db.execute(
+            "SELECT COUNT(*) FROM outbox WHERE account != ? AND (status IN ('queued', 'sending') "
+            "OR sent_copy = 'pending')", (self._account(),),
+        ).fetchone()[0]
+        if stranded:
+            logger.warning(f"{stranded} outbox entries belong to another account and won't be processed")
+        self._workers = [asyncio.create_task(self._work(), name=f"outbox:{n}")
+                         for n in range(max(1, config.OUTBOX_WORKERS))]
+        self._workers.append(asyncio.create_task(self._copy_to_sent(), name="outbox:sent-copy"))
+
+    async def stop(self) -> None:
+        workers, self._workers = self._workers, []
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    def _claim(self) -> sqlite3.Row | float | None:
+        """Mark the next due entry as sending and return it, else the time the next one is due."""
+        now = time.time()
+        # No await between SELECT and UPDATE, so workers in this loop can't claim the same row
+        row = self.db.execute(
+            "SELECT * FROM outbox WHERE status = 'queued' AND account = ? ORDER BY next_attempt LIMIT 1",
+            (self._account(),),
+        ).fetchone()
+        if row is None:
+            return None
+        if row["next_attempt"] > now:
+            return row["next_attempt"]
+        with self.db:
+            self.db.execute("UPDATE outbox SET status = 'sending', attempts = attempts + 1 WHERE id = ?", (row["id"],))
+        return row
+
+    async def _throttle(self) -> None:
+        if config.OUTBOX_RATE_PER_MINUTE <= 0:
+            return
+        async with self._rate_lock:
+            delay = self._next_slot - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_slot = max(self._next_slot, time.monotonic()) + 60.0 / config.OUTBOX_RATE_PER_MINUTE
+
+    async def _work(self) -> None:
+        detach()
+        while True:
+            claimed = self._claim()
+            if not isinstance(claimed, sqlite3.Row):
+                timeout = None if claimed is None else max(0.0, claimed - time.time())
+                self._wakeup.clear()
+                await _wait(self._wakeup, timeout)
+                continue
+            try:
+                await self._deliver(claimed)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Outbox worker error on {claimed['id']}: {e}")
+
+    async def _deliver(self, row: sqlite3.Row) -> None:
+        await self._throttle()
+        msg = email.message_from_bytes(row["raw"], policy=default)
+        try:
+            result = (await smtp_pool.send_messages([msg]) or [ConnectionError("SMTP session lost")])[0]
+        except Exception as e:
+            # Couldn't even connect/log in
+            result = e
+
+        if not isinstance(result, Exception):
+            logger.info(f"Outbox {row['id']} delivered")
+            # The Sent copy is a separate job so the worker can move on to the next message
+            self._mark_sent(row["id"], result[1], bool(row["save_to_sent"]) and not server_files_sent_mail())
+            return
+
+        attempts = row["attempts"] + 1
+        if _is_transient(result) and attempts < config.OUTBOX_MAX_ATTEMPTS:
+            delay = min(config.OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1), config.OUTBOX_RETRY_MAX_SECONDS)
+            delay *= random.uniform(0.8, 1.2)
+            logger.warning(f"Outbox {row['id']} attempt {attempts} failed ({result}); retrying in {delay:.0f}s")
+            status, next_attempt = "queued", time.time() + delay
+        else:
+            logger.error(f"Outbox {row['id']} failed permanently: {result}")
+            status, next_attempt = "failed", row["next_attempt"]
+        with self.db:
+            self.db.execute(
+                "UPDATE outbox SET status = ?, next_attempt = ?, last_error = ? WHERE id = ?",
+                (status, next_attempt, str(result), row["id"]),
+            )
+
+    async def _copy_to_sent(self) -> None:
+        """Background job: APPEND pending Sent copies in batches over one pooled IMAP session."""
+        detach()
+        delay = 0.0
+        while True:
+            await _wait(self._copy_wakeup, delay or SENT_COPY_POLL_SECONDS)
+            # Cleared before looking, so a wakeup that comes in while appending isn't lost
+            self._copy_wakeup.clear()
+            rows = self.db.execute(
+                "SELECT id, raw FROM outbox WHERE account = ? AND sent_copy = 'pending' ORDER BY sent_at LIMIT ?",
+                (self._account(), SENT_COPY_BATCH),
+            ).fetchall()
+            if not rows:
+                delay = 0.0
+                continue
+            try:
+                await self._append_copies(rows)
+                delay = 0.0
+                self._copy_wakeup.set()  # there may be more than one batch
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                delay = min(max(delay * 2, config.OUTBOX_RETRY_BASE_SECONDS), config.OUTBOX_RETRY_MAX_SECONDS)
+                logger.warning(f"Saving copies to Sent failed ({e}); retrying in {delay:.0f}s")
+
+    async def _append_copies(self, rows: list[sqlite3.Row]) -> None:
+        async with imap_pool.acquire() as imap_client:
+            if server_files_sent_mail(imap_client):
+                self._set_copy_state([row["id"] for row in rows], "skipped")
+                return
+            # Resolved through the cached folder list (\\Sent attribute first)
+            sent_folder = await folder_catalog.resolve(imap_client, "Sent") or "Sent"
+            for row in rows:
+                # Using None for date_time to avoid type errors observed in testing
+                response = await imap_client.append(row["raw"], mailbox=quote_mailbox(sent_folder), flags=r'(\Seen)', date=None)
+                if response.result != 'OK':
+                    logger.error(f"Outbox {row['id']}: server refused the Sent copy: {response}")
+                self._set_copy_state([row["id"]], "done" if response.result == 'OK' else "failed")
+
+    def _set_copy_state(self, ids: list[str], state: str) -> None:
+        # Done, skipped or refused: the message body has served its purpose either way
+        with self.db:
+            self.db.executemany("UPDATE outbox SET sent_copy = ?, raw = X'' WHERE id = ?",
+                                [(state, queue_id) for queue_id in ids])
+
+    def cancel_account(self, account: str) -> tuple[list[str], list[str]]:
+        """
+        Give up on an account's unfinished entries (its credentials are gone):
+        undelivered ones become 'cancelled', pending Sent copies are dropped.
+        Returns (cancelled queue ids, ids whose Sent copy was dropped).
+        Stop the workers first, so nothing is mid-delivery.
+        """
+        cancelled = [row["id"] for row in self.db.execute(
+            "SELECT id FROM outbox WHERE account = ? AND status IN ('queued', 'sending')", (account,))]
+        copies = [row["id"] for row in self.db.execute(
+            "SELECT id FROM outbox WHERE account = ? AND sent_copy = 'pending'", (account,))]
+        with self.db:
+            self.db.executemany(
+                "UPDATE outbox SET status = 'cancelled', last_error = 'account reconfigured before delivery', "
+                "raw = X'' WHERE id = ?", [(queue_id,) for queue_id in cancelled])
+        self._set_copy_state(copies, "cancelled")
+        if cancelled or copies:
+            logger.warning(f"Outbox: cancelled {len(cancelled)} undelivered emails and {len(copies)} Sent copies "
+                           f"of {account}, which was reconfigured")
+        return cancelled, copies
+
+    def _prune(self) -> None:
+        """Delete finished entries older than OUTBOX_RETENTION_DAYS (at most every PRUNE_INTERVAL)."""
+        now = time.time()
+        if config.OUTBOX_RETENTION_DAYS <= 0 or now - self._pruned_at < PRUNE_INTERVAL:
+            return
+        self._pruned_at = now
+        with self.db:
+            removed = self.db.execute(
+                "DELETE FROM outbox WHERE status IN ('sent', 'failed', 'cancelled') AND COALESCE(sent_copy, '') != 'pending' "
+                "AND created_at < ?", (now - config.OUTBOX_RETENTION_DAYS * 86400,),
+            ).rowcount
+        if removed:
+            logger.info(f"Pruned {removed} outbox entries older than {config.OUTBOX_RETENTION_DAYS:g} days")
+
+
+outbox = Outbox()
@@ -0,0 +1,97 @@
+import asyncio
+import contextvars
+import logging
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from src.config import config
+    from src.metrics import span
+    from src.text_cache import extract_cached, in_worker, parse_and_extract_cached, text_cache
+except ImportError:
+    from config import config
+    from metrics import span
+    from text_cache import extract_cached, in_worker, parse_and_extract_cached, text_cache
+
+logger = logging.getLogger(__name__)
+
+
+class ParsePool:
+    """
+    Runs CPU-bound work (MIME parsing, HTML to text) off the event loop, so
+    one heavy newsletter doesn't stall every other request.
+
+    PARSE_EXECUTOR picks a thread pool (default; frees the loop), a process
+    pool (parses a batch on several cores, at the cost of pickling messages
+    to the workers) or "inline" (the old behaviour). A process pool that
+    breaks is replaced by inline parsing rather than failing the request.
+    """
+
+    def __init__(self):
+        self._executor: Executor | None = None
+        self._kind: str | None = None
+
+    def _get_executor(self) -> Executor | None:
+        kind = config.PARSE_EXECUTOR.lower()
+        if kind == "inline":
+            return None
+        if self._executor is None or self._kind != kind:
+            self.shutdown()
+            workers = config.PARSE_WORKERS or min(4, os.cpu_count() or 1)
+            if kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="parse")
+            self._kind = kind
+        return self._executor
+
+    async def run(self, fn, *args):
+        executor = self._get_executor()
+        if executor is None:
+            return fn(*args)
+        if isinstance(executor, ThreadPoolExecutor):
+            # Carry the caller's context over, so the worker's timings are credited to its tool call
+            call = contextvars.copy_context().run
+        else:
+            # The worker's text cache is its own; its hits and misses come back with the result
+            call = in_worker
+        try:
+            # Includes the wait for a free worker
+            with span("parse_pool"):
+                result = await asyncio.get_running_loop().run_in_executor(executor, call, fn, *args)
+        except BrokenProcessPool as e:
+            logger.warning(f"Parse worker died ({e}); parsing inline")
+            self.shutdown()
+            return fn(*args)
+        if call is in_worker:
+            result, counts = result
+            text_cache.add_worker_counts(*counts)
+        return result
+
+    async def extract_bodies(self, items: list[tuple[bytes | None, object]],
+                             max_bytes: int | None) -> list[tuple[object, str]]:
+        """
+        Body text for a batch of (raw message, parsed message) pairs; raw ones
+        are parsed too. Returns (parsed message, body) per item, in order, with
+        the batch spread over the pool's workers.
+        """
+        parser = config.HTML_PARSER
+
+        async def one(raw, msg):
+            if msg is None:
+                return await self.run(parse_and_extract_cached, raw, max_bytes, parser)
+            return msg, await self.run(extract_cached, msg, max_bytes, parser)
+
+        return await asyncio.gather(*(one(raw, msg) for raw, msg in items))
+
+    async def extract_body(self, raw: bytes | None, msg, max_bytes: int | None) -> tuple[object, str]:
+        return (await self.extract_bodies([(raw, msg)], max_bytes))[0]
+
+    def shutdown(self) -> None:
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+parse_pool = ParsePool()
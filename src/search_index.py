@@ -0,0 +1,177 @@
+import logging
+import re
+import sqlite3
+from datetime import datetime, timezone
+
+try:
+    from src.config import config
+    from src.message_cache import cache_root
+    from src.utils import date_timestamp
+except ImportError:
+    from config import config
+    from message_cache import cache_root
+    from utils import date_timestamp
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id          INTEGER PRIMARY KEY,
+    account     TEXT NOT NULL,
+    folder      TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    uid         INTEGER NOT NULL,
+    sender      TEXT,
+    subject     TEXT,
+    date        TEXT,
+    date_ts     REAL,
+    has_body    INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (account, folder, uidvalidity, uid)
+);
+CREATE INDEX IF NOT EXISTS messages_date ON messages (account, date_ts);
+CREATE VIRTUAL TABLE IF NOT EXISTS fts USING fts5(sender, recipients, subject, body, tokenize = 'unicode61 remove_diacritics 2');
+"""
+
+# bm25 column weights: sender, recipients, subject, body
+RANK = "bm25(fts, 4.0, 2.0, 8.0, 1.0)"
+
+FIELD_COLUMNS = {"sender": "sender", "to": "recipients", "subject": "subject"}
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _match_terms(text: str, column: str | None = None) -> list[str]:
+    # Quote every token so user input can never be parsed as FTS5 syntax
+    prefix = f"{column} : " if column else ""
+    return [f'{prefix}"{token}"' for token in TOKEN_RE.findall(text)]
+
+
+def _parse_day(value: str) -> float:
+    return datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+
+
+class SearchIndex:
+    """
+    Local SQLite FTS5 index over the mail this server has seen.
+
+    Headers are added as soon as the header index (folder_sync) learns about
+    a message; the body text is added once the message has been downloaded
+    (read_email, list_emails with bodies, IDLE prefetch). Entries follow the
+    header index, so UIDVALIDITY resets and expunges remove them too.
+    """
+
+    def __init__(self):
+        self._db: sqlite3.Connection | None = None
+        self._available: bool | None = None
+
+    @property
+    def enabled(self) -> bool:
+        if not config.SEARCH_INDEX_ENABLED:
+            return False
+        if self._available is None:
+            try:
+                self.db
+                self._available = True
+            except sqlite3.OperationalError as e:
+                # Some minimal SQLite builds ship without FTS5
+                logger.warning(f"Full-text search disabled: {e}")
+                self._available = False
+        return self._available
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            root = cache_root()
+            root.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(root / 'search.sqlite3')
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+            self._db = db
+        return self._db
+
+    @staticmethod
+    def _account() -> str:
+        return config.EMAIL_USER or ""
+
+    def add(self, folder: str, uidvalidity: int | None, uid: int, msg, body: str | None = None) -> None:
+        """Index a message's headers, plus its body text when given. Already indexed bodies are kept."""
+        if uidvalidity is None or not self.enabled:
+            return
+        account = self._account()
+        row = self.db.execute(
+            "SELECT id, has_body FROM messages WHERE account = ? AND folder = ? AND uidvalidity = ? AND uid = ?",
+            (account, folder, uidvalidity, uid),
+        ).fetchone()
+        if row and (row[1] or body is None):
+            return
+
+        sender = str(msg.get("from", "Unknown"))
+        subject = str(msg.get("subject", "No Subject"))
+        date = str(msg.get("date", "Unknown"))
+        recipients = " ".join(str(msg.get(h, "")) for h in ("to", "cc"))
+        with self.db:
+            if row:
+                self.db.execute("DELETE FROM fts WHERE rowid = ?", (row[0],))
+                self.db.execute("DELETE FROM messages WHERE id = ?", (row[0],))
+            cursor = self.db.execute(
+                "INSERT INTO messages (account, folder, uidvalidity, uid, sender, subject, date, date_ts, has_body) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (account, folder, uidvalidity, uid, sender, subject, date, date_timestamp(date), body is not None),
+            )
+            self.db.execute(
+                "INSERT INTO fts (rowid, sender, recipients, subject, body) VALUES (?, ?, ?, ?, ?)",
+                (cursor.lastrowid, sender, recipients, subject, body or ""),
+            )
+
+    def remove(self, folder: str, uidvalidity: int | None = None, uids: list[int] | None = None) -> None:
+        """Drop a folder's entries: all of them, those not under `uidvalidity`, or just `uids`."""
+        if not self.enabled:
+            return
+        where, params = "account = ? AND folder = ?", [self._account(), folder]
+        if uids is not None:
+            where += f" AND uidvalidity = ? AND uid IN ({','.join('?' * len(uids))})"
+            params += [uidvalidity, *uids]
+        elif uidvalidity is not None:
+            where += " AND uidvalidity != ?"
+            params.append(uidvalidity)
+        with self.db:
+            self.db.execute(f"DELETE FROM fts WHERE rowid IN (SELECT id FROM messages WHERE {where})", params)
+            self.db.execute(f"DELETE FROM messages WHERE {where}", params)
+
+    def search(self, query: str = "", folder: str | None = None, sender: str | None = None, to: str | None = None,
+               subject: str | None = None, since: str | None = None, before: str | None = None,
+               limit: int = 20) -> list[dict]:
+        terms = _match_terms(query)
+        for field, value in (("sender", sender), ("to", to), ("subject", subject)):
+            if value:
+                terms += _match_terms(value, FIELD_COLUMNS[field])
+
+        where, params = ["m.account = ?"], [self._account()]
+        if folder:
+            where.append("m.folder = ?")
+            params.append(folder)
+        if since:
+            where.append("m.date_ts >= ?")
+            params.append(_parse_day(since))
+        if before:
+            where.append("m.date_ts < ?")
+            params.append(_parse_day(before))
+
+        if terms:
+            sql = (f"SELECT m.folder, m.uidvalidity, m.uid, m.sender, m.subject, m.date, "
+                   f"snippet(fts, 3, '**', '**', '...', 12) FROM fts JOIN messages m ON m.id = fts.rowid "
+                   f"WHERE fts MATCH ? AND {' AND '.join(where)} ORDER BY {RANK} LIMIT ?")
+            params = [" ".join(terms), *params]
+        else:
+            # Only filters: newest first
+            sql = (f"SELECT m.folder, m.uidvalidity, m.uid, m.sender, m.subject, m.date, '' FROM messages m "
+                   f"WHERE {' AND '.join(where)} ORDER BY m.date_ts DESC LIMIT ?")
+        rows = self.db.execute(sql, (*params, limit)).fetchall()
+        return [
+            {"id": str(uid), "folder": folder, "uidvalidity": uidvalidity,
+             "sender": sender, "subject": subject, "date": date, "snippet": snippet}
+            for folder, uidvalidity, uid, sender, subject, date, snippet in rows
+        ]
+
+
+search_index = SearchIndex()
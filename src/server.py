@@ -1,13 +1,12 @@
 import asyncio
-import ssl
 import re
+from functools import partial
 import logging
 import time
-import aiosmtplib
-import aioimaplib
 import secrets
+from datetime import date, timedelta
 from pathlib import Path
-from starlette.responses import HTMLResponse, JSONResponse
+from starlette.responses import HTMLResponse, JSONResponse, Response
 
 from starlette.requests import Request
 from starlette.applications import Starlette
@@ -24,11 +23,51 @@ from email.mime.multipart import MIMEMultipart
 import email
 
 try:
-    from src.config import config
-    from src.utils import find_folder, extract_email_body, parse_folder_line, check_attachment
+    from src.config import config, DEFAULT_ACCOUNT
+    from src.utils import (
+        check_attachment, quote_mailbox,
+        chunked, to_sequence_set, parse_fetch_response, fetch_literal,
+        encode_cursor, decode_cursor, fetch_message_texts,
+    )
+    from src.imap_pool import imap_pool
+    from src.smtp_pool import smtp_pool
+    from src.outbox import outbox, server_files_sent_mail
+    from src.folder_catalog import folder_catalog, select_folder
+    from src.message_cache import message_cache
+    from src.folder_sync import folder_sync, header_fields, HEADER_FIELDS
+    from src.idle_watcher import idle_watcher
+    from src.search_index import search_index
+    from src.parse_pool import parse_pool
+    from src.text_cache import text_cache
+    from src.fanout import fan_out, merge_newest
+    from src.mail_filter import MailFilter
+    from src.attachments import attachment_parts, decoded_size, fetch_parts, save_part, spool_path
+    from src.threader import collect_thread, jwz_thread
+    from src.metrics import CONTENT_TYPE, count_cache, metrics, timed_tool
+    from src import mutations
 except ImportError:
-    from config import config
-    from utils import find_folder, extract_email_body, parse_folder_line, check_attachment
+    from config import config, DEFAULT_ACCOUNT
+    from utils import (
+        check_attachment, quote_mailbox,
+        chunked, to_sequence_set, parse_fetch_response, fetch_literal,
+        encode_cursor, decode_cursor, fetch_message_texts,
+    )
+    from imap_pool import imap_pool
+    from smtp_pool import smtp_pool
+    from outbox import outbox, server_files_sent_mail
+    from folder_catalog import folder_catalog, select_folder
+    from message_cache import message_cache
+    from folder_sync import folder_sync, header_fields, HEADER_FIELDS
+    from idle_watcher import idle_watcher
+    from search_index import search_index
+    from parse_pool import parse_pool
+    from text_cache import text_cache
+    from fanout import fan_out, merge_newest
+    from mail_filter import MailFilter
+    from attachments import attachment_parts, decoded_size, fetch_parts, save_part, spool_path
+    from threader import collect_thread, jwz_thread
+    from metrics import CONTENT_TYPE, count_cache, metrics, timed_tool
+    import mutations
 
 # Initialize FastMCP Server
 mcp = FastMCP("Custom Email MCP")
@@ -48,6 +87,7 @@ def get_setup_url() -> str:
     return f"{base_url.rstrip('/')}/setup?token={SETUP_TOKEN}"
 
 @mcp.tool()
+@timed_tool
 async def get_configuration_link() -> str:
     """
     Returns a secure link to configure the server via browser.
@@ -116,6 +156,7 @@ async def handle_setup(request: Request):
         return HTMLResponse(f"<h1>Error</h1><p>{e}</p>", status_code=500)
 
 @mcp.tool()
+@timed_tool
 async def configure_email(
     email_user: str, 
     email_pass: str, 
@@ -129,12 +170,31 @@ async def configure_email(
     This is persistent and saves to a file on the server.
     """
     try:
+        previous_user = config.EMAIL_USER if config.is_configured else None
+        # No delivery in flight while the credentials change
+        await outbox.stop()
         config.save_to_file(smtp_host, smtp_port, imap_host, imap_port, email_user, email_pass)
-        return "✅ Configuration saved successfully. You can now use email tools."
+        # Sessions logged in with the old credentials are useless now
+        await imap_pool.close_all()
+        await smtp_pool.close_all()
+        await idle_watcher.stop()
+        folder_catalog.invalidate()
+
+        note = ""
+        if previous_user and previous_user != email_user:
+            # Their queue would never be processed again (workers only take the current account's)
+            cancelled, copies = outbox.cancel_account(previous_user)
+            if cancelled:
+                note += f"\n⚠️ Cancelled {len(cancelled)} undelivered emails queued by {previous_user}: {', '.join(cancelled)}"
+            if copies:
+                note += f"\n⚠️ {len(copies)} sent emails of {previous_user} were not saved to its Sent folder."
+        outbox.ensure_started()
+        return "✅ Configuration saved successfully. You can now use email tools." + note
     except Exception as e:
         return f"❌ Failed to save configuration: {e}"
 
 @mcp.tool()
+@timed_tool
 async def check_connection() -> dict:
     """
     Validates the ability to connect and authenticate with both SMTP and IMAP servers.
@@ -152,16 +212,9 @@ async def check_connection() -> dict:
     try:
         logger.info(f"Connecting to SMTP: {config.SMTP_HOST}:{config.SMTP_PORT}")
         
-        use_tls = config.SMTP_PORT == 465
-        
-        smtp_client = aiosmtplib.SMTP(hostname=config.SMTP_HOST, port=config.SMTP_PORT, use_tls=use_tls)
-        await smtp_client.connect()
-        
-        if not use_tls:
-            await smtp_client.starttls()
-
-        await smtp_client.login(config.EMAIL_USER, config.EMAIL_PASS)
-        await smtp_client.quit()
+        # Borrowing a pooled session logs in (or RSETs a live one)
+        async with smtp_pool.acquire():
+            pass
         results["smtp"]["status"] = "success"
         results["smtp"]["message"] = "Authenticated successfully"
     except Exception as e:
@@ -169,22 +222,17 @@ async def check_connection() -> dict:
         results["smtp"]["status"] = "failed"
         results["smtp"]["error"] = str(e)
 
-    # Check IMAP
+    # Check IMAP (borrowing a pooled session proves the credentials work)
     try:
         logger.info(f"Connecting to IMAP: {config.IMAP_HOST}:{config.IMAP_PORT}")
-        ssl_context = ssl.create_default_context()
-        imap_client = aioimaplib.IMAP4_SSL(host=config.IMAP_HOST, port=config.IMAP_PORT, ssl_context=ssl_context)
-        await imap_client.wait_hello_from_server()
-        
-        login_response = await imap_client.login(config.EMAIL_USER, config.EMAIL_PASS)
-        if login_response.result == 'OK':
+        async with imap_pool.acquire() as imap_client:
+            noop_response = await imap_client.noop()
+        if noop_response.result == 'OK':
              results["imap"]["status"] = "success"
              results["imap"]["message"] = "Authenticated successfully"
         else:
              results["imap"]["status"] = "failed"
-             results["imap"]["error"] = f"Login failed: {login_response}"
-        
-        await imap_client.logout()
+             results["imap"]["error"] = f"NOOP failed: {noop_response}"
 
     except Exception as e:
         logger.error(f"IMAP Error: {e}")
@@ -194,44 +242,49 @@ async def check_connection() -> dict:
     return results
 
 @mcp.tool()
-async def list_folders() -> list[dict]:
+@timed_tool
+async def cache_stats() -> dict:
+    """
+    Reports how well the local caches are doing. 'html_to_text' counts hits
+    and misses of the memoized HTML conversion (process pool workers
+    included).
+    """
+    return {"html_to_text": text_cache.stats()}
+
+@mcp.tool()
+@timed_tool
+async def list_folders(refresh: bool = False) -> list[dict]:
     """
     Lists all available IMAP folders/mailboxes on the email server.
     
+    Args:
+        refresh: If True, ask the server again instead of using the cached
+            folder list (e.g. right after a folder was created elsewhere).
+
     Returns:
         List of dictionaries containing 'name' and 'flags' for each folder.
+        Special-use flags such as \\Sent or \\Drafts mark the well-known folders.
     """
     if not config.is_configured:
         return [{"error": f"Server not configured. Configure at {get_setup_url()} or use `configure_email`."}]
 
     try:
-        ssl_context = ssl.create_default_context()
-        client = aioimaplib.IMAP4_SSL(host=config.IMAP_HOST, port=config.IMAP_PORT, ssl_context=ssl_context)
-        await client.wait_hello_from_server()
-        await client.login(config.EMAIL_USER, config.EMAIL_PASS)
-        
-        # List all folders
-        status, folders_data = await client.list('""', '*')
-        
-        folders = []
-        if status == 'OK':
-
-            for folder_line in folders_data:
-                parsed = parse_folder_line(folder_line)
-                if parsed:
-                    folders.append(parsed)
-        
-        await client.logout()
-        return folders
+        async with imap_pool.acquire() as client:
+            folders = await folder_catalog.get(client, refresh=refresh)
+        return [dict(folder) for folder in folders]
         
     except Exception as e:
         logger.error(f"List Folders Error: {e}")
         return [{"error": str(e)}]
 
 @mcp.tool()
-async def list_emails(folder: str = "INBOX", limit: int = 10, sender: str | None = None, to: str | None = None, include_body: bool = False) -> list[dict]:
+@timed_tool
+async def list_emails(folder: str = "INBOX", limit: int = 10, sender: str | None = None, to: str | None = None, include_body: bool = False, cursor: str | None = None, body_max_bytes: int | None = None,
+                      folders: list[str] | None = None, accounts: list[str] | None = None,
+                      since: str | None = None, before: str | None = None, unread: bool | None = None,
+                      flagged: bool | None = None, min_size: int | None = None, gmail_query: str | None = None) -> dict:
     """
-    Fetches email metadata from a specific folder.
+    Fetches email metadata from a specific folder, one page at a time.
     
     Args:
         folder: The folder to search (default="INBOX")
@@ -239,179 +292,395 @@ async def list_emails(folder: str = "INBOX", limit: int = 10, sender: str | None
         sender: Optional sender email address to filter by (FROM "email").
         to: Optional recipient email address to filter by (TO "email").
         include_body: If True, fetches and returns the full email body for each email.
+        cursor: The 'next_cursor' from a previous call to get the next (older)
+            page. Use the same folder and filters as the call that returned it.
+        body_max_bytes: Optional cap on each body when include_body is set,
+            e.g. 500 for short previews (default: BODY_MAX_BYTES).
+        folders: Optional list of folders to list together, e.g. ["INBOX", "Sent"]
+            (replaces `folder`). The results are merged newest first.
+        accounts: Optional list of account names (see accounts.json) to list
+            across, e.g. ["default", "work"].
+        since: Optional start date (YYYY-MM-DD, inclusive, by the Date header).
+        before: Optional end date (YYYY-MM-DD, exclusive).
+        unread: Optional; True for unread emails only, False for read ones only.
+        flagged: Optional; True for flagged (starred) emails only, False for unflagged.
+        min_size: Optional minimum size in bytes (e.g. 1000000 for big attachments).
+        gmail_query: Optional Gmail search, e.g. "has:attachment newer_than:2d"
+            (Gmail accounts only).
+
+    All filters are combined (AND) into one server-side search, so only
+    matching emails are fetched; there is no need to over-fetch and filter.
+
+    Returns:
+        Dictionary with 'emails' (newest first) and 'next_cursor' (None when
+        there are no older emails). Each email is addressed by the stable
+        handle ('folder', 'uidvalidity', 'id') where 'id' is the message UID.
+        Multi-folder/account listings also add 'account' to each email and
+        report unreachable folders under 'errors'.
     """
     if not config.is_configured:
-        return [{"error": f"Server not configured. Configure at {get_setup_url()} or use `configure_email`."}]
+        return {"error": f"Server not configured. Configure at {get_setup_url()} or use `configure_email`."}
 
+    idle_watcher.ensure_started()
+    max_body = body_max_bytes or config.BODY_MAX_BYTES or None
     try:
-        ssl_context = ssl.create_default_context()
-        client = aioimaplib.IMAP4_SSL(host=config.IMAP_HOST, port=config.IMAP_PORT, ssl_context=ssl_context)
-        await client.wait_hello_from_server()
-        
-        await client.login(config.EMAIL_USER, config.EMAIL_PASS)
-        
+        filters = MailFilter(sender, to, since, before, unread, flagged, min_size, gmail_query)
+    except ValueError as e:
+        return {"error": str(e)}
+    try:
+        page = decode_cursor(cursor)
+        if folders or accounts or "sources" in page:
+            return await _list_many(folders or [folder], accounts or [DEFAULT_ACCOUNT], limit, filters,
+                                    include_body, page, max_body)
+        return await _list_folder(folder, limit, filters, include_body, page, max_body)
+    except Exception as e:
+        logger.error(f"List Emails Error: {e}")
+        return {"error": str(e)}
+
+
+async def _list_folder(folder: str, limit: int, filters: MailFilter, include_body: bool,
+                       page: dict, max_body: int | None) -> dict:
+    """One page of one folder of the current account (see list_emails)."""
+    if not include_body:
+        local = _list_from_index(folder, limit, filters, page)
+        count_cache("header_index", hits=local is not None, misses=local is None)
+        if local is not None:
+            return local
+
+    async with imap_pool.acquire() as client:
         # Select folder logic
-        res = await client.select(folder)
-        if res.result != 'OK':
-             candidates = [folder]
-             if folder.lower() in ["sent", "sent items", "sent mail"]:
-                 candidates = ["Sent Mail", "Sent", "Sent Items", "INBOX.Sent", "[Gmail]/Sent Mail"]
-             elif folder.lower() in ["drafts", "draft"]:
-                 candidates = ["Drafts", "Draft", "INBOX.Drafts", "[Gmail]/Drafts"]
-             elif folder.lower() in ["trash", "bin", "deleted items"]:
-                 candidates = ["Trash", "Bin", "Deleted Items", "[Gmail]/Trash"]
-             elif folder.lower() in ["junk", "spam"]:
-                 candidates = ["Junk", "Spam", "Junk E-mail", "[Gmail]/Spam"]
-                 
-             real_folder = await find_folder(client, candidates)
-             res = await client.select(real_folder)
-             if res.result != 'OK':
-                  await client.logout()
-                  return [{"error": f"Folder {folder} not found"}]
-
-        # Build Query
-        query_parts = []
-        if sender:
-            query_parts.append(f'(FROM "{sender}")')
-        if to:
-            query_parts.append(f'(TO "{to}")')
-        
-        # If no specific filters, default to ALL
-        if not query_parts:
-            query_str = "ALL"
+        real_folder, folder_info = await select_folder(client, folder)
+        if real_folder is None:
+            return {"error": f"Folder {folder} not found"}
+        if filters.gmail_query and not client.has_capability('X-GM-EXT-1'):
+            return {"error": "gmail_query needs a Gmail account (X-GM-RAW is not supported by this server)"}
+
+        uidvalidity = folder_info.get("uidvalidity")
+        # A page is "everything older than UID `before`"; UIDs never get reused
+        # within a UIDVALIDITY, so the cursor stays valid while mail arrives
+        before = None
+        if page:
+            if page.get("folder") != real_folder or page.get("query") != filters.key():
+                return {"error": "Cursor belongs to a different folder or filter"}
+            if page.get("uidvalidity") != uidvalidity:
+                return {"error": f"Folder {real_folder} was rebuilt on the server (UIDVALIDITY changed); list again without a cursor"}
+            before = int(page["before"])
+
+        indexed = {}
+        has_more = False
+        index_page = None
+        if uidvalidity is not None:
+            # Listings come from the local header index, which only pulls what
+            # changed since the last sync instead of SEARCH ALL
+            state = await folder_sync.sync(client, real_folder, folder_info)
+            if state is not None and not filters:
+                newer = folder_sync.count_from(real_folder, uidvalidity, before) if before else 0
+                # The index is contiguous from the top, so this backfills exactly one page
+                await folder_sync.ensure_depth(client, real_folder, folder_info, newer + limit)
+            if state is not None:
+                index_page = _index_page(real_folder, state, before, limit, filters)
+        if index_page is not None:
+            rows, has_more = index_page
+            indexed = {row["uid"]: row for row in rows}
+            recent_uids = list(indexed)
         else:
-            query_str = " ".join(query_parts)
-        
-        logger.info(f"Searching in {folder} with query: {query_str}")
-        status, data = await client.search(query_str)
-        if status != 'OK':
-             await client.logout()
-             return [{"error": f"Search failed: {status}"}]
+            # Every filter in one SEARCH, so only matching UIDs are ever fetched
+            query_str = filters.criteria(before)
+            logger.info(f"Searching in {real_folder} with query: {query_str}")
+            status, data = await client.uid_search(query_str)
+            if status != 'OK':
+                 return {"error": f"Search failed: {status}"}
 
-        # Get the list of email IDs
-        email_ids = data[0].split()
-        
-        # Taking the last 'limit' emails (most recent if server appends new ones at end)
-        start_index = max(0, len(email_ids) - limit)
-        recent_ids = email_ids[start_index:]
-        
-        # Inverse to show newest first
-        recent_ids.reverse()
+            # UIDs are strictly ascending in arrival order, so the last ones are the newest
+            email_uids = [int(uid) for uid in data[0].split()]
+            if before:
+                # Ranges are unordered in IMAP; don't trust the server to clip them
+                email_uids = [uid for uid in email_uids if uid < before]
+            start_index = max(0, len(email_uids) - limit)
+            recent_uids = email_uids[start_index:]
+            has_more = start_index > 0
+    
+            # Inverse to show newest first
+            recent_uids = list(reversed(recent_uids))
 
-        emails = []
-        for e_id in recent_ids:
-            # Decode bytes to string for fetch command
-            e_id_str = e_id.decode() if isinstance(e_id, bytes) else str(e_id)
-            
-            if include_body:
-                # Fetch full content if requested
-                status, info = await client.fetch(e_id_str, '(RFC822)')
-                if status == 'OK':
-                    raw_email = b""
-                    for part in info:
-                         if isinstance(part, (bytes, bytearray)):
-                             part_bytes = bytes(part)
-                             if b"RFC822" in part_bytes and part_bytes.strip().endswith(b"}"):
-                                 continue
-                             if part_bytes.strip() == b")":
-                                 continue
-                             raw_email += part_bytes
-                    
-                    msg = email.message_from_bytes(raw_email, policy=default)
-                    subject = msg.get("subject", "No Subject")
-                    sender_val = msg.get("from", "Unknown")
-                    date = msg.get("date", "Unknown")
-                    body = extract_email_body(msg)
-                    
-                    emails.append({
-                        "id": e_id_str,
-                        "sender": str(sender_val),
-                        "subject": str(subject),
-                        "date": str(date),
-                        "body": body
-                    })
+        records = {}
+        parsed = {}
+        if include_body:
+            parsed = await _fetch_bodies(client, real_folder, uidvalidity, recent_uids, max_body)
+        else:
+            # One UID FETCH per chunk of messages instead of one round trip per message
+            to_fetch = [uid for uid in recent_uids if uid not in indexed]
+            for chunk in chunked(to_fetch, config.IMAP_FETCH_BATCH_SIZE):
+                status, info = await client.uid('fetch', to_sequence_set(chunk), '(BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE)])')
+                if status != 'OK':
+                    logger.warning(f"Batch fetch failed for {len(chunk)} messages: {status}")
+                    continue
+                for record in parse_fetch_response(info):
+                    if "UID" in record:
+                        records[int(record["UID"])] = record
+
+    emails = []
+    for uid in recent_uids:
+        record = records.get(uid)
+        if not include_body and uid in indexed:
+            emails.append(_index_item(real_folder, uidvalidity, indexed[uid]))
+            continue
+        if include_body:
+            if uid in parsed:
+                msg, body = parsed[uid]
             else:
-                # Fetch only headers (original behavior)
-                status, info = await client.fetch(e_id_str, '(BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE)])')
-                
-                if status == 'OK':
-                    raw_header = b""
-                    if len(info) >= 2:
-                        header_data = info[1]
-                        if isinstance(header_data, (bytes, bytearray)):
-                            raw_header = bytes(header_data)
-                    
-                    msg = email.message_from_bytes(raw_header, policy=default)
-                    
-                    subject = msg.get("subject", "No Subject")
-                    sender_val = msg.get("from", "Unknown")
-                    date = msg.get("date", "Unknown")
-                    
-                    emails.append({
-                        "id": e_id_str,
-                        "sender": str(sender_val),
-                        "subject": str(subject),
-                        "date": str(date)
-                    })
-
-        await client.logout()
-        return emails
+                continue
+        elif record is None:
+            continue
+        else:
+            msg = email.message_from_bytes(fetch_literal(record, "BODY[HEADER"), policy=default)
 
-    except Exception as e:
-        logger.error(f"List Emails Error: {e}")
-        return [{"error": str(e)}]
+        item = {
+            "id": str(uid),
+            "folder": real_folder,
+            "uidvalidity": uidvalidity,
+            "sender": str(msg.get("from", "Unknown")),
+            "subject": str(msg.get("subject", "No Subject")),
+            "date": str(msg.get("date", "Unknown"))
+        }
+        if include_body:
+            item["body"] = body
+        emails.append(item)
+
+    return {"emails": emails, "next_cursor": _page_cursor(real_folder, uidvalidity, recent_uids, has_more, filters)}
+
+
+async def _fetch_bodies(client, real_folder: str, uidvalidity: int | None, uids: list[int],
+                        max_body: int | None) -> dict[int, tuple[object, str]]:
+    """
+    {uid: (parsed message, body text)} for messages of the selected folder:
+    cached ones from disk, the rest in one batched fetch of their text parts
+    (BODY.PEEK, so nothing is marked read). Parsing runs on the parse pool.
+    """
+    # Full messages we already have on disk don't need to be fetched again
+    message_cache.check_uidvalidity(real_folder, uidvalidity)
+    cached = message_cache.get_many(real_folder, uidvalidity, uids)
+    to_fetch = [uid for uid in uids if uid not in cached]
+    fetched = await fetch_message_texts(client, to_fetch, max_body, config.IMAP_FETCH_BATCH_SIZE)
+
+    sources = {uid: (cached[uid], None) if uid in cached else fetched[uid]
+               for uid in uids if uid in cached or uid in fetched}
+    results = dict(zip(sources, await parse_pool.extract_bodies(list(sources.values()), max_body)))
+    for uid, (msg, body) in results.items():
+        raw_email = fetched.get(uid, (None, None))[0]
+        if raw_email:
+            message_cache.put(real_folder, uidvalidity, uid, raw_email, msg)
+        search_index.add(real_folder, uidvalidity, uid, msg, body)
+    return results
+
+
+def _index_page(real_folder: str, state, before: int | None, limit: int,
+                filters: MailFilter) -> tuple[list[dict], bool] | None:
+    """(rows, has_more) straight from the header index, or None if the index doesn't hold that page."""
+    uidvalidity = state.uidvalidity
+    if filters:
+        # Filters need every message indexed (the index only grows back as far as someone listed)
+        if not filters.local or not folder_sync.is_complete(real_folder, state):
+            return None
+        # Without CONDSTORE a sync whose UIDNEXT/EXISTS didn't move skips the flags, so
+        # another client's reads wouldn't show; the server's SEARCH UNSEEN/FLAGGED is exact
+        if filters.by_flags and state.highestmodseq is None:
+            return None
+        rows = (folder_sync.before(real_folder, uidvalidity, before, limit + 1, filters) if before
+                else folder_sync.latest(real_folder, uidvalidity, limit + 1, filters))
+        return rows[:limit], len(rows) > limit
+    newer = folder_sync.count_from(real_folder, uidvalidity, before) if before else 0
+    rows = (folder_sync.before(real_folder, uidvalidity, before, limit) if before
+            else folder_sync.latest(real_folder, uidvalidity, limit))
+    has_more = newer + len(rows) < state.exists_count
+    if len(rows) < limit and has_more:
+        return None  # not backfilled that far yet
+    return rows, has_more
+
+
+def _list_from_index(folder: str, limit: int, filters: MailFilter, page: dict) -> dict | None:
+    """
+    A page without any IMAP traffic, when the folder's index is known to be
+    current: it is watched with IDLE, or was synced less than
+    HEADER_INDEX_MAX_AGE seconds ago. None means "ask the server".
+    """
+    # Sync state is only ever saved under real folder names, so an exact name needs no LIST
+    real_folder = folder_catalog.lookup(folder) or idle_watcher.resolved.get(folder) or folder
+    state = folder_sync.get_state(real_folder)
+    if state is None or not (idle_watcher.is_live(real_folder) or folder_sync.is_fresh(state)):
+        return None
+    before = None
+    if page:
+        if page.get("folder") != real_folder or page.get("query") != filters.key() \
+                or page.get("uidvalidity") != state.uidvalidity:
+            return None  # let the server path report it
+        before = int(page["before"])
+    index_page = _index_page(real_folder, state, before, limit, filters)
+    if index_page is None:
+        return None
+    rows, has_more = index_page
+    return {
+        "emails": [_index_item(real_folder, state.uidvalidity, row) for row in rows],
+        "next_cursor": _page_cursor(real_folder, state.uidvalidity, [row["uid"] for row in rows], has_more, filters),
+    }
+
+
+def _index_item(real_folder: str, uidvalidity: int, row: dict) -> dict:
+    return {
+        "id": str(row["uid"]),
+        "folder": real_folder,
+        "uidvalidity": uidvalidity,
+        "sender": row["sender"],
+        "subject": row["subject"],
+        "date": row["date"]
+    }
+
+
+def _page_cursor(real_folder: str, uidvalidity: int | None, uids: list[int], has_more: bool,
+                 filters: MailFilter) -> str | None:
+    if not (has_more and uids):
+        return None
+    return encode_cursor({
+        "folder": real_folder, "uidvalidity": uidvalidity,
+        "before": min(uids), "query": filters.key(),
+    })
+
+
+async def _list_many(folders: list[str], accounts: list[str], limit: int, filters: MailFilter,
+                     include_body: bool, page: dict, max_body: int | None) -> dict:
+    """
+    list_emails over several folders/accounts. Every source is listed
+    concurrently (bounded by FANOUT_CONCURRENCY) and the pages are heap-merged
+    by date, so a call costs about as much as the slowest folder. The cursor
+    keeps one position per source.
+    """
+    if page:
+        if page.get("query") != filters.key():
+            return {"error": "Cursor belongs to a different filter"}
+        sources = page.get("sources") or []
+    else:
+        unknown = [account for account in accounts if account not in config.account_names()]
+        if unknown:
+            return {"error": f"Unknown account(s): {', '.join(unknown)}"}
+        sources = [[account, name, {}] for account in dict.fromkeys(accounts) for name in dict.fromkeys(folders)]
+
+    # Headers first (usually straight from the index): any source could supply the whole page
+    results = await fan_out([
+        (account, partial(_list_folder, name, limit, filters, False, position, max_body))
+        for account, name, position in sources
+    ])
+
+    pages, errors = [], []
+    for (account, name, _), result in zip(sources, results):
+        if isinstance(result, Exception) or "error" in result:
+            errors.append({"account": account, "folder": name, "error": str(result.get("error") if isinstance(result, dict) else result)})
+            pages.append([])
+            continue
+        for item in result["emails"]:
+            item["account"] = account
+        pages.append(result["emails"])
+    merged = merge_newest(pages, limit)
+    chosen = {id(item) for item in merged}
+
+    remaining, body_jobs = [], []
+    for (account, name, position), result, items in zip(sources, results, pages):
+        taken = [item for item in items if id(item) in chosen]  # always a prefix of the source's page
+        if isinstance(result, Exception) or "error" in result:
+            remaining.append([account, name, position])
+            continue
+        if taken and include_body:
+            # Exactly the same UIDs again, this time with bodies
+            newest = {"folder": taken[0]["folder"], "uidvalidity": taken[0]["uidvalidity"],
+                      "before": int(taken[0]["id"]) + 1, "query": filters.key()}
+            body_jobs.append((account, partial(_list_folder, name, len(taken), filters, True, newest, max_body)))
+        if len(taken) == len(items) and result["next_cursor"] is None:
+            continue  # exhausted
+        if taken:
+            position = {"folder": taken[-1]["folder"], "uidvalidity": taken[-1]["uidvalidity"],
+                        "before": int(taken[-1]["id"]), "query": filters.key()}
+        remaining.append([account, name, position])
+
+    if body_jobs:
+        bodies = {}
+        for (account, _), result in zip(body_jobs, await fan_out(body_jobs)):
+            if isinstance(result, dict) and "emails" in result:
+                for item in result["emails"]:
+                    bodies[(account, item["folder"], item["id"])] = item["body"]
+        for item in merged:
+            item["body"] = bodies.get((item["account"], item["folder"], item["id"]), "")
+
+    # An empty page ends the listing, even if some sources only failed
+    response = {"emails": merged,
+                "next_cursor": encode_cursor({"sources": remaining, "query": filters.key()}) if remaining and merged else None}
+    if errors:
+        response["errors"] = errors
+    return response
 
 @mcp.tool()
-async def read_email(email_id: str, folder: str = "INBOX") -> str:
+@timed_tool
+async def read_email(email_id: str, folder: str = "INBOX", uidvalidity: int | None = None, account: str | None = None) -> str:
     """
     Fetches the full content of a specific email.
     
     Args:
-        email_id: The unique ID from list_emails.
+        email_id: The message UID ('id') from list_emails.
         folder: The folder to search (default="INBOX").
+        uidvalidity: Optional 'uidvalidity' from list_emails. If the folder's
+            UIDVALIDITY has changed since, the id is stale and an error is returned.
+        account: Optional 'account' from a multi-account list_emails (default account otherwise).
         
     Returns:
-        Full text body (HTML stripped to Markdown).
+        Full text body (HTML stripped to Markdown). Attachments are not
+        downloaded and the email is not marked as read.
     """
+    try:
+        with config.use_account(account):
+            return await _read_email(email_id, folder, uidvalidity)
+    except ValueError as e:
+        return f"Error: {e}"
+
+
+async def _read_email(email_id: str, folder: str, uidvalidity: int | None) -> str:
     if not config.is_configured:
         return f"Error: Server not configured. Configure at {get_setup_url()} or use `configure_email`."
 
     try:
-        ssl_context = ssl.create_default_context()
-        client = aioimaplib.IMAP4_SSL(host=config.IMAP_HOST, port=config.IMAP_PORT, ssl_context=ssl_context)
-        await client.wait_hello_from_server()
-        await client.login(config.EMAIL_USER, config.EMAIL_PASS)
-        
-        # Select folder
-        res = await client.select(folder)
-        if res.result != 'OK':
-             await client.logout()
-             return f"Error: Failed to select folder '{folder}': {res}"
-        
-        # Fetch full body
-        status, data = await client.fetch(email_id, '(RFC822)')
-        
-        content = ""
-        
-        if status == 'OK':
+        # A full (folder, uidvalidity, uid) handle can be answered from disk without touching the server
+        raw_email = message_cache.get(folder, uidvalidity, int(email_id))
+        msg = None
+        fresh = False
+        real_folder, current_uidvalidity = folder, uidvalidity
 
+        if raw_email is None:
+            async with imap_pool.acquire() as client:
+                # Select folder
+                real_folder, folder_info = await select_folder(client, folder)
+                if real_folder is None:
+                     return f"Error: Failed to select folder '{folder}'"
 
-            
-            raw_email = b""
-            # Loop through response from aioimaplib
-            for part in data:
-                 if isinstance(part, (bytes, bytearray)):
-                     part_bytes = bytes(part)
-                     if b"RFC822" in part_bytes and part_bytes.strip().endswith(b"}"):
-                         continue
-                     if part_bytes.strip() == b")":
-                         continue
-                     raw_email += part_bytes
-            
-            msg = email.message_from_bytes(raw_email, policy=default)
-            content = extract_email_body(msg)
+                current_uidvalidity = folder_info.get("uidvalidity")
+                if uidvalidity is not None and current_uidvalidity not in (None, uidvalidity):
+                     return f"Error: Folder '{real_folder}' was rebuilt (UIDVALIDITY changed); list emails again to get fresh ids."
+
+                message_cache.check_uidvalidity(real_folder, current_uidvalidity)
+                raw_email = message_cache.get(real_folder, current_uidvalidity, int(email_id))
+
+                if raw_email is None:
+                    # Text parts only; attachments stay on the server and the email stays unread
+                    fetched = await fetch_message_texts(client, [int(email_id)], config.BODY_MAX_BYTES or None)
+                    if int(email_id) in fetched:
+                        raw_email, msg = fetched[int(email_id)]
+                        fresh = raw_email is not None
+
+        content = ""
+        
+        if raw_email or msg is not None:
+            # Parsed and converted on the parse pool, not on the event loop
+            msg, content = await parse_pool.extract_body(raw_email, msg, config.BODY_MAX_BYTES or None)
+            if fresh:
+                message_cache.put(real_folder, current_uidvalidity, int(email_id), raw_email, msg)
+            search_index.add(real_folder, current_uidvalidity, int(email_id), msg, content)
 
-        await client.logout()
         return content  if content else "No content found or empty email."
 
     except Exception as e:
@@ -419,6 +688,563 @@ async def read_email(email_id: str, folder: str = "INBOX") -> str:
         return f"Error reading email: {str(e)}"
 
 @mcp.tool()
+@timed_tool
+async def get_thread(email_id: str, folder: str = "INBOX", uidvalidity: int | None = None, include_body: bool = True,
+                     body_max_bytes: int | None = None, account: str | None = None) -> dict:
+    """
+    Fetches the whole conversation an email belongs to, including your own
+    replies filed in other folders.
+
+    Args:
+        email_id: The message UID ('id') from list_emails.
+        folder: The folder the email is in (default="INBOX").
+        uidvalidity: Optional 'uidvalidity' from list_emails (stale ids return an error).
+        include_body: Also return each message's text (one batched fetch per folder).
+        body_max_bytes: Per-message body limit (default BODY_MAX_BYTES).
+        account: Optional 'account' from a multi-account list_emails.
+
+    Returns:
+        {"source": "gmail" or "headers", "messages": [...]} in conversation
+        order: oldest first, each reply right after the message it answers,
+        with "depth" its nesting level. On Gmail the thread comes from the
+        server (X-GM-THRID); elsewhere it is rebuilt from the Message-ID,
+        In-Reply-To and References headers of the local header index, so
+        it only covers folders that have been listed before.
+    """
+    try:
+        with config.use_account(account):
+            return await _get_thread(email_id, folder, uidvalidity, include_body, body_max_bytes)
+    except ValueError as e:
+        return {"error": str(e)}
+
+
+THREAD_HEADER_ITEMS = f"(UID FLAGS BODY.PEEK[HEADER.FIELDS ({HEADER_FIELDS})])"
+
+
+async def _get_thread(email_id: str, folder: str, uidvalidity: int | None, include_body: bool,
+                      body_max_bytes: int | None) -> dict:
+    if not config.is_configured:
+        return {"error": f"Server not configured. Configure at {get_setup_url()} or use `configure_email`."}
+
+    max_body = body_max_bytes if body_max_bytes is not None else (config.BODY_MAX_BYTES or None)
+    try:
+        uid = int(email_id)
+        async with imap_pool.acquire() as client:
+            real_folder, info = await select_folder(client, folder)
+            if real_folder is None:
+                return {"error": f"Failed to select folder '{folder}'"}
+            current_uidvalidity = info.get("uidvalidity")
+            if uidvalidity is not None and current_uidvalidity not in (None, uidvalidity):
+                return {"error": f"Folder '{real_folder}' was rebuilt (UIDVALIDITY changed); list emails again to get fresh ids."}
+
+            source, rows = "gmail", None
+            if client.has_capability('X-GM-EXT-1'):
+                rows = await _gmail_thread(client, real_folder, uid)
+            if rows:
+                thread = jwz_thread(rows)
+            else:
+                source = "headers"
+                if rows is not None:
+                    # The Gmail lookup moved us to All Mail
+                    real_folder, info = await select_folder(client, real_folder)
+                state = await folder_sync.sync(client, real_folder, info)
+                seed = folder_sync.get(real_folder, current_uidvalidity, uid) if state else None
+                if seed is None:
+                    # Older than the index reaches; not stored, so the index stays contiguous
+                    fetched = await _header_rows(client, real_folder, current_uidvalidity, [uid])
+                    if not fetched:
+                        return {"error": f"Email {email_id} not found in '{real_folder}'"}
+                    seed = fetched[0]
+                else:
+                    seed.update(folder=real_folder, uidvalidity=current_uidvalidity)
+                thread = jwz_thread(collect_thread(seed), seed)
+
+            bodies = {}
+            if include_body:
+                bodies = await _thread_bodies(client, [row for row, _ in thread], max_body)
+
+        messages = []
+        for row, depth in thread:
+            key = (row["folder"], row["uidvalidity"], row["uid"])
+            item = {
+                "id": str(row["uid"]),
+                "folder": row["folder"],
+                "uidvalidity": row["uidvalidity"],
+                "sender": row["sender"],
+                "recipients": row["recipients"],
+                "subject": row["subject"],
+                "date": row["date"],
+                "depth": depth,
+                "message_id": row["message_id"],
+            }
+            if include_body:
+                item["body"] = bodies.get(key)
+            messages.append(item)
+        return {"source": source, "messages": messages}
+
+    except Exception as e:
+        logger.error(f"Get Thread Error: {e}")
+        return {"error": f"Error fetching thread: {str(e)}"}
+
+
+async def _gmail_thread(client, real_folder: str, uid: int) -> list[dict] | None:
+    """
+    Header rows of every message in the Gmail thread of `uid` (X-GM-THRID),
+    searched in All Mail so sent replies are included. None if the server
+    didn't give a thread id; may leave All Mail selected.
+    """
+    status, data = await client.uid('fetch', str(uid), '(UID X-GM-THRID)')
+    if status != 'OK':
+        return None
+    thrid = next((r.get("X-GM-THRID") for r in parse_fetch_response(data) if r.get("UID") == str(uid)), None)
+    if not thrid:
+        return None
+
+    folders = [real_folder]
+    all_mail = await folder_catalog.resolve(client, "All Mail")
+    if all_mail and all_mail != real_folder:
+        folders.insert(0, all_mail)
+    for target in folders:
+        target, info = await select_folder(client, target)
+        if target is None:
+            continue
+        status, data = await client.uid_search(f"X-GM-THRID {thrid}")
+        uids = [int(u) for u in data[0].split()] if status == 'OK' and data and data[0] else []
+        if uids:
+            return await _header_rows(client, target, info.get("uidvalidity"), uids)
+    return []
+
+
+async def _header_rows(client, real_folder: str, uidvalidity: int | None, uids: list[int]) -> list[dict]:
+    """Thread rows (see folder_sync.header_fields) for messages of the selected folder, fetched in batches."""
+    rows = []
+    for chunk in chunked(uids, config.IMAP_FETCH_BATCH_SIZE):
+        status, data = await client.uid('fetch', to_sequence_set(chunk), THREAD_HEADER_ITEMS)
+        if status != 'OK':
+            logger.warning(f"Header fetch failed for {len(chunk)} messages: {status}")
+            continue
+        for record in parse_fetch_response(data):
+            if "UID" not in record:
+                continue
+            msg = email.message_from_bytes(fetch_literal(record, "BODY[HEADER"), policy=default)
+            row = header_fields(msg)
+            row.update(uid=int(record["UID"]), folder=real_folder, uidvalidity=uidvalidity,
+                       flags=record.get("FLAGS", []))
+            rows.append(row)
+    return rows
+
+
+async def _thread_bodies(client, rows: list[dict], max_body: int | None) -> dict[tuple, str]:
+    """Bodies of thread messages, one batched fetch per folder they live in."""
+    groups: dict[tuple, list[int]] = {}
+    for row in rows:
+        groups.setdefault((row["folder"], row["uidvalidity"]), []).append(row["uid"])
+
+    bodies = {}
+    for (folder, uidvalidity), uids in groups.items():
+        real_folder, info = await select_folder(client, folder)
+        if real_folder is None or info.get("uidvalidity") != uidvalidity:
+            # Index rows of a folder that has since been rebuilt; its headers still thread fine
+            continue
+        parsed = await _fetch_bodies(client, real_folder, uidvalidity, uids, max_body)
+        for uid, (_, body) in parsed.items():
+            bodies[(folder, uidvalidity, uid)] = body
+    return bodies
+
+
+@mcp.tool()
+@timed_tool
+async def list_attachments(email_id: str, folder: str = "INBOX", uidvalidity: int | None = None,
+                           account: str | None = None) -> dict:
+    """
+    Lists the attachments of an email without downloading them.
+
+    Args:
+        email_id: The message UID ('id') from list_emails.
+        folder: The folder the email is in (default="INBOX").
+        uidvalidity: Optional 'uidvalidity' from list_emails (stale ids return an error).
+        account: Optional 'account' from a multi-account list_emails.
+
+    Returns:
+        {"attachments": [{"part", "filename", "type", "size"}]}; 'size' is
+        approximate (bytes once decoded). Pass 'part' to save_attachment.
+    """
+    try:
+        with config.use_account(account):
+            return await _attachments(email_id, folder, uidvalidity)
+    except ValueError as e:
+        return {"error": str(e)}
+
+
+@mcp.tool()
+@timed_tool
+async def save_attachment(email_id: str, part: str, folder: str = "INBOX", uidvalidity: int | None = None,
+                          account: str | None = None) -> dict:
+    """
+    Downloads one attachment of an email to a local file.
+
+    Args:
+        email_id: The message UID ('id') from list_emails.
+        part: The attachment's 'part' (or its filename) from list_attachments.
+        folder: The folder the email is in (default="INBOX").
+        uidvalidity: Optional 'uidvalidity' from list_emails (stale ids return an error).
+        account: Optional 'account' from a multi-account list_emails.
+
+    Returns:
+        {"path", "filename", "type", "size"} of the saved file (under
+        ATTACHMENT_DIR). The download is streamed to disk in chunks, so
+        attachments of any size are fine; the email is not marked as read.
+    """
+    try:
+        with config.use_account(account):
+            return await _attachments(email_id, folder, uidvalidity, part)
+    except ValueError as e:
+        return {"error": str(e)}
+
+
+async def _attachments(email_id: str, folder: str, uidvalidity: int | None, wanted: str | None = None) -> dict:
+    """list_attachments, or with `wanted` save_attachment."""
+    if not config.is_configured:
+        return {"error": f"Server not configured. Configure at {get_setup_url()} or use `configure_email`."}
+
+    try:
+        uid = int(email_id)
+        async with imap_pool.acquire() as client:
+            real_folder, folder_info = await select_folder(client, folder)
+            if real_folder is None:
+                return {"error": f"Failed to select folder '{folder}'"}
+            current_uidvalidity = folder_info.get("uidvalidity")
+            if uidvalidity is not None and current_uidvalidity not in (None, uidvalidity):
+                return {"error": f"Folder '{real_folder}' was rebuilt (UIDVALIDITY changed); list emails again to get fresh ids."}
+
+            parts = await fetch_parts(client, uid)
+            if parts is None:
+                return {"error": f"Email {email_id} not found in '{real_folder}'"}
+            attachments = attachment_parts(parts)
+            if wanted is None:
+                return {"attachments": [
+                    {"part": p["section"], "filename": p["filename"], "type": p["type"], "size": decoded_size(p)}
+                    for p in attachments
+                ]}
+
+            match = next((p for p in attachments if p["section"] == wanted), None) \
+                or next((p for p in attachments if p["filename"] == wanted), None)
+            if match is None:
+                return {"error": f"No attachment '{wanted}' in email {email_id}; see list_attachments"}
+            path = spool_path(real_folder, current_uidvalidity, uid, match)
+            # Saved before: UIDs are never reused within a UIDVALIDITY, so it is still the same file
+            size = path.stat().st_size if path.exists() else await save_part(client, uid, match, path)
+        return {"path": str(path), "filename": path.name, "type": match["type"], "size": size}
+
+    except Exception as e:
+        logger.error(f"Attachment Error: {e}")
+        return {"error": f"Error fetching attachment: {str(e)}"}
+
+
+@mcp.tool()
+@timed_tool
+async def mark_emails(email_ids: list[str], folder: str = "INBOX", read: bool | None = None,
+                      flagged: bool | None = None, add_labels: list[str] | None = None,
+                      remove_labels: list[str] | None = None, uidvalidity: int | None = None,
+                      account: str | None = None) -> dict:
+    """
+    Marks many emails at once: read/unread, flagged/unflagged, and on Gmail
+    adds or removes labels.
+
+    Args:
+        email_ids: Message UIDs ('id' from list_emails) in `folder`; any number.
+        folder: The folder the emails are in (default="INBOX").
+        read: True marks them read, False unread; omit to leave as is.
+        flagged: True flags (stars) them, False unflags; omit to leave as is.
+        add_labels: Gmail labels to add (e.g. "Receipts", or "\\Important").
+        remove_labels: Gmail labels to remove.
+        uidvalidity: Optional 'uidvalidity' from list_emails (stale ids return an error).
+        account: Optional 'account' from a multi-account list_emails.
+
+    Returns:
+        {"folder", "marked": number of emails changed, "missing": ids not in the folder}
+    """
+    changes = mutations.flag_changes(read, flagged) + mutations.label_changes(add_labels, remove_labels)
+    if not changes:
+        return {"error": "Nothing to change: pass read, flagged, add_labels or remove_labels"}
+
+    async def work(client, real_folder, current_uidvalidity, uids):
+        if (add_labels or remove_labels) and not client.has_capability('X-GM-EXT-1'):
+            return {"error": "Labels are only supported on Gmail; use move_emails for other servers"}
+        records = []
+        for action, items in changes:
+            records += await mutations.store(client, uids, action, items)
+        folder_sync.update_flags(real_folder, current_uidvalidity, records)
+        return {"folder": real_folder, "marked": len(uids)}
+
+    try:
+        with config.use_account(account):
+            return await _bulk(email_ids, folder, uidvalidity, work)
+    except ValueError as e:
+        return {"error": str(e)}
+
+
+@mcp.tool()
+@timed_tool
+async def move_emails(email_ids: list[str], destination: str, folder: str = "INBOX",
+                      uidvalidity: int | None = None, account: str | None = None) -> dict:
+    """
+    Moves many emails to another folder at once (e.g. to archive them).
+
+    Args:
+        email_ids: Message UIDs ('id' from list_emails) in `folder`; any number.
+        destination: Target folder; "Archive", "Trash", "Junk" etc. find the provider's folder.
+        folder: The folder the emails are in (default="INBOX").
+        uidvalidity: Optional 'uidvalidity' from list_emails (stale ids return an error).
+        account: Optional 'account' from a multi-account list_emails.
+
+    Returns:
+        {"folder", "destination", "moved", "missing"}, plus "new_ids" ({old id:
+        id in destination}) when the server reports them.
+    """
+    async def work(client, real_folder, current_uidvalidity, uids):
+        target = await folder_catalog.resolve(client, destination)
+        if target is None:
+            return {"error": f"Folder '{destination}' not found"}
+        if target == real_folder:
+            return {"error": f"The emails are already in '{real_folder}'"}
+        return await _move(client, real_folder, current_uidvalidity, uids, target)
+
+    try:
+        with config.use_account(account):
+            return await _bulk(email_ids, folder, uidvalidity, work)
+    except ValueError as e:
+        return {"error": str(e)}
+
+
+@mcp.tool()
+@timed_tool
+async def delete_emails(email_ids: list[str], folder: str = "INBOX", permanent: bool = False,
+                        uidvalidity: int | None = None, account: str | None = None) -> dict:
+    """
+    Deletes many emails at once by moving them to Trash, or permanently.
+
+    Args:
+        email_ids: Message UIDs ('id' from list_emails) in `folder`; any number.
+        folder: The folder the emails are in (default="INBOX").
+        permanent: True deletes them for good instead of moving them to
+            Trash. Emails already in Trash are always deleted for good.
+        uidvalidity: Optional 'uidvalidity' from list_emails (stale ids return an error).
+        account: Optional 'account' from a multi-account list_emails.
+
+    Returns:
+        {"folder", "deleted", "missing"}, plus "destination" when they went to Trash.
+    """
+    async def work(client, real_folder, current_uidvalidity, uids):
+        trash = await folder_catalog.resolve(client, "Trash")
+        gmail = client.has_capability('X-GM-EXT-1')
+        if real_folder == trash or (permanent and not gmail):
+            expunged = await mutations.expunge(client, uids)
+            if not expunged:
+                return {"error": "Not deleted: other messages in the folder are flagged \\Deleted and "
+                                 "the server can't expunge selectively; expunge those first"}
+            _forget(real_folder, current_uidvalidity, uids)
+            return {"folder": real_folder, "deleted": len(uids)}
+        if trash is None:
+            return {"error": "No Trash folder found; use permanent=True to delete for good"}
+
+        result = await _move(client, real_folder, current_uidvalidity, uids, trash)
+        result["deleted"] = result.pop("moved", 0)
+        if permanent and "error" not in result:
+            # On Gmail, expunging from a label only removes that label; mail is only really gone once expunged from Trash
+            new_ids = [int(i) for i in result.pop("new_ids", {}).values()]
+            if not new_ids:
+                return {"error": "Moved to Trash, but the server didn't report the new ids to expunge them"}
+            real_trash, trash_info = await select_folder(client, trash)
+            if real_trash is None or not await mutations.expunge(client, new_ids):
+                return {"error": f"Moved to '{trash}' but couldn't expunge them there"}
+            _forget(real_trash, trash_info.get("uidvalidity"), new_ids)
+            for key in ("destination", "uidvalidity"):
+                result.pop(key, None)
+        return result
+
+    try:
+        with config.use_account(account):
+            return await _bulk(email_ids, folder, uidvalidity, work)
+    except ValueError as e:
+        return {"error": str(e)}
+
+
+async def _bulk(email_ids: list[str], folder: str, uidvalidity: int | None, work) -> dict:
+    """
+    Shared by mark/move/delete_emails: select the folder, keep the ids it
+    still has (one UID SEARCH), then `work(client, folder, uidvalidity, uids)`.
+    The commands go out per compact UID set, so 500 ids cost a handful of round trips.
+    """
+    if not config.is_configured:
+        return {"error": f"Server not configured. Configure at {get_setup_url()} or use `configure_email`."}
+
+    try:
+        wanted = sorted({int(i) for i in email_ids})
+    except (TypeError, ValueError):
+        return {"error": "email_ids must be message UIDs ('id' from list_emails)"}
+    if not wanted:
+        return {"error": "No email_ids given"}
+
+    try:
+        async with imap_pool.acquire() as client:
+            real_folder, folder_info = await select_folder(client, folder)
+            if real_folder is None:
+                return {"error": f"Failed to select folder '{folder}'"}
+            current_uidvalidity = folder_info.get("uidvalidity")
+            if uidvalidity is not None and current_uidvalidity not in (None, uidvalidity):
+                return {"error": f"Folder '{real_folder}' was rebuilt (UIDVALIDITY changed); list emails again to get fresh ids."}
+
+            uids = await mutations.existing(client, wanted)
+            missing = [str(uid) for uid in sorted(set(wanted) - set(uids))]
+            if not uids:
+                return {"error": f"None of the emails are in '{real_folder}'", "missing": missing}
+            result = await work(client, real_folder, current_uidvalidity, uids)
+        if "error" not in result:
+            result["missing"] = missing
+        return result
+
+    except Exception as e:
+        logger.error(f"Bulk Update Error: {e}")
+        return {"error": str(e)}
+
+
+async def _move(client, real_folder: str, uidvalidity: int | None, uids: list[int], target: str) -> dict:
+    method, target_uidvalidity, new_ids, removed = await mutations.move(client, uids, target)
+    if not removed:
+        return {"error": f"Copied to '{target}' but the originals are still in '{real_folder}': other messages there "
+                         f"are flagged \\Deleted and the server can't expunge selectively; expunge those first"}
+    _forget(real_folder, uidvalidity, uids)
+    result = {"folder": real_folder, "destination": target, "moved": len(uids), "method": method}
+    if new_ids:
+        result["new_ids"] = {str(old): str(new) for old, new in sorted(new_ids.items())}
+        result["uidvalidity"] = target_uidvalidity
+    return result
+
+
+def _forget(folder: str, uidvalidity: int | None, uids: list[int]) -> None:
+    """Drop moved or expunged messages from the header index, search index and message cache."""
+    folder_sync.remove(folder, uidvalidity, uids)
+    message_cache.remove(folder, uidvalidity, uids)
+
+
+@mcp.tool()
+@timed_tool
+async def whats_new(cursor: str | None = None, folders: list[str] | None = None, limit: int = 50) -> dict:
+    """
+    Returns emails that arrived since a previous call. Cheap to poll: watched
+    folders (IDLE_FOLDERS, default INBOX) are answered from the local index.
+    
+    Args:
+        cursor: The 'cursor' from the previous call. Omit it on the first call
+            to get the current position (no emails are returned then).
+        folders: Folders to check (default: the watched IDLE_FOLDERS).
+        limit: Max number of emails to return (default=50).
+
+    Returns:
+        Dictionary with the new 'emails' (oldest first, same handles as
+        list_emails), the 'cursor' to pass next time, and 'has_more' if
+        the limit cut the result short.
+    """
+    if not config.is_configured:
+        return {"error": f"Server not configured. Configure at {get_setup_url()} or use `configure_email`."}
+
+    idle_watcher.ensure_started()
+    try:
+        positions = decode_cursor(cursor)
+        wanted = folders or [f.strip() for f in config.IDLE_FOLDERS.split(",") if f.strip()]
+        resolved = {f: idle_watcher.resolved.get(f, f) for f in wanted}
+
+        # Folders without a live IDLE loop need one sync round trip first
+        stale = [f for f in wanted if not idle_watcher.is_live(resolved[f])]
+        if stale:
+            async with imap_pool.acquire() as client:
+                for f in stale:
+                    real_folder, folder_info = await select_folder(client, f)
+                    if real_folder is None:
+                        continue
+                    resolved[f] = real_folder
+                    await folder_sync.sync(client, real_folder, folder_info)
+
+        emails = []
+        next_positions = {}
+        has_more = False
+        for f in wanted:
+            real_folder = resolved[f]
+            state = folder_sync.get_state(real_folder)
+            if state is None:
+                continue
+            last_uidvalidity, next_uid = positions.get(real_folder, (None, None))
+            if cursor is None or last_uidvalidity != state.uidvalidity or next_uid is None:
+                # First call, or the folder was rebuilt: start from "now"
+                next_positions[real_folder] = [state.uidvalidity, state.uidnext]
+                continue
+
+            budget = limit - len(emails)
+            rows = folder_sync.since(real_folder, state.uidvalidity, next_uid, budget + 1)
+            if len(rows) > budget:
+                rows, has_more = rows[:budget], True
+                next_positions[real_folder] = [state.uidvalidity, rows[-1]["uid"] + 1 if rows else next_uid]
+            else:
+                next_positions[real_folder] = [state.uidvalidity, state.uidnext or (rows[-1]["uid"] + 1 if rows else next_uid)]
+            for row in rows:
+                emails.append({
+                    "id": str(row["uid"]),
+                    "folder": real_folder,
+                    "uidvalidity": state.uidvalidity,
+                    "sender": row["sender"],
+                    "subject": row["subject"],
+                    "date": row["date"]
+                })
+
+        return {"cursor": encode_cursor(next_positions), "emails": emails, "has_more": has_more}
+
+    except Exception as e:
+        logger.error(f"Whats New Error: {e}")
+        return {"error": str(e)}
+
+@mcp.tool()
+@timed_tool
+async def search_emails(query: str = "", folder: str | None = None, sender: str | None = None, to: str | None = None,
+                        subject: str | None = None, since: str | None = None, before: str | None = None,
+                        limit: int = 20) -> list[dict]:
+    """
+    Full-text search over the mail this server has already seen (listed,
+    read or picked up by the IDLE watcher), answered locally without
+    contacting the mail server. Use list_emails with sender/to to search
+    the whole mailbox on the server instead.
+    
+    Args:
+        query: Words to search for in sender, recipients, subject and body.
+            Results are ranked by relevance.
+        folder: Optional folder to restrict the search to (e.g. "INBOX").
+        sender: Optional words that must appear in the From header.
+        to: Optional words that must appear in the To/Cc headers.
+        subject: Optional words that must appear in the subject.
+        since: Optional start date (YYYY-MM-DD, inclusive).
+        before: Optional end date (YYYY-MM-DD, exclusive).
+        limit: Max number of results (default=20).
+
+    Returns:
+        List of matching emails (same handles as list_emails) with a 'snippet'
+        of the matching body text. Without any words only the date/folder
+        filters apply and the newest emails come first.
+    """
+    if not search_index.enabled:
+        return [{"error": "Search index is disabled (SEARCH_INDEX_ENABLED=false or SQLite without FTS5)"}]
+
+    try:
+        if folder:
+            folder = idle_watcher.resolved.get(folder, folder)
+        return search_index.search(query, folder, sender, to, subject, since, before, limit)
+    except ValueError as e:
+        return [{"error": f"Invalid date, expected YYYY-MM-DD: {e}"}]
+    except Exception as e:
+        logger.error(f"Search Emails Error: {e}")
+        return [{"error": str(e)}]
+
+@mcp.tool()
+@timed_tool
 async def draft_email(to_recipients: list[str], subject: str, body_text: str) -> str:
     """
     Creates a new email and saves it to the provider's Drafts folder.
@@ -442,16 +1268,6 @@ async def draft_email(to_recipients: list[str], subject: str, body_text: str) ->
         body_text = body_text.replace("\\n", "\n")
         msg.attach(MIMEText(body_text, 'plain'))
 
-        # Connect to IMAP
-        ssl_context = ssl.create_default_context()
-        client = aioimaplib.IMAP4_SSL(host=config.IMAP_HOST, port=config.IMAP_PORT, ssl_context=ssl_context)
-        await client.wait_hello_from_server()
-        await client.login(config.EMAIL_USER, config.EMAIL_PASS)
-
-        # Append to Drafts
-        # Note: "Drafts" is common, but some providers use "INBOX.Drafts" or "[Gmail]/Drafts"
-        folder = "Drafts"
-        
         # APPEND command requires the message to be bytes and usually flags
         msg_bytes = msg.as_bytes()
         
@@ -460,9 +1276,10 @@ async def draft_email(to_recipients: list[str], subject: str, body_text: str) ->
         now = time.strftime("%d-%b-%Y %H:%M:%S +0000", time.gmtime())
         date_time = f'"{now}"'
         
-        response = await client.append(msg_bytes, mailbox=folder, flags=r'(\Seen \Draft)', date=date_time)
-        
-        await client.logout()
+        async with imap_pool.acquire() as client:
+            # "Drafts" on most servers, "[Gmail]/Drafts" etc. elsewhere (found via the \Drafts attribute)
+            folder = await folder_catalog.resolve(client, "Drafts") or "Drafts"
+            response = await client.append(msg_bytes, mailbox=quote_mailbox(folder), flags=r'(\Seen \Draft)', date=date_time)
         
         if response.result == 'OK':
              return "✅ Saved to Drafts folder successfully."
@@ -476,77 +1293,142 @@ async def draft_email(to_recipients: list[str], subject: str, body_text: str) ->
 
 
 
+def _build_message(to_recipients: list[str], subject: str, body_text: str, cc_recipients: list[str] | None = None) -> EmailMessage:
+    msg = EmailMessage()
+    msg['From'] = config.EMAIL_USER
+    msg['To'] = ", ".join(to_recipients)
+    msg['Subject'] = subject
+    msg['Date'] = email.utils.formatdate(localtime=True)
+    # Fixed up front so a retried send is recognisable as the same message
+    msg['Message-ID'] = email.utils.make_msgid(domain=(config.EMAIL_USER or "").rpartition("@")[2] or None)
+    # Ensure newlines are treated correctly
+    body_text = body_text.replace("\\n", "\n")
+    msg.set_content(body_text)
+    
+    if cc_recipients:
+        msg['Cc'] = ", ".join(cc_recipients)
+    return msg
+
 @mcp.tool()
-async def send_email(to_recipients: list[str], subject: str, body_text: str, cc_recipients: list[str] = None) -> str:
+@timed_tool
+async def send_email(to_recipients: list[str], subject: str, body_text: str, cc_recipients: list[str] = None,
+                     idempotency_key: str | None = None) -> str:
     """
-    Sends an email immediately using SMTP and saves a copy to Sent.
+    Queues an email for immediate delivery via SMTP (a copy is saved to Sent
+    unless the provider already does that).
+    Returns right away with a queue id; delivery, retries on temporary
+    failures and the copy to Sent happen in the background.
     
     Args:
         to_recipients: List of email addresses.
         subject: Email subject.
         body_text: Body content (text).
         cc_recipients: Optional list of CC addresses.
+        idempotency_key: Optional unique key for this email. Calling again
+            with the same key returns the original queue id instead of
+            sending a second copy.
     """
     if not config.is_configured:
         return f"Error: Server not configured. Configure at {get_setup_url()} or use `configure_email`."
 
     try:
-        msg = EmailMessage()
-        msg['From'] = config.EMAIL_USER
-        msg['To'] = ", ".join(to_recipients)
-        msg['Subject'] = subject
-        msg['Date'] = email.utils.formatdate(localtime=True)
-        # Ensure newlines are treated correctly
-        body_text = body_text.replace("\\n", "\n")
-        msg.set_content(body_text)
-        
-        if cc_recipients:
-            msg['Cc'] = ", ".join(cc_recipients)
+        msg = _build_message(to_recipients, subject, body_text, cc_recipients)
 
-        logger.info(f"Sending email to {to_recipients}...")
+        outbox.ensure_started()
+        queue_id, created = outbox.enqueue(msg, idempotency_key)
+        if not created:
+            status = outbox.status(queue_id)[0]["status"]
+            return f"✅ Already queued with this idempotency key (id: {queue_id}, status: {status})."
 
-        # 1. Send via SMTP
-        use_tls = config.SMTP_PORT == 465
-        smtp_client = aiosmtplib.SMTP(hostname=config.SMTP_HOST, port=config.SMTP_PORT, use_tls=use_tls)
-        
-        await smtp_client.connect()
-        if not use_tls:
-             await smtp_client.starttls()
-        
-        await smtp_client.login(config.EMAIL_USER, config.EMAIL_PASS)
-        # Capture response
-        errors, response_msg = await smtp_client.send_message(msg)
-        await smtp_client.quit()
-        
-        # 2. Append to Sent via IMAP
-        try:
-            ssl_context = ssl.create_default_context()
-            imap_client = aioimaplib.IMAP4_SSL(host=config.IMAP_HOST, port=config.IMAP_PORT, ssl_context=ssl_context)
-            await imap_client.wait_hello_from_server()
-            await imap_client.login(config.EMAIL_USER, config.EMAIL_PASS)
-            
-            # Use corrected folder list - Prioritize "Sent" to avoid space quoting issues
-            sent_folder = await find_folder(imap_client, ["Sent", "Sent Mail", "Sent Items", "INBOX.Sent", "[Gmail]/Sent Mail"])
-            
-            # Quote folder if it has spaces
-            if " " in sent_folder:
-                sent_folder = f'"{sent_folder}"'
-                
-            msg_bytes = msg.as_bytes()
-            
-            # Using None for date_time to avoid type errors observed in testing
-            await imap_client.append(msg_bytes, mailbox=sent_folder, flags=r'(\Seen)', date=None)
-            await imap_client.logout()
-            return f"✅ Email sent ({response_msg}) and saved to Sent folder."
-            
-        except Exception as e:
-            logger.error(f"Failed to append to Sent: {e}")
-            return f"✅ Email sent ({response_msg}), but failed to save copy to Sent folder."
+        logger.info(f"Queued email to {to_recipients} as {queue_id}")
+        return f"✅ Email queued for delivery (id: {queue_id}). Use `email_status` to check on it."
 
     except Exception as e:
         logger.error(f"Send Email Error: {e}")
         return f"Error sending email: {str(e)}"
 
+@mcp.tool()
+@timed_tool
+async def email_status(queue_id: str | None = None, limit: int = 20) -> list[dict]:
+    """
+    Reports the delivery status of emails queued by send_email.
+    
+    Args:
+        queue_id: The id returned by send_email. Omit to list the most recent emails.
+        limit: Max number of entries when listing (default=20).
+
+    Returns:
+        List of entries with 'id', 'status' (queued, sending, sent, failed
+        or cancelled), 'recipients', 'subject', 'attempts', 'last_error', the
+        server 'response', 'sent_copy' (pending, done, skipped, failed or cancelled)
+        and timestamps ('next_attempt' while queued).
+    """
+    try:
+        outbox.ensure_started()
+        entries = outbox.status(queue_id, limit)
+        if queue_id and not entries:
+            return [{"error": f"No queued email with id {queue_id}"}]
+        return entries
+    except Exception as e:
+        logger.error(f"Email Status Error: {e}")
+        return [{"error": str(e)}]
+
+@mcp.tool()
+@timed_tool
+async def send_bulk(messages: list[dict], save_to_sent: bool = True) -> list[dict]:
+    """
+    Sends many emails through one authenticated SMTP session (no handshake per email).
+    
+    Args:
+        messages: List of emails, each a dict with 'to' (list of addresses),
+            'subject', 'body' and optionally 'cc' (list of addresses).
+        save_to_sent: Also save a copy of each sent email to Sent (default=True).
+
+    Returns:
+        One result per email, in order: {'index', 'status': 'sent'|'failed',
+        'response' or 'error'}.
+    """
+    if not config.is_configured:
+        return [{"error": f"Server not configured. Configure at {get_setup_url()} or use `configure_email`."}]
+
+    results = []
+    built = []
+    for index, item in enumerate(messages):
+        try:
+            to = item["to"]
+            built.append((index, _build_message(to if isinstance(to, list) else [to], item.get("subject", ""),
+                                                item.get("body", ""), item.get("cc"))))
+        except Exception as e:
+            results.append({"index": index, "status": "failed", "error": f"Invalid message: {e}"})
+
+    try:
+        logger.info(f"Sending {len(built)} emails in one SMTP session...")
+        outcomes = await smtp_pool.send_messages([msg for _, msg in built])
+    except Exception as e:
+        logger.error(f"Send Bulk Error: {e}")
+        outcomes = [e] * len(built)
+
+    sent = []
+    for (index, msg), outcome in zip(built, outcomes):
+        if isinstance(outcome, Exception):
+            results.append({"index": index, "status": "failed", "error": str(outcome)})
+        else:
+            results.append({"index": index, "status": "sent", "response": outcome[1]})
+            sent.append((msg, outcome[1]))
+    # A connection error may have stopped the batch early
+    for index, _ in built[len(outcomes):]:
+        results.append({"index": index, "status": "failed", "error": "Not sent (SMTP session lost)"})
+
+    # Sent copies are appended in the background (and skipped where the provider files them itself)
+    try:
+        outbox.ensure_started()
+        for msg, response in sent:
+            outbox.record_sent(msg, response, save_to_sent and not server_files_sent_mail())
+    except Exception as e:
+        logger.error(f"Failed to schedule Sent copies for bulk messages: {e}")
+
+    return sorted(results, key=lambda r: r["index"])
+
 
 
 @mcp.prompt()
@@ -554,11 +1436,13 @@ def daily_digest() -> list[dict]:
     """
     Summarize emails from the last 24 hours.
     """
+    # SEARCH dates have day granularity, so ask for yesterday and today
+    since = (date.today() - timedelta(days=1)).isoformat()
     return [
         {
             "role": "user",
-            "content": """Please fetch the emails from the last 24 hours using the `list_emails` tool (limit to 20-30 to be safe). 
-            
+            "content": f"""Please fetch the emails from the last 24 hours using the `list_emails` tool with `since="{since}"` and `limit=50`; the server only returns emails from that day on, so at most skip the few that are older than 24 hours. If `next_cursor` is set, fetch the next page too.
+
 Instructions:
 1. List the emails from the Inbox.
 2. Summarize the important ones into categories:
@@ -575,13 +1459,14 @@ def meeting_hunter() -> list[dict]:
     """
     Find all scheduling and meeting requests from the last few days.
     """
+    since = (date.today() - timedelta(days=3)).isoformat()
     return [
         {
             "role": "user",
-            "content": """Please scan my recent emails for any meeting requests, scheduling conflicts, or calendar invites.
+            "content": f"""Please scan my recent emails for any meeting requests, scheduling conflicts, or calendar invites.
 
 Instructions:
-1. Call `list_emails` for the last 50 emails.
+1. Call `list_emails` with `since="{since}"` and `limit=50`.
 2. Look for keywords like "zoom", "meet", "schedule", "calendar", "time", "invite".
 3. List them out for me in a table with:
    - Sender
@@ -592,6 +1477,14 @@ Instructions:
     ]
 
 
+# Served by run_metrics_server below, on a listener of its own
+async def metrics_page(request: Request):
+    """Prometheus scrape target: tool latency, IMAP/SMTP round trips and bytes, cache hits."""
+    if not config.METRICS_ENABLED:
+        return Response("Metrics are disabled (METRICS_ENABLED=false)\n", status_code=404, media_type="text/plain")
+    return Response(metrics.render(), media_type=CONTENT_TYPE)
+
+
 if __name__ == "__main__":
     # Create a separate Starlette app for the setup page
     # This allows us to serve the web interface on port 8000 while the MCP server runs on stdio
@@ -612,9 +1505,22 @@ if __name__ == "__main__":
         except Exception as e:
             logger.error(f"Failed to start HTTP server: {e}")
 
+    def run_metrics_server():
+        # Its own listener (loopback by default), so /metrics never keeps the setup routes reachable.
+        # Checked here rather than before starting the thread: reading the config would delay startup
+        if not config.METRICS_ENABLED:
+            return
+        try:
+            metrics_app = Starlette(routes=[Route("/metrics", metrics_page, methods=["GET"])])
+            uvicorn.Server(uvicorn.Config(metrics_app, host=config.METRICS_HOST, port=config.METRICS_PORT,
+                                          log_level="critical")).run()
+        except Exception as e:
+            logger.error(f"Failed to start metrics server: {e}")
+
     # Start HTTP server in a background thread
     http_thread = threading.Thread(target=run_http_server, daemon=True)
     http_thread.start()
+    threading.Thread(target=run_metrics_server, daemon=True).start()
     
     logger.info("HTTP Setup Server running on http://localhost:8000/setup")
     
@@ -0,0 +1,183 @@
+import asyncio
+import time
+import logging
+from contextlib import asynccontextmanager
+
+try:
+    from src.config import config
+    from src.imap_pool import PooledSession
+    from src.metrics import instrument_smtp, metrics, span
+except ImportError:
+    from config import config
+    from imap_pool import PooledSession
+    from metrics import instrument_smtp, metrics, span
+
+logger = logging.getLogger(__name__)
+
+
+def _connection_lost(error: Exception) -> bool:
+    """True for errors after which the session is gone (dropped socket or 421 'closing connection')."""
+    import aiosmtplib
+
+    if isinstance(error, (aiosmtplib.SMTPServerDisconnected, ConnectionError)):
+        return True
+    return isinstance(error, aiosmtplib.SMTPResponseException) and error.code == 421
+
+
+class SMTPPool:
+    """
+    Keeps authenticated SMTP sessions open between sends, so a message costs
+    MAIL/RCPT/DATA instead of connect + TLS + EHLO + AUTH + QUIT.
+
+    A session that comes back from the pool is checked with RSET, which also
+    guarantees a clean envelope. If the server drops the connection or
+    answers 421 (providers do this after N messages or some idle time) the
+    message is retried once on a fresh session.
+    """
+
+    def __init__(self, size: int | None = None):
+        self._size = size
+        # Idle sessions per (host, port, user, password), so several accounts can share the pool
+        self._idle: dict[tuple, list[PooledSession]] = {}
+        self._semaphore: asyncio.Semaphore | None = None
+
+    # Sized on first use rather than at import, which would load the config (see LazyConfig)
+    @property
+    def size(self) -> int:
+        if self._size is None:
+            self._size = config.SMTP_POOL_SIZE
+        return self._size
+
+    @property
+    def _slots(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.size)
+        return self._semaphore
+
+    @staticmethod
+    def _config_key() -> tuple:
+        return (config.SMTP_HOST, config.SMTP_PORT, config.EMAIL_USER, config.EMAIL_PASS)
+
+    async def _connect(self, key: tuple) -> PooledSession:
+        # Imported on first connect, keeping it out of the server's startup
+        import aiosmtplib
+
+        logger.info(f"Opening pooled SMTP connection to {config.SMTP_HOST}:{config.SMTP_PORT}")
+        # 465 is implicit TLS; anything else must upgrade with STARTTLS during connect()
+        use_tls = config.SMTP_PORT == 465
+        client = aiosmtplib.SMTP(hostname=config.SMTP_HOST, port=config.SMTP_PORT,
+                                 use_tls=use_tls, start_tls=not use_tls)
+        # TCP + TLS (or STARTTLS) + EHLO
+        with span("smtp_connect"):
+            await client.connect()
+        try:
+            with span("smtp_login"):
+                await client.login(config.EMAIL_USER, config.EMAIL_PASS)
+        except Exception:
+            await self._close_client(client)
+            raise
+        return PooledSession(instrument_smtp(client), key)
+
+    @staticmethod
+    async def _close_client(client) -> None:
+        try:
+            if client.is_connected:
+                await asyncio.wait_for(client.quit(), timeout=5)
+        except Exception as e:
+            logger.debug(f"Ignoring error while closing SMTP session: {e}")
+            client.close()
+
+    async def _is_healthy(self, session: PooledSession) -> bool:
+        if not session.client.is_connected:
+            return False
+        try:
+            response = await session.client.rset()
+            return response.code == 250
+        except Exception as e:
+            logger.info(f"Pooled SMTP session failed RSET: {e}")
+            return False
+
+    async def _checkout(self) -> PooledSession:
+        key = self._config_key()
+        idle = self._idle.setdefault(key, [])
+        while idle:
+            session = idle.pop()
+            if session.idle_for > config.SMTP_POOL_IDLE_TIMEOUT:
+                await self._close_client(session.client)
+                continue
+            if await self._is_healthy(session):
+                return session
+            await self._close_client(session.client)
+        return await self._connect(key)
+
+    async def _park(self, session: PooledSession) -> None:
+        self._idle.setdefault(session.key, []).append(session)
+        # Keep at most `size` idle sessions across all accounts; the least recently used goes
+        idle = [s for sessions in self._idle.values() for s in sessions]
+        if len(idle) > self.size:
+            oldest = min(idle, key=lambda s: s.last_used)
+            self._idle[oldest.key].remove(oldest)
+            await self._close_client(oldest.client)
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Borrow an authenticated SMTP client (dropped instead of returned if the block raises)."""
+        async with self._slots:
+            session = await self._checkout()
+            try:
+                yield session.client
+            except BaseException:
+                await self._close_client(session.client)
+                raise
+            session.last_used = time.monotonic()
+            await self._park(session)
+
+    async def send_messages(self, messages: list) -> list:
+        """
+        Send messages back to back over one pooled session.
+
+        Returns one entry per message: the (recipient errors, server reply)
+        tuple from aiosmtplib, or the exception that message failed with. If
+        no new session can be opened the list stops short; the remaining
+        messages were not sent.
+        """
+        results = []
+        async with self._slots:
+            session = await self._checkout()
+            try:
+                for msg in messages:
+                    for attempt in (1, 2):
+                        try:
+                            results.append(await session.client.send_message(msg))
+                            break
+                        except Exception as e:
+                            if not _connection_lost(e):
+                                # Refused recipient, bad address, ... aiosmtplib already sent RSET
+                                results.append(e)
+                                break
+                            logger.info(f"SMTP session lost ({e}), reconnecting")
+                            await self._close_client(session.client)
+                            try:
+                                session = await self._connect(session.key)
+                            except Exception as connect_error:
+                                results.append(connect_error)
+                                return results
+                            if attempt == 2:
+                                results.append(e)
+            except BaseException:
+                await self._close_client(session.client)
+                raise
+            session.last_used = time.monotonic()
+            await self._park(session)
+        return results
+
+    async def close_all(self) -> None:
+        """QUIT every idle session (e.g. after the credentials changed)."""
+        idle, self._idle = self._idle, {}
+        for session in [s for sessions in idle.values() for s in sessions]:
+            await self._close_client(session.client)
+
+
+smtp_pool = SMTPPool()
+metrics.gauge("email_mcp_smtp_idle_sessions", "Logged-in SMTP sessions waiting in the pool",
+              lambda: sum(len(sessions) for sessions in smtp_pool._idle.values()))
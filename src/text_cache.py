@@ -0,0 +1,184 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from src.config import config
+    from src.message_cache import cache_root
+    from src.metrics import count_cache, span
+    from src.utils import extract_email_body, html_to_text, parse_message
+except ImportError:
+    from config import config
+    from message_cache import cache_root
+    from metrics import count_cache, span
+    from utils import extract_email_body, html_to_text, parse_message
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS texts (
+    key       TEXT PRIMARY KEY,
+    text      TEXT NOT NULL,
+    size      INTEGER NOT NULL,
+    used_at   REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS texts_lru ON texts (used_at);
+"""
+
+# HTML shorter than this converts faster than it hashes and looks up
+MIN_HTML_CHARS = 2048
+
+
+class TextCache:
+    """
+    Memoized HTML-to-text, keyed by the SHA-1 of the HTML part (and the
+    parser used). Newsletters and marketing mail reuse the same templates,
+    and the same message is often converted by read_email and again by
+    list_emails(include_body=True).
+
+    The in-memory tier is an LRU of TEXT_CACHE_SIZE entries. With
+    TEXT_CACHE_DISK on, results also go to a SQLite file under the cache
+    directory (capped at TEXT_CACHE_DISK_MAX_MB), so they survive restarts.
+    Safe to use from the parse pool's threads; with a process pool every
+    worker keeps its own memory tier and they share the disk tier, and the
+    workers' lookups are reported back (see in_worker) so the counters here
+    cover them.
+    """
+
+    def __init__(self):
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._worker_entries: dict[int, int] = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _db(self) -> sqlite3.Connection:
+        # One connection per thread: the parse pool calls in from its workers
+        db = getattr(self._local, "db", None)
+        if db is None:
+            root = cache_root()
+            root.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(root / 'texts.sqlite3', timeout=5)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+            self._local.db = db
+        return db
+
+    def _remember(self, key: str, text: str) -> None:
+        with self._lock:
+            self._entries[key] = text
+            self._entries.move_to_end(key)
+            while len(self._entries) > max(0, config.TEXT_CACHE_SIZE):
+                self._entries.popitem(last=False)
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            text = self._entries.get(key)
+            if text is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                count_cache("html_to_text", hits=1)
+                return text
+        if config.TEXT_CACHE_DISK:
+            try:
+                row = self._db().execute("SELECT text FROM texts WHERE key = ?", (key,)).fetchone()
+                if row:
+                    with self._db() as db:
+                        db.execute("UPDATE texts SET used_at = ? WHERE key = ?", (time.time(), key))
+                    self.disk_hits += 1
+                    count_cache("html_to_text", hits=1, result="disk_hit")
+                    self._remember(key, row[0])
+                    return row[0]
+            except sqlite3.Error as e:
+                logger.warning(f"Text cache read failed: {e}")
+        self.misses += 1
+        count_cache("html_to_text", misses=1)
+        return None
+
+    def put(self, key: str, text: str) -> None:
+        self._remember(key, text)
+        if not config.TEXT_CACHE_DISK:
+            return
+        try:
+            with self._db() as db:
+                db.execute("INSERT OR REPLACE INTO texts (key, text, size, used_at) VALUES (?, ?, ?, ?)",
+                           (key, text, len(text), time.time()))
+                total = db.execute("SELECT COALESCE(SUM(size), 0) FROM texts").fetchone()[0]
+                limit = config.TEXT_CACHE_DISK_MAX_MB * 1024 * 1024
+                if total > limit:
+                    # Drop the least recently used quarter in one go
+                    db.execute("DELETE FROM texts WHERE key IN "
+                               "(SELECT key FROM texts ORDER BY used_at LIMIT (SELECT COUNT(*) / 4 + 1 FROM texts))")
+        except sqlite3.Error as e:
+            logger.warning(f"Text cache write failed: {e}")
+
+    def convert(self, html: str, parser: str = "auto") -> str:
+        """html_to_text(), answered from the cache when this exact HTML was converted before."""
+        if config.TEXT_CACHE_SIZE <= 0 or len(html) < MIN_HTML_CHARS:
+            with span("html_to_text"):
+                return html_to_text(html, parser)
+        key = hashlib.sha1(f"{parser}\0{html}".encode("utf-8", errors="surrogatepass")).hexdigest()
+        text = self.get(key)
+        if text is None:
+            with span("html_to_text"):
+                text = html_to_text(html, parser)
+            self.put(key, text)
+        return text
+
+    def counts(self) -> tuple[int, int, int]:
+        return self.hits, self.disk_hits, self.misses
+
+    def add_worker_counts(self, worker: int, entries: int, hits: int, disk_hits: int, misses: int) -> None:
+        """Lookups a process pool worker made in its own copy of the cache (see in_worker)."""
+        with self._lock:
+            self._worker_entries[worker] = entries
+            self.hits += hits
+            self.disk_hits += disk_hits
+            self.misses += misses
+        count_cache("html_to_text", hits=hits)
+        count_cache("html_to_text", hits=disk_hits, result="disk_hit")
+        count_cache("html_to_text", misses=misses)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            # Process pool workers' memory tiers included, as of their last task
+            "entries": len(self._entries) + sum(self._worker_entries.values()),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.disk_hits) / lookups, 3) if lookups else None,
+        }
+
+
+text_cache = TextCache()
+
+
+# Entry points for the parse pool (module level, so a process pool can pickle them)
+
+def extract_cached(msg, max_bytes: int | None = None, html_parser: str = "auto") -> str:
+    return extract_email_body(msg, max_bytes, html_parser, text_cache.convert)
+
+
+def parse_and_extract_cached(raw: bytes, max_bytes: int | None = None, html_parser: str = "auto"):
+    with span("mime_parse"):
+        msg = parse_message(raw)
+    return msg, extract_cached(msg, max_bytes, html_parser)
+
+
+def in_worker(fn, *args):
+    """
+    fn(*args) in a process pool worker, plus the text cache lookups it made
+    there, for the parent's add_worker_counts (a worker runs one task at a
+    time, so the difference is exactly this call's).
+    """
+    before = text_cache.counts()
+    result = fn(*args)
+    counts = [after - start for after, start in zip(text_cache.counts(), before)]
+    return result, (os.getpid(), len(text_cache._entries), *counts)
@@ -0,0 +1,143 @@
+import logging
+
+try:
+    from src.folder_sync import MESSAGE_ID_RE, folder_sync
+except ImportError:
+    from folder_sync import MESSAGE_ID_RE, folder_sync
+
+logger = logging.getLogger(__name__)
+
+# Discovery rounds over the header index (each round follows one more generation)
+MAX_ROUNDS = 8
+MAX_MESSAGES = 500
+
+
+def message_ids(value: str | None) -> list[str]:
+    return MESSAGE_ID_RE.findall(value or "")
+
+
+def ancestors(row: dict) -> list[str]:
+    """Message-IDs this message descends from, oldest first (References, then In-Reply-To)."""
+    refs = message_ids(row.get("refs"))
+    parent = message_ids(row.get("in_reply_to"))[:1]
+    if parent and (not refs or refs[-1] != parent[0]):
+        refs += parent
+    return refs
+
+
+def _own_id(row: dict) -> str:
+    ids = message_ids(row.get("message_id"))
+    # No usable Message-ID: still a message, just one nothing can reply to
+    return ids[0] if ids else f"<{row.get('folder')}/{row.get('uidvalidity')}/{row['uid']}@local>"
+
+
+def collect_thread(seed: dict) -> list[dict]:
+    """
+    Every indexed message connected to `seed` through Message-ID, In-Reply-To
+    or References, in any folder (so replies filed in Sent are found too).
+    """
+    found = {(seed.get("folder"), seed.get("uidvalidity"), seed["uid"]): seed}
+    wanted = {_own_id(seed), *ancestors(seed)}
+    searched: set[str] = set()
+    for _ in range(MAX_ROUNDS):
+        pending = sorted(wanted - searched)
+        if not pending or len(found) >= MAX_MESSAGES:
+            break
+        searched.update(pending)
+        for row in folder_sync.find_related(pending, MAX_MESSAGES):
+            key = (row["folder"], row["uidvalidity"], row["uid"])
+            if key not in found:
+                found[key] = row
+                wanted.update([_own_id(row), *ancestors(row)])
+    return list(found.values())
+
+
+class Container:
+    """A node of the JWZ thread tree: a Message-ID, and the message if we have it."""
+
+    __slots__ = ("message_id", "row", "parent", "children")
+
+    def __init__(self, message_id: str):
+        self.message_id = message_id
+        self.row: dict | None = None
+        self.parent: Container | None = None
+        self.children: list[Container] = []
+
+    def has_ancestor(self, other: "Container") -> bool:
+        node = self
+        while node is not None:
+            if node is other:
+                return True
+            node = node.parent
+        return False
+
+    def adopt(self, child: "Container") -> None:
+        """Make `child` a child of this container, unless that would create a loop."""
+        if child.parent is self or self.has_ancestor(child):
+            return
+        if child.parent is not None:
+            child.parent.children.remove(child)
+        child.parent = self
+        self.children.append(child)
+
+    @property
+    def date_ts(self) -> float:
+        if self.row is not None:
+            return self.row.get("date_ts") or 0.0
+        return min((child.date_ts for child in self.children), default=0.0)
+
+
+def jwz_thread(rows: list[dict], seed: dict | None = None) -> list[tuple[dict, int]]:
+    """
+    Thread `rows` after Jamie Zawinski's algorithm (https://www.jwz.org/doc/threading.html),
+    minus the subject grouping step.
+
+    Returns (row, depth) pairs in conversation order: depth first, replies
+    sorted by date. With `seed`, only the conversation containing it;
+    otherwise every conversation in `rows`, oldest first. The same message in
+    two folders (e.g. INBOX and All Mail) is listed once.
+    """
+    containers: dict[str, Container] = {}
+
+    def container(message_id: str) -> Container:
+        if message_id not in containers:
+            containers[message_id] = Container(message_id)
+        return containers[message_id]
+
+    for row in rows:
+        node = container(_own_id(row))
+        if node.row is not None:
+            continue
+        node.row = row
+        # Link the References chain, keeping links that are already there
+        previous = None
+        for message_id in ancestors(row):
+            ref = container(message_id)
+            if previous is not None and ref.parent is None:
+                previous.adopt(ref)
+            previous = ref
+        # The last reference is the parent, whatever earlier messages claimed
+        if previous is not None:
+            previous.adopt(node)
+
+    if seed is not None:
+        root = containers[_own_id(seed)]
+        while root.parent is not None:
+            root = root.parent
+        roots = [root]
+    else:
+        roots = sorted((c for c in containers.values() if c.parent is None), key=lambda c: c.date_ts)
+
+    ordered = []
+
+    def walk(node: Container, depth: int) -> None:
+        if node.row is not None:
+            ordered.append((node.row, depth))
+            depth += 1
+        # Placeholders for messages we don't have don't add a level
+        for child in sorted(node.children, key=lambda c: c.date_ts):
+            walk(child, depth)
+
+    for root in roots:
+        walk(root, 0)
+    return ordered
@@ -1,85 +1,208 @@
+import io
 import re
+import base64
+import binascii
+import json
+import quopri
 import email
+from email.generator import BytesGenerator
+from email.header import decode_header, make_header
+from email.message import EmailMessage
 from email.policy import default
-from bs4 import BeautifulSoup
+from email.utils import parsedate_to_datetime
+from datetime import timezone
+from functools import lru_cache
+import importlib.util
 import logging
+from typing import Iterable, Iterator
 
 logger = logging.getLogger(__name__)
 
-async def find_folder(client, candidates: list[str]) -> str:
-    """Helper to find the first existing folder from a list of candidates."""
-    try:
-        status, folders = await client.list('""', '*')
-        if status != 'OK':
-            return candidates[0]
-            
-        folder_names = []
-        for f in folders:
-            if isinstance(f, (bytes, bytearray)):
-                f_str = f.decode()
-            else:
-                f_str = str(f)
-                
-            # Parse using the robust logic matching server.py
-            # Simple fallback or regex
-            if '"' in f_str:
-                parts = f_str.split('"')
-                folder_names.append(parts[-2])
-            else:
-                folder_names.append(f_str.split()[-1])
-        
-        for cand in candidates:
-            if cand in folder_names:
-                return cand
-        
-        return candidates[0]
-    except Exception as e:
-        logger.error(f"Error finding folder: {e}")
-        return candidates[0]
+# "* 12 FETCH (" at the start of each message in a FETCH response
+FETCH_START_RE = re.compile(rb'^(\d+) FETCH \(', re.IGNORECASE)
+# "{1234}" at the end of a line announces a literal in the next element
+LITERAL_RE = re.compile(rb'\{(\d+)\+?\}$')
+# One token of a FETCH data item list. Atoms may carry a [section]<origin> suffix,
+# e.g. BODY[HEADER.FIELDS (FROM SUBJECT DATE)] or BODY[1.2]<0>.
+FETCH_TOKEN_RE = re.compile(
+    r'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|\x00(\d+)\x00|([^\s()"\x00\[]+(?:\[[^\]]*\](?:<\d+>)?)?))'
+)
+
+# Common provider-specific names for the well-known folders
+FOLDER_ALIASES = {
+    "sent": ["Sent Mail", "Sent", "Sent Items", "INBOX.Sent", "[Gmail]/Sent Mail"],
+    "drafts": ["Drafts", "Draft", "INBOX.Drafts", "[Gmail]/Drafts"],
+    "trash": ["Trash", "Bin", "Deleted Items", "[Gmail]/Trash"],
+    "junk": ["Junk", "Spam", "Junk E-mail", "[Gmail]/Spam"],
+    "all": ["[Gmail]/All Mail", "[Google Mail]/All Mail", "All Mail"],
+    "archive": ["Archive", "Archives", "INBOX.Archive"],
+}
+FOLDER_ALIAS_KEYS = {
+    "sent": "sent", "sent items": "sent", "sent mail": "sent",
+    "drafts": "drafts", "draft": "drafts",
+    "trash": "trash", "bin": "trash", "deleted items": "trash",
+    "junk": "junk", "spam": "junk",
+    "all mail": "all",
+    "archive": "archive", "archives": "archive",
+}
+
+def quote_mailbox(name: str) -> str:
+    """Quote a mailbox name for commands where aioimaplib passes it verbatim."""
+    if name.startswith('"') or not re.search(r'[\s"\\()\[\]]', name):
+        return name
+    return '"' + name.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def parse_select_response(lines: list) -> dict:
+    """Pull EXISTS / UIDVALIDITY / UIDNEXT / HIGHESTMODSEQ out of a SELECT response."""
+    info = {}
+    for line in lines:
+        if not isinstance(line, (bytes, bytearray)):
+            continue
+        text = bytes(line).decode(errors='ignore')
+        match = re.match(r'(\d+) EXISTS', text)
+        if match:
+            info["exists"] = int(match.group(1))
+        for key in ("UIDVALIDITY", "UIDNEXT", "HIGHESTMODSEQ"):
+            match = re.search(rf'\[{key} (\d+)\]', text)
+            if match:
+                info[key.lower()] = int(match.group(1))
+    return info
 
 def check_attachment(content_disposition: str) -> bool:
     return "attachment" in str(content_disposition).lower()
 
-def extract_email_body(msg) -> str:
-    """Extracts plain text or HTML (converted to text) from an email message."""
-    body_text = ""
-    html_text = ""
-    
-    if msg.is_multipart():
-        for part in msg.walk():
-            ctype = part.get_content_type()
-            cdispo = str(part.get("Content-Disposition"))
-            
-            if check_attachment(cdispo):
-                continue
-                
-            if ctype == "text/plain":
-                 payload = part.get_payload(decode=True)
-                 if payload:
-                    body_text += payload.decode(errors='ignore')
-            elif ctype == "text/html":
-                 payload = part.get_payload(decode=True)
-                 if payload:
-                    html_text += payload.decode(errors='ignore')
-    else:
-        ctype = msg.get_content_type()
-        payload = msg.get_payload(decode=True)
+TRUNCATION_MARKER = "\n\n[... truncated, the email is longer than {limit} bytes ...]"
+
+def _decode_payload(part, limit: int | None) -> tuple[bytes, bool]:
+    """
+    Decode a part's payload, stopping after `limit` bytes. base64 and
+    quoted-printable are decoded line by line into one bytearray, so a huge
+    part costs no more than the slice we keep. Returns (data, truncated).
+    """
+    cte = str(part.get("Content-Transfer-Encoding", "")).strip().lower()
+    raw = part.get_payload()
+    if limit is None or not isinstance(raw, str) or cte not in ("base64", "quoted-printable"):
+        payload = part.get_payload(decode=True) or b""
+        if limit is not None and len(payload) > limit:
+            return bytes(memoryview(payload)[:limit]), True
+        return payload, False
+
+    out = bytearray()
+    pending = ""
+    try:
+        for line in io.StringIO(raw):
+            if cte == "base64":
+                pending += line.strip()
+                usable = len(pending) - len(pending) % 4
+                out += binascii.a2b_base64(pending[:usable])
+                pending = pending[usable:]
+            else:
+                out += quopri.decodestring(line.encode('ascii', errors='ignore'))
+            if len(out) >= limit:
+                return bytes(memoryview(out)[:limit]), True
+    except (binascii.Error, ValueError):
+        # Malformed encoding: let the email package apply its lenient decoder
+        payload = part.get_payload(decode=True) or b""
+        return payload[:limit], len(payload) > limit
+    return bytes(out), False
+
+def _to_text(data: bytes, part) -> str:
+    try:
+        return data.decode(part.get_content_charset() or 'utf-8', errors='ignore')
+    except LookupError:
+        return data.decode('utf-8', errors='ignore')
+
+# The HTML backends (BeautifulSoup, and the optional faster ones: pip install
+# selectolax / lxml) are imported on the first HTML email, not at startup
+
+@lru_cache(maxsize=None)
+def _lexbor_parser():
+    try:
+        from selectolax.lexbor import LexborHTMLParser
+    except ImportError:
+        return None
+    return LexborHTMLParser
+
+@lru_cache(maxsize=None)
+def _has_lxml() -> bool:
+    return importlib.util.find_spec("lxml") is not None
+
+def resolve_html_parser(preferred: str = "auto") -> str:
+    """
+    Pick the HTML backend: "selectolax", "lxml" or "html.parser". "auto" takes
+    the fastest one installed; an unavailable choice falls back to html.parser.
+    """
+    preferred = (preferred or "auto").lower()
+    selectolax = _lexbor_parser() is not None
+    lxml = _has_lxml()
+    if preferred == "auto":
+        return "selectolax" if selectolax else "lxml" if lxml else "html.parser"
+    if preferred == "selectolax" and selectolax or preferred == "lxml" and lxml:
+        return preferred
+    return "html.parser"
+
+def html_to_text(html: str, parser: str = "auto") -> str:
+    backend = resolve_html_parser(parser)
+    if backend == "selectolax":
+        tree = _lexbor_parser()(html)
+        # BeautifulSoup's get_text() leaves these out too
+        tree.strip_tags(["script", "style", "template"])
+        return tree.root.text(separator="\n") if tree.root is not None else ""
+    from bs4 import BeautifulSoup
+
+    return BeautifulSoup(html, backend).get_text('\n')
+
+def extract_email_body(msg, max_bytes: int | None = None, html_parser: str = "auto", convert=None) -> str:
+    """
+    Extracts plain text or HTML (converted to text) from an email message.
+
+    With max_bytes set, at most that much of the text/plain and of the
+    text/html parts is decoded and a truncation marker is appended.
+    Attachments and non-text parts are never decoded. `convert` replaces
+    html_to_text (e.g. with the memoized one from text_cache).
+    """
+    body_parts, html_parts = [], []
+    budget = {"text/plain": max_bytes, "text/html": max_bytes}
+    truncated = False
+
+    for part in (msg.walk() if msg.is_multipart() else [msg]):
+        ctype = part.get_content_type()
+        if ctype not in budget or part.is_multipart():
+            continue
+        if check_attachment(part.get("Content-Disposition")):
+            continue
+        room = budget[ctype]
+        if room is not None and room <= 0:
+            truncated = True
+            continue
+
+        payload, cut = _decode_payload(part, room)
+        truncated = truncated or cut
+        if room is not None:
+            budget[ctype] = room - len(payload)
         if payload:
-            decoded = payload.decode(errors='ignore')
-            if ctype == "text/plain":
-                body_text = decoded
-            elif ctype == "text/html":
-                html_text = decoded
-    
+            # Collected and joined once instead of growing a string with +=
+            (body_parts if ctype == "text/plain" else html_parts).append(_to_text(payload, part))
+
+    body_text = "".join(body_parts)
+    html_text = "".join(html_parts)
+    marker = TRUNCATION_MARKER.format(limit=max_bytes) if truncated else ""
+
+    if truncated and html_text.rfind("<") > html_text.rfind(">"):
+        # Don't let a tag cut in half show up as text
+        html_text = html_text[:html_text.rfind("<")]
+
     # Prioritize HTML -> Markdown if available, else Plain
     if html_text:
         try:
-            soup = BeautifulSoup(html_text, "html.parser")
-            return soup.get_text('\n')
+            return (convert or html_to_text)(html_text, html_parser) + marker
         except Exception:
-            return html_text if html_text else body_text
-    
-    return body_text
+            return html_text + marker
+
+    return body_text + marker if body_text else body_text
+
+def parse_message(raw: bytes):
+    return email.message_from_bytes(raw, policy=default)
 
 def parse_folder_line(folder_line):
     """Parses an IMAP LIST response line into name, flags, delimiter."""
@@ -96,7 +219,7 @@ def parse_folder_line(folder_line):
         delimiter = match.group("delim").replace('"', '')
         name = match.group("name").strip()
         if name.startswith('"') and name.endswith('"'):
-            name = name[1:-1]
+            name = re.sub(r'\\(.)', r'\1', name[1:-1])
             
         return {
             "name": name,
@@ -113,3 +236,295 @@ def parse_folder_line(folder_line):
                 "delimiter": "/"
             }
     return None
+
+
+def chunked(items: list, size: int) -> Iterator[list]:
+    """Yield successive slices of at most `size` items."""
+    for i in range(0, len(items), max(1, size)):
+        yield items[i:i + size]
+
+def to_sequence_set(ids: Iterable) -> str:
+    """Compress message numbers/UIDs into an IMAP sequence set, e.g. [1,2,3,7] -> "1:3,7"."""
+    numbers = sorted({int(i.decode() if isinstance(i, (bytes, bytearray)) else i) for i in ids})
+    ranges = []
+    for n in numbers:
+        if ranges and n == ranges[-1][1] + 1:
+            ranges[-1][1] = n
+        else:
+            ranges.append([n, n])
+    return ",".join(f"{a}:{b}" if a != b else str(a) for a, b in ranges)
+
+def _tokenize_fetch(text: str, literals: list[bytes]) -> list:
+    """Turn FETCH data items into nested lists; literals are swapped back in as bytes."""
+    stack: list[list] = [[]]
+    pos = 0
+    while pos < len(text):
+        m = FETCH_TOKEN_RE.match(text, pos)
+        if not m or m.end() == pos:
+            break
+        pos = m.end()
+        if m.group(1):
+            stack.append([])
+        elif m.group(2):
+            if len(stack) == 1:
+                break
+            inner = stack.pop()
+            stack[-1].append(inner)
+            if len(stack) == 1:
+                # Closing paren of the message's item list; ignore anything after it
+                break
+        elif m.group(3) is not None:
+            stack[-1].append(re.sub(r'\\(.)', r'\1', m.group(3)))
+        elif m.group(4) is not None:
+            stack[-1].append(literals[int(m.group(4))])
+        elif m.group(5):
+            stack[-1].append(m.group(5))
+    while len(stack) > 1:
+        inner = stack.pop()
+        stack[-1].append(inner)
+    return stack[0][0] if stack[0] and isinstance(stack[0][0], list) else []
+
+def parse_fetch_response(lines: list) -> list[dict]:
+    """
+    Split a (possibly multi-message) FETCH response from aioimaplib into one
+    dict per message: {"seq": 12, "UID": "101", "FLAGS": ["\\Seen"], "RFC822": b"..."}.
+
+    aioimaplib hands back text lines as bytes and literals as separate
+    elements, so literals are matched to the "{n}" that announced them.
+    """
+    records = []
+    current = None  # (seq, text parts, literals)
+    for line in lines:
+        if not isinstance(line, (bytes, bytearray)):
+            continue
+        if current is not None and current[1] and LITERAL_RE.search(current[1][-1]):
+            # Literal payload announced by the previous line
+            current[1][-1] = LITERAL_RE.sub(b'\x00%d\x00' % len(current[2]), current[1][-1])
+            current[2].append(bytes(line))
+            continue
+        match = FETCH_START_RE.match(line)
+        if match:
+            if current is not None:
+                records.append(current)
+            current = (int(match.group(1)), [bytes(line[match.end() - 1:])], [])
+        elif current is not None:
+            current[1].append(bytes(line))
+    if current is not None:
+        records.append(current)
+
+    parsed = []
+    for seq, parts, literals in records:
+        items = _tokenize_fetch(b"".join(parts).decode('utf-8', errors='replace'), literals)
+        record = {"seq": seq}
+        for key, value in zip(items[::2], items[1::2]):
+            record[str(key).upper()] = value
+        parsed.append(record)
+    return parsed
+
+def fetch_literal(record: dict, prefix: str) -> bytes:
+    """Return the first literal item whose name starts with prefix (e.g. "BODY[HEADER")."""
+    for key, value in record.items():
+        if isinstance(key, str) and key.startswith(prefix) and isinstance(value, bytes):
+            return value
+    return b""
+
+def _nil(value):
+    return None if isinstance(value, str) and value.upper() == "NIL" else value
+
+def _as_text(value) -> str | None:
+    value = _nil(value)
+    if isinstance(value, (bytes, bytearray)):
+        value = bytes(value).decode('utf-8', errors='replace')
+    return value if isinstance(value, str) else None
+
+def _param_dict(value) -> dict:
+    if not isinstance(value, list):
+        return {}
+    return {str(k).lower(): _as_text(v) for k, v in zip(value[::2], value[1::2])}
+
+def _decode_filename(name: str | None) -> str | None:
+    if not name:
+        return None
+    try:
+        return str(make_header(decode_header(name)))
+    except Exception:
+        return name
+
+def parse_bodystructure(structure, section: str = "") -> list[dict]:
+    """
+    Flatten a parsed BODYSTRUCTURE into its leaf parts, in section order:
+    [{"section": "1.2", "type": "text/html", "charset": "utf-8",
+      "encoding": "base64", "size": 1234, "disposition": None, "filename": None}].
+    Attached messages (message/rfc822) are reported as one leaf.
+    """
+    if not isinstance(structure, list) or not structure:
+        return []
+    if isinstance(structure[0], list):
+        # multipart: child parts first, then the subtype and extension data
+        count = 0
+        while count < len(structure) and isinstance(structure[count], list):
+            count += 1
+        parts = []
+        for n, child in enumerate(structure[:count], 1):
+            parts += parse_bodystructure(child, f"{section}.{n}" if section else str(n))
+        return parts
+
+    maintype, subtype = str(structure[0]).lower(), str(structure[1]).lower()
+    params = _param_dict(structure[2] if len(structure) > 2 else None)
+    # Disposition sits after the type specific fields (+lines for text, +envelope/body/lines for messages) and MD5
+    dispo_index = {"text": 9, "message": 11 if subtype == "rfc822" else 8}.get(maintype, 8)
+    dispo = structure[dispo_index] if len(structure) > dispo_index else None
+    disposition, filename = None, None
+    if isinstance(dispo, list) and dispo:
+        disposition = str(dispo[0]).lower()
+        filename = _param_dict(dispo[1] if len(dispo) > 1 else None).get("filename")
+    size = str(structure[6]) if len(structure) > 6 else ""
+    return [{
+        "section": section or "1",
+        "type": f"{maintype}/{subtype}",
+        "charset": params.get("charset"),
+        "encoding": (_as_text(structure[5]) or "7bit").lower() if len(structure) > 5 else "7bit",
+        "size": int(size) if size.isdigit() else 0,
+        "disposition": disposition,
+        "filename": _decode_filename(filename or params.get("name")),
+    }]
+
+def text_sections(parts: list[dict]) -> list[dict]:
+    """The parts extract_email_body would use: HTML if there is any, else plain text."""
+    texts = [p for p in parts if p["type"] in ("text/plain", "text/html") and p["disposition"] != "attachment"]
+    html = [p for p in texts if p["type"] == "text/html"]
+    return html or texts
+
+def _encoded_length(encoding: str, limit: int) -> int:
+    """Bytes of transfer-encoded data needed to decode `limit` bytes (with line breaks)."""
+    if encoding == "base64":
+        return (limit // 57 + 1) * 78
+    if encoding == "quoted-printable":
+        return limit * 3 + (limit * 3 // 76 + 1) * 3
+    return limit
+
+def _message_from_sections(header: bytes, sections: list[tuple[dict, bytes]]):
+    """Rebuild a parseable message from the header plus the fetched text sections."""
+    msg = email.message_from_bytes(header, policy=default)
+    for name in ("Content-Type", "Content-Transfer-Encoding"):
+        del msg[name]
+    msg["Content-Type"] = "multipart/mixed"
+    children = []
+    for part, data in sections:
+        child = EmailMessage()
+        child["Content-Type"] = part["type"]
+        if part["charset"]:
+            child.set_param("charset", part["charset"])
+        child["Content-Transfer-Encoding"] = part["encoding"]
+        child.set_payload(data.decode('ascii', errors='surrogateescape'))
+        children.append(child)
+    msg.set_payload(children)
+    return msg
+
+def _message_bytes(msg) -> bytes:
+    """A rebuilt message as raw bytes; 8-bit section data goes out as it came in."""
+    out = io.BytesIO()
+    BytesGenerator(out, policy=default).flatten(msg)
+    return out.getvalue()
+
+async def fetch_message_texts(client, uids: list[int], max_bytes: int | None,
+                              batch_size: int = 200) -> dict[int, tuple[bytes | None, object]]:
+    """
+    Fetch what is needed to show the text of each message, without setting \\Seen.
+
+    BODYSTRUCTURE and RFC822.SIZE come first. Text-only messages no larger
+    than max_bytes are fetched whole with BODY.PEEK[]; for the rest only the
+    header and the text sections are requested, as <0.N> partial ranges when
+    max_bytes would cut them anyway.
+
+    Returns {uid: (raw message, None)} for messages whose text arrived in
+    full, which are the ones worth caching (parsing them is left to the
+    caller, see parse_pool). That includes messages assembled from sections
+    when only attachments were left out; they come back re-serialized
+    without them. Messages with a text part cut at max_bytes come back as
+    {uid: (None, parsed message)} and are never cached, since a later call
+    with a larger limit must not get the cut text.
+    """
+    structures = {}
+    for chunk in chunked(uids, batch_size):
+        status, data = await client.uid('fetch', to_sequence_set(chunk), '(UID RFC822.SIZE BODYSTRUCTURE)')
+        if status != 'OK':
+            logger.warning(f"BODYSTRUCTURE fetch failed for {len(chunk)} messages: {status}")
+            continue
+        for record in parse_fetch_response(data):
+            if "UID" in record:
+                size = str(record.get("RFC822.SIZE", "0"))
+                structures[int(record["UID"])] = (int(size) if size.isdigit() else 0,
+                                                  parse_bodystructure(record.get("BODYSTRUCTURE")))
+
+    whole, by_items, cut = [], {}, set()
+    for uid, (size, parts) in structures.items():
+        texts = text_sections(parts)
+        only_text = all(p["type"] in ("text/plain", "text/html") and p["disposition"] != "attachment" for p in parts)
+        if only_text and (not max_bytes or size <= max_bytes):
+            whole.append(uid)
+            continue
+        items = ["UID", "BODY.PEEK[HEADER]"]
+        for part in texts:
+            # One byte past the limit, so decoding can tell the part was cut (and add the marker)
+            wanted = _encoded_length(part["encoding"], max_bytes + 1) if max_bytes else None
+            partial = f"<0.{wanted}>" if wanted and part["size"] > wanted else ""
+            if partial:
+                cut.add(uid)
+            items.append(f"BODY.PEEK[{part['section']}]{partial}")
+        # Messages with the same layout share one FETCH command
+        by_items.setdefault(f"({' '.join(items)})", []).append(uid)
+
+    results = {}
+    for chunk in chunked(whole, batch_size):
+        status, data = await client.uid('fetch', to_sequence_set(chunk), '(UID BODY.PEEK[])')
+        if status != 'OK':
+            logger.warning(f"Batch fetch failed for {len(chunk)} messages: {status}")
+            continue
+        for record in parse_fetch_response(data):
+            raw = fetch_literal(record, "BODY[]")
+            if "UID" in record and raw:
+                results[int(record["UID"])] = (raw, None)
+
+    for items, group in by_items.items():
+        for chunk in chunked(group, batch_size):
+            status, data = await client.uid('fetch', to_sequence_set(chunk), items)
+            if status != 'OK':
+                logger.warning(f"Section fetch failed for {len(chunk)} messages: {status}")
+                continue
+            for record in parse_fetch_response(data):
+                if "UID" not in record:
+                    continue
+                uid = int(record["UID"])
+                sections = [(part, fetch_literal(record, f"BODY[{part['section']}]"))
+                            for part in text_sections(structures[uid][1])]
+                msg = _message_from_sections(fetch_literal(record, "BODY[HEADER]"), sections)
+                results[uid] = (None, msg) if uid in cut else (_message_bytes(msg), None)
+    return results
+
+def encode_cursor(state: dict) -> str:
+    """Pack pagination/polling state into an opaque, URL-safe token."""
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(",", ":")).encode()).decode()
+
+def decode_cursor(cursor: str | None) -> dict:
+    if not cursor:
+        return {}
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(state, dict):
+        raise ValueError("Invalid cursor")
+    return state
+
+def date_timestamp(date_header: str | None) -> float | None:
+    """Date header -> POSIX timestamp (naive dates are taken as UTC), None if unparseable."""
+    if not date_header:
+        return None
+    try:
+        parsed = parsedate_to_datetime(date_header)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()